@@ -1,6 +1,6 @@
 import streamlit as st
-import uuid
 import rag_utils
+import game_engine
 import time
 
 st.set_page_config(layout="wide")
@@ -11,36 +11,18 @@ st.title("Story Weawer")
 if 'step' not in st.session_state:
     st.session_state['step'] = 1
 
-if 'user_choice' not in st.session_state:
-    st.session_state['user_choice'] = ""
-
-if 'my_session_id' not in st.session_state:
-    st.session_state['my_session_id'] = None
-
-if 'the_story' not in st.session_state:
-    st.session_state['the_story'] = ""
-
-if 'characters_list' not in st.session_state:
-    st.session_state['characters_list'] = []
-
-if 'prompt1' not in st.session_state:
-    st.session_state['prompt1'] = ""
-
-if 'next_action_str' not in st.session_state:
-    st.session_state['next_action_str'] = ""
-
-if 'no_of_steps' not in st.session_state:
-    st.session_state['no_of_steps'] = 10
+if 'game' not in st.session_state:
+    st.session_state['game'] = None
 
 if "messages" not in st.session_state:
         st.session_state.messages = []
 
-if 'result' not in st.session_state:
-    st.session_state['result'] = ""
-
-connection = rag_utils.connect_to_postgres()
-cursor = rag_utils.create_vector_extension_and_register(connection)
+if rag_utils.embedding_cache.store is None:
+    rag_utils.embedding_cache.store = rag_utils.PostgresEmbeddingStore()
 table_name = "story_embeddings"
+story_blob_name = "story.txt"
+# the game itself runs in the engine, this script only renders it and keeps the (serializable) GameState
+engine = game_engine.GameEngine(story_id=story_blob_name, backend=rag_utils.get_retrieval_backend(table_name=table_name))
 
 placeholder = st._bottom.empty()
 
@@ -49,31 +31,45 @@ if st.session_state['step'] != 1:
         with st.chat_message(message["role"]):
             st.markdown(f'{message["content"]}', unsafe_allow_html=True)
 
-def step_one():
-    if st.session_state['my_session_id'] is None:
-            st.session_state['my_session_id'] = str(uuid.uuid4())
-    # Load story and characters
-    the_story = rag_utils.get_story_from_blob("story.txt")
-    st.session_state['the_story'] = the_story
-    tries_ch_list = 0
-    characters_list = st.session_state['characters_list']
-    dummy_var = 0
-    while len(characters_list) < 1 and tries_ch_list < 5:
-        dummy_var = 1
-        characters_str = rag_utils.character_extraction_chain_fun(the_story)
-        characters_list = eval(characters_str)
+def render_turn_stream(turn_stream):
+    with st.chat_message("assistant"):
+        description_placeholder = st.empty()
+        actions_placeholder = st.empty()
         try:
-            abilities = characters_list[0].get("character_abilities")
-            weaknesses = characters_list[0].get("character_weaknesses")
-            if (abilities is not None) and (weaknesses is not None):
-                break
-        except:
-            characters_list = []
-        tries_ch_list += 1
-    # Display characters
-    if dummy_var == 1:
+            for parser in game_engine.iterate_sync(turn_stream):
+                description_placeholder.markdown(f'<p style="font-size: 20px;">{parser.description}<br></p>', unsafe_allow_html=True)
+                if parser.actions is not None:
+                    actions_placeholder.markdown(actions_message(parser.actions), unsafe_allow_html=True)
+        except game_engine.TurnError as e:
+            # the game state is unchanged, the turn is played again
+            description_placeholder.empty()
+            actions_placeholder.empty()
+            st.warning(str(e))
+            return False
+        game = st.session_state['game']
+        description_message = f'<p style="font-size: 20px;">{game.description}<br></p>'
+        description_placeholder.markdown(description_message, unsafe_allow_html=True)
+        actions_placeholder.markdown(actions_message(game.actions), unsafe_allow_html=True)
+    message = description_message + actions_message(game.actions)
+    st.session_state.messages.append({"role": "assistant", "content": message})
+    return True
+
+def actions_message(actions):
+    message = ""
+    action_counter = 1
+    for action in actions:
+        message += f'<p style="font-size: 20px;">{action_counter}. {action}<br></p>'
+        action_counter += 1
+    return message
+
+def step_one():
+    if st.session_state['game'] is None:
+        # Load story and characters
+        game = game_engine.run_sync(engine.start())
+        st.session_state['game'] = game
+        # Display characters
         character_string = '<p style="font-size: 20px;">'
-        for character in characters_list:
+        for character in game.characters:
             character_string += f"------- Character_name: {character['character_name']} --------<br>"
             character_string += f"Abilities: {character['character_abilities']}<br>"
             character_string += f"Weaknesses: {character['character_weaknesses']}<br>"
@@ -82,105 +78,101 @@ def step_one():
         with st.chat_message("assistant"):
             st.markdown(f'{character_string}', unsafe_allow_html=True)
         st.session_state.messages.append({"role": "assistant", "content": character_string})
-    st.session_state['characters_list'] = characters_list
     prompt = placeholder.chat_input("Choose a character from the ones mentioned above: ", key="character_selection")
     if prompt is not None:
         st.session_state['prompt1'] = str(prompt)
         st.session_state['step'] = 2
 
 
-if st.session_state['step'] == 1:
-    step_one()
-    
-
 def step_two():
-        user_choice = rag_utils.choosen_character_user(st.session_state['characters_list'], st.session_state['prompt1'])
-        st.session_state['user_choice'] = user_choice
-        with st.chat_message("user"):
-            st.markdown(user_choice)
-        st.session_state.messages.append({"role": "user", "content": user_choice})
-
-if st.session_state['step'] == 2:
-    step_two()
+    game = st.session_state['game']
+    user_choice = rag_utils.choosen_character_user(game.characters, st.session_state['prompt1'])
+    if user_choice is None:
+        st.warning(f"{st.session_state['prompt1']} is not a character of the story.")
+        st.session_state['step'] = 1
+        return
+    st.session_state['prompt1'] = user_choice
+    with st.chat_message("user"):
+        st.markdown(user_choice)
+    st.session_state.messages.append({"role": "user", "content": user_choice})
     st.session_state['step'] = 3
 
+
 def step_three():
-    # check if table exists and create one
-    if not rag_utils.check_if_table_exists(cursor, table_name):
-        st.session_state.messages.append({"role": "assistant", "content": "Embeddings table does not exist. Creating one."})
-        with st.chat_message("assistant"):
-            st.markdown(f'<p style="font-size: 20px;">Embeddings table does not exist. Creating one.</p>', unsafe_allow_html=True)
-        rag_utils.create_table(cursor, connection, table_name)
-        paragraphs = rag_utils.split_into_paragraphs(st.session_state['the_story'])
-        for paragraph in paragraphs:
-            embedding = rag_utils.get_embedding(paragraph)
-            rag_utils.insert_story_embeddings(cursor, connection, table_name, embedding, paragraph)
-        st.session_state.messages.append({"role": "assistant", "content": "Table created."})
+    game = st.session_state['game']
+    if not render_turn_stream(engine.choose_character_stream(game, st.session_state['prompt1'])):
+        st.button("Try again")
+        return False
+    if game.ingest_stats is not None:
+        ingest_message = (f"Story embeddings were missing or outdated and have been updated. "
+                          f"{game.ingest_stats['rows']} paragraphs embedded, {game.ingest_stats['reused']} reused "
+                          f"({game.ingest_stats['rows_per_sec']:.1f} rows/sec).")
+        st.session_state.messages.append({"role": "assistant", "content": ingest_message})
         with st.chat_message("assistant"):
-            st.markdown(f'<p style="font-size: 20px;">Table created.</p>', unsafe_allow_html=True)
-
-    fragments_list = rag_utils.get_exact_match(cursor, table_name, st.session_state['user_choice'])
-    # start the character chain 
-    character_start_content = rag_utils.character_start_chain_memory_fun(st.session_state['user_choice'], 
-                                                                         fragments_list, st.session_state['my_session_id'])
-    result = rag_utils.advancing(character_start_content)
-    st.session_state['result'] = result
-    message = f'<p style="font-size: 20px;">{result.get("description")}<br></p>'
-    action_counter = 1
-    for action in result.get("actions"):
-        message += f'<p style="font-size: 20px;">{action_counter}. {action}<br></p>'
-        action_counter += 1
-    with st.chat_message("assistant"):
-        st.markdown(message, unsafe_allow_html=True)
-    st.session_state.messages.append({"role": "assistant", "content": message})
+            st.markdown(f'<p style="font-size: 20px;">{ingest_message}</p>', unsafe_allow_html=True)
+    return True
 
-if st.session_state['step'] == 3:
-    step_three()
-    st.session_state['step'] = 4
 
 def step_four():
-    result = st.session_state['result']
+    game = st.session_state['game']
     prompt = placeholder.chat_input("Select an action from the ones mentioned above by it's number: ", key="action_selection1")
     if prompt is not None:
-        prompt_int = int(prompt)
-        next_action_str = rag_utils.next_actions(result.get("actions"), prompt_int)
+        if not prompt.strip().isdigit() or not 1 <= int(prompt) <= len(game.actions):
+            st.warning(f"Please enter a number between 1 and {len(game.actions)}.")
+            return
+        next_action_str = game.actions[int(prompt) - 1]
         with st.chat_message("user"):
             st.markdown(next_action_str)
         st.session_state.messages.append({"role": "user", "content": next_action_str})
-        fragments_list_exact = rag_utils.get_exact_match(cursor, table_name, st.session_state['user_choice']) 
-        fragments_list_similar = rag_utils.get_similar_to_action(cursor, table_name, next_action_str)
-        fragments_list_exact.extend(fragments_list_similar)
-
-        character_advancement_content = rag_utils.character_advancement_chain_memory_fun(st.session_state['user_choice'], 
-                                                                                         fragments_list_exact, 
-                                                                                         st.session_state['my_session_id'], 
-                                                                                         st.session_state['no_of_steps'], 
-                                                                                         next_action_str)
-        if st.session_state['no_of_steps'] > 0:
-            result = rag_utils.advancing(character_advancement_content, True)
-            st.session_state['result'] = result
-            message = f'<p style="font-size: 20px;">{result.get("description")}<br></p>'
-            action_counter = 1
-            for action in result.get("actions"):
-                message += f'<p style="font-size: 20px;">{action_counter}. {action}<br></p>'
-                action_counter += 1
-            st.session_state.messages.append({"role": "assistant", "content": message})
-            with st.chat_message("assistant"):
-                st.markdown(message, unsafe_allow_html=True)
-                st.session_state['no_of_steps'] -= 1
-        else:
-            result = rag_utils.advancing(character_advancement_content)
-            message = f'<p style="font-size: 20px;">{result.get("description")}<br></p>'
-            with st.chat_message("assistant"):
-                st.markdown(message, unsafe_allow_html=True)
-            st.session_state.messages.append({"role": "assistant", "content": message})
+        if not render_turn_stream(engine.advance_stream(game, int(prompt))):
+            st.session_state.messages.pop()
+            return
+        if game.status == "ended":
             st.session_state['step'] = 5
         
-if st.session_state['step'] == 4:
-    step_four()
 
 def step_five():
     st.markdown(f'<p style="font-size: 50px; text-align: center;">THE END</p>', unsafe_allow_html=True)
 
+def metrics_panel():
+    session_stats = rag_utils.metrics.session_stats(st.session_state['game'].session_id) if st.session_state['game'] else {}
+    with st.sidebar:
+        st.header("Metrics")
+        if not session_stats:
+            st.caption("Nothing recorded yet.")
+            return
+        totals = session_stats["totals"]
+        st.metric("Tokens", totals["prompt_tokens"] + totals["completion_tokens"])
+        st.metric("Estimated cost", f"${totals['cost']:.4f}")
+        last_turn = max(session_stats["turns"])
+        st.subheader(f"Turn {last_turn}")
+        st.table([{"stage": stage, "ms": round(stage_stats["seconds"] * 1000, 1), 
+                   "prompt tokens": stage_stats["prompt_tokens"], "completion tokens": stage_stats["completion_tokens"]} 
+                  for stage, stage_stats in sorted(session_stats["turns"][last_turn].items())])
+        schedulers = rag_utils.scheduler_stats()
+        st.caption(", ".join(f"{name} queue: {schedulers[name]['waiting']} waiting (peak {schedulers[name]['peak_waiting']}), "
+                             f"p95 wait {schedulers[name]['wait_p95_ms']:.0f}ms" for name in ("llm", "embedding")))
+        counters = rag_utils.metrics.counter_stats()
+        if counters:
+            st.caption(", ".join(f"{name}: {value}" for name, value in sorted(counters.items())))
+        st.download_button("Prometheus metrics", rag_utils.metrics.prometheus(), file_name="metrics.prom")
+        st.download_button("JSON lines events", rag_utils.metrics.jsonl(), file_name="metrics.jsonl")
+
+if st.session_state['step'] == 1:
+    step_one()
+
+if st.session_state['step'] == 2:
+    step_two()
+
+if st.session_state['step'] == 3:
+    if step_three():
+        st.session_state['step'] = 4
+
+if st.session_state['step'] == 4:
+    step_four()
+
 if st.session_state['step'] == 5:
-    step_five()
\ No newline at end of file
+    step_five()
+
+if rag_utils.metrics.enabled:
+    metrics_panel()
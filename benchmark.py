@@ -0,0 +1,383 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import platform
+import random
+import tempfile
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import numpy as np
+from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables.history import RunnableWithMessageHistory
+
+import rag_utils
+
+
+# offline stand-ins for OpenAI, the vector store and Neo4j
+class FakeEmbeddingClient:
+    """Deterministic stand-in for the openai client: the same text always gets the same unit vector.
+    Each request sleeps latency + per_text_latency * number of texts."""
+
+    def __init__(self, dimensions:int = rag_utils.EMBEDDING_DIMENSIONS, latency:float = 0.0, per_text_latency:float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+        self.requests = 0
+        self.texts = 0
+        self.embeddings = SimpleNamespace(create=self.create)
+
+    def vector(self, text:str, dimensions:int = None) -> list:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        # like the text-embedding-3 models, shorter embeddings are the first dimensions, normalized again
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32)[:dimensions]
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def create(self, input, model = None, dimensions:int = None):
+        texts = [input] if isinstance(input, str) else list(input)
+        self.requests += 1
+        self.texts += len(texts)
+        time.sleep(self.latency + self.per_text_latency * len(texts))
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=self.vector(text, dimensions)) for i, text in enumerate(texts)])
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic stand-in for the chat model: answers with a game turn (description + actions) derived
+    from the prompt. Sleeps latency before the first chunk and chunk_latency before each chunk."""
+
+    latency: float = 0.0
+    chunk_latency: float = 0.0
+    chunk_size: int = 16
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _content(self, messages) -> str:
+        seed = hashlib.sha256(messages[-1].content.encode("utf-8")).hexdigest()[:8]
+        actions = [f"Action {i} of turn {seed}" for i in range(1, 5)]
+        return json.dumps({"description": f"The story moves on ({seed}). " * 8, "actions": actions})
+
+    def _generate(self, messages, stop = None, run_manager = None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._content(messages)))])
+
+    def _stream(self, messages, stop = None, run_manager = None, **kwargs):
+        content = self._content(messages)
+        time.sleep(self.latency)
+        for i in range(0, len(content), self.chunk_size):
+            time.sleep(self.chunk_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=content[i:i + self.chunk_size]))
+
+    async def _agenerate(self, messages, stop = None, run_manager = None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._content(messages)))])
+
+    async def _astream(self, messages, stop = None, run_manager = None, **kwargs):
+        content = self._content(messages)
+        await asyncio.sleep(self.latency)
+        for i in range(0, len(content), self.chunk_size):
+            await asyncio.sleep(self.chunk_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=content[i:i + self.chunk_size]))
+
+
+def use_fakes(client, llm):
+    """Route the lazy clients of rag_utils to the fakes, without rate limits, and keep the chat histories in memory"""
+    histories = {}
+
+    def get_memory(session_id):
+        handle = histories.get(session_id)
+        if handle is None:
+            handle = histories.setdefault(session_id, rag_utils.CachedChatMessageHistory(session_id, backend=InMemoryChatMessageHistory()))
+        return handle
+
+    # the fakes have no rate limits, the account's would throttle the benchmark
+    for scheduler in (rag_utils.llm_scheduler, rag_utils.embedding_scheduler):
+        scheduler.requests_per_minute = scheduler.tokens_per_minute = 0
+    rag_utils.get_client = lambda: client
+    rag_utils.get_llm = lambda: llm
+    rag_utils.get_memory = get_memory
+
+
+def make_story(paragraphs:int, characters, seed:int = 0) -> str:
+    rng = random.Random(seed)
+    words = ["forest", "castle", "river", "sword", "night", "storm", "village", "dragon", "secret", "road",
+             "king", "shadow", "fire", "mountain", "ship", "letter", "door", "garden", "tower", "stone"]
+    story = []
+    for i in range(paragraphs):
+        sentences = []
+        for _ in range(rng.randint(3, 8)):
+            sentence = " ".join(rng.choice(words) for _ in range(rng.randint(6, 16)))
+            if rng.random() < 0.3:
+                sentence = f"{rng.choice(characters)} saw the {sentence}"
+            sentences.append(sentence.capitalize() + ".")
+        story.append(f"{i}. " + " ".join(sentences))
+    return "\n\n".join(story)
+
+
+def summarize(latencies) -> dict:
+    latencies = np.array(latencies) * 1000
+    return {"count": int(len(latencies)), "mean_ms": float(latencies.mean()), "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)), "max_ms": float(latencies.max())}
+
+
+def bench_ingest(story:str, directory:str, client:FakeEmbeddingClient) -> dict:
+    backend = rag_utils.NumpyBackend(directory)
+    requests = client.requests
+    stats = backend.ingest(story, "story", cache=rag_utils.EmbeddingCache())
+    return {"rows": stats["rows"], "seconds": stats["seconds"], "rows_per_sec": stats["rows_per_sec"],
+            "embedding_requests": client.requests - requests}
+
+
+def bench_pgvector_ingest(story:str, story_id:str, table_name:str, dimensions:int, client:FakeEmbeddingClient) -> tuple:
+    # the story is stored again from scratch, so that no character is in the mention index yet
+    backend = rag_utils.PgVectorBackend(table_name, dimensions=dimensions)
+    with rag_utils.pooled_connection() as connection:
+        cursor = connection.cursor()
+        if rag_utils.check_if_table_exists(cursor, table_name):
+            rag_utils.delete_story(cursor, connection, table_name, story_id)
+    requests = client.requests
+    stats = backend.ingest(story, story_id)
+    return backend, {"rows": stats["rows"], "seconds": stats["seconds"], "rows_per_sec": stats["rows_per_sec"],
+                     "embedding_requests": client.requests - requests}
+
+
+def bench_retrieval(backend:rag_utils.RetrievalBackend, story_id:str, characters, client:FakeEmbeddingClient,
+                    queries:int, k:int) -> dict:
+    # a new backend: the story is loaded (numpy) without querying a character, so every exact match starts cold
+    start = time.perf_counter()
+    backend.has_story(story_id)
+    load_seconds = time.perf_counter() - start
+
+    exact_cold, exact_warm = [], []
+    for character in characters:
+        start = time.perf_counter()
+        backend.get_exact_match(character, story_id)
+        exact_cold.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        backend.get_exact_match(character, story_id)
+        exact_warm.append(time.perf_counter() - start)
+
+    similar = []
+    for i in range(queries):
+        vector = np.array(client.vector(f"query {i}"))
+        start = time.perf_counter()
+        backend.get_similar(vector, story_id, k)
+        similar.append(time.perf_counter() - start)
+    return {"load_ms": load_seconds * 1000, "exact_match_cold": summarize(exact_cold),
+            "exact_match_warm": summarize(exact_warm), "similar": summarize(similar)}
+
+
+def bench_embedding_burst(client:FakeEmbeddingClient, sessions:int) -> dict:
+    # one action embedded by each of many sessions at the same time, coalesced or not
+    results = {}
+    for name, batcher in (("separate", None), ("coalesced", rag_utils.EmbeddingMicroBatcher())):
+        latencies = []
+        requests = client.requests
+
+        def embed(i):
+            start = time.perf_counter()
+            rag_utils.get_embeddings([f"{name} action {i}"], client, cache=None, batcher=batcher)
+            latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=embed, args=(i,)) for i in range(sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results[name] = {"embedding_requests": client.requests - requests, "latency": summarize(latencies)}
+    return results
+
+
+def bench_turn_overhead(character:str, fragments, iterations:int) -> dict:
+    # per-turn cost of the chain and history handle setup, rebuilt on every call (as before) or reused,
+    # alone and around an advancement of the zero-latency chat model
+    llm = FakeChatModel()
+    prompt = rag_utils.character_advancement_memory_prompt
+    session_id = str(uuid.uuid4())
+    rag_utils.get_memory(session_id).messages
+
+    def rebuilt():
+        chain = prompt | rag_utils.structured_llm(llm, rag_utils.turn_schema)
+        return RunnableWithMessageHistory(chain, lambda session_id: rag_utils.CachedChatMessageHistory(session_id), 
+                                          input_messages_key="choosen_action", history_messages_key="history")
+
+    def reused():
+        return rag_utils.get_chain_with_history(prompt, "choosen_action", llm)
+
+    inputs = {"choosen_character": character, "fragment_list": fragments, "no_of_steps": 5, "choosen_action": "Action 1"}
+    results = {}
+    for name, build in (("rebuilt", rebuilt), ("reused", reused)):
+        setups, turns = [], []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            build()
+            setups.append(time.perf_counter() - start)
+        for _ in range(iterations):
+            start = time.perf_counter()
+            for _ in build().stream(inputs, config={"configurable": {"session_id": session_id}}):
+                pass
+            turns.append(time.perf_counter() - start)
+        results[name] = {"setup": summarize(setups), "turn": summarize(turns)}
+    return results
+
+
+def bench_turns(directory:str, character:str, steps:int, think_time:float) -> dict:
+    # the turn loop of app.py, without Streamlit
+    backend = rag_utils.NumpyBackend(directory)
+    session_id = str(uuid.uuid4())
+    prefetcher = rag_utils.ActionPrefetcher()
+
+    start = time.perf_counter()
+    fragments = backend.get_exact_match(character, "story")
+    parser = None
+    for parser in rag_utils.character_start_chain_memory_stream(character, fragments, session_id):
+        pass
+    result = rag_utils.advancing(parser.buffer)
+    start_seconds = time.perf_counter() - start
+
+    turns, first_chunks, retrieval_timings = [], [], []
+    for step in range(steps, 0, -1):
+        prefetcher.prefetch(session_id, result["actions"], backend, "story", choosen_character=character,
+                            exact_fragments=fragments, no_of_steps=step)
+        time.sleep(think_time)
+        action = result["actions"][0]
+        start = time.perf_counter()
+        speculative_content = prefetcher.continuation(session_id, action)
+        if speculative_content is not None:
+            rag_utils.commit_advancement(session_id, action, speculative_content)
+            turn_stream = [rag_utils.TurnStreamParser().feed(speculative_content)]
+        else:
+            turn_context = rag_utils.retrieve_turn_context(backend, character, action, "story", session_id=session_id,
+                                                           exact_fragments=fragments, prefetcher=prefetcher)
+            retrieval_timings.append(turn_context["timings"])
+            turn_stream = rag_utils.character_advancement_chain_memory_stream(character, turn_context["fragments"],
+                                                                              session_id, step, action)
+        first_chunk = None
+        for parser in turn_stream:
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - start
+        result = rag_utils.advancing(parser.buffer)
+        turns.append(time.perf_counter() - start)
+        first_chunks.append(first_chunk)
+    rag_utils.get_memory(session_id).flush()
+
+    stages = {}
+    for timings in retrieval_timings:
+        for stage, seconds in timings.items():
+            if not isinstance(seconds, bool):
+                stages.setdefault(stage, []).append(seconds)
+    return {"start_ms": start_seconds * 1000, "turn": summarize(turns), "first_chunk": summarize(first_chunks),
+            "retrieval_stages": {stage: summarize(seconds) for stage, seconds in stages.items()},
+            "prefetch": prefetcher.stats()}
+
+
+def bench_sessions(directory:str, story:str, characters, sessions:int, steps:int) -> dict:
+    # many games played at once by one GameEngine on one event loop, as the app serves its sessions
+    from game_engine import GameEngine
+
+    engine = GameEngine("story", backend=rag_utils.NumpyBackend(directory), no_of_steps=steps,
+                        prefetcher=rag_utils.ActionPrefetcher(), load_story=lambda story_id: story,
+                        load_characters=lambda the_story: [{"character_name": name} for name in characters])
+    turns = []
+
+    async def play(i):
+        state = await engine.start()
+        start = time.perf_counter()
+        await engine.choose_character(state, characters[i % len(characters)])
+        turns.append(time.perf_counter() - start)
+        while state.status == "playing":
+            start = time.perf_counter()
+            await engine.advance(state, 1)
+            turns.append(time.perf_counter() - start)
+
+    async def play_all():
+        await asyncio.gather(*(play(i) for i in range(sessions)))
+
+    start = time.perf_counter()
+    asyncio.run(play_all())
+    elapsed = time.perf_counter() - start
+    return {"sessions": sessions, "seconds": elapsed, "turns_per_sec": len(turns) / elapsed, "turn": summarize(turns)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of ingestion, retrieval and game turns, "
+                                                 "with fake OpenAI models, the numpy backend and in-memory history")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="story sizes, in paragraphs")
+    parser.add_argument("--queries", type=int, default=200, help="similarity queries per story size")
+    parser.add_argument("--steps", type=int, default=10, help="advancement steps of the end-to-end game")
+    parser.add_argument("--dimensions", type=int, default=rag_utils.EMBEDDING_DIMENSIONS, help="dimensions of the fake embeddings")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per fake embedding request")
+    parser.add_argument("--embedding-text-latency", type=float, default=0.0005, help="extra seconds per text in a fake embedding request")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds before the first chunk of the fake chat model")
+    parser.add_argument("--llm-chunk-latency", type=float, default=0.01, help="seconds per streamed chunk of the fake chat model")
+    parser.add_argument("--burst-sessions", type=int, default=100, help="sessions embedding an action at the same time")
+    parser.add_argument("--overhead-turns", type=int, default=200, help="turns of the chain setup micro-benchmark")
+    parser.add_argument("--sessions", type=int, default=50, help="games played at the same time by the game engine")
+    parser.add_argument("--session-steps", type=int, default=3, help="advancement steps of each concurrent game")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds the player takes to choose an action")
+    parser.add_argument("--pgvector", action="store_true", help="also benchmark ingestion and retrieval on PostgreSQL (POSTGRESQL_* settings)")
+    parser.add_argument("--pg-table", default="benchmark_embeddings", help="table of the pgvector benchmark, its stories are replaced")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated stories")
+    parser.add_argument("--output", default="benchmark_results.json", help="where the JSON results are written")
+    args = parser.parse_args()
+
+    client = FakeEmbeddingClient(args.dimensions, args.embedding_latency, args.embedding_text_latency)
+    llm = FakeChatModel(latency=args.llm_latency, chunk_latency=args.llm_chunk_latency)
+    use_fakes(client, llm)
+    characters = ["Aria", "Borin", "Cassius", "Delia", "Edric"]
+
+    results = {"config": vars(args), "python": platform.python_version(), "numpy": np.__version__,
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "sizes": []}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            size_directory = tempfile.mkdtemp(dir=directory)
+            story = make_story(size, characters, args.seed)
+            ingestion = bench_ingest(story, size_directory, client)
+            retrieval = bench_retrieval(rag_utils.NumpyBackend(size_directory), "story", characters, client, args.queries, k=5)
+            print(f"{size} paragraphs: ingest {ingestion['rows_per_sec']:.1f} rows/sec, "
+                  f"exact match p50 {retrieval['exact_match_cold']['p50_ms']:.2f}ms, "
+                  f"similar p50 {retrieval['similar']['p50_ms']:.2f}ms")
+            results["sizes"].append({"paragraphs": size, "chunks": ingestion["rows"], "ingestion": ingestion, "retrieval": retrieval})
+            if args.pgvector:
+                story_id = f"benchmark-{size}"
+                backend, pg_ingestion = bench_pgvector_ingest(story, story_id, args.pg_table, args.dimensions, client)
+                pg_retrieval = bench_retrieval(backend, story_id, characters, client, args.queries, k=5)
+                print(f"{size} paragraphs (pgvector): ingest {pg_ingestion['rows_per_sec']:.1f} rows/sec, "
+                      f"exact match p50 {pg_retrieval['exact_match_cold']['p50_ms']:.2f}ms, "
+                      f"similar p50 {pg_retrieval['similar']['p50_ms']:.2f}ms")
+                results["sizes"][-1]["pgvector"] = {"ingestion": pg_ingestion, "retrieval": pg_retrieval}
+        # the game is played on the largest story
+        results["game"] = bench_turns(size_directory, characters[0], args.steps, args.think_time)
+        print(f"Game of {args.steps} steps: turn p50 {results['game']['turn']['p50_ms']:.1f}ms, "
+              f"first chunk p50 {results['game']['first_chunk']['p50_ms']:.1f}ms")
+        results["concurrent_sessions"] = bench_sessions(size_directory, story, characters, args.sessions, args.session_steps)
+        print(f"{args.sessions} concurrent games: {results['concurrent_sessions']['turns_per_sec']:.1f} turns/sec, "
+              f"turn p50 {results['concurrent_sessions']['turn']['p50_ms']:.1f}ms, "
+              f"p95 {results['concurrent_sessions']['turn']['p95_ms']:.1f}ms")
+        fragments = rag_utils.NumpyBackend(size_directory).get_exact_match(characters[0], "story")
+        results["turn_overhead"] = bench_turn_overhead(characters[0], fragments, args.overhead_turns)
+        print("Chain setup per turn: " + ", ".join(
+            f"{name} {overhead['setup']['mean_ms']:.3f}ms (turn {overhead['turn']['mean_ms']:.2f}ms)"
+            for name, overhead in results["turn_overhead"].items()))
+
+    results["embedding_burst"] = bench_embedding_burst(client, args.burst_sessions)
+    print(f"{args.burst_sessions} concurrent action embeddings: "
+          + ", ".join(f"{name} {burst['embedding_requests']} requests, p50 {burst['latency']['p50_ms']:.1f}ms"
+                      for name, burst in results["embedding_burst"].items()))
+
+    results["counters"] = rag_utils.metrics.counter_stats()
+    results["schedulers"] = rag_utils.scheduler_stats()
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+import asyncio
+import copy
+import queue
+import threading
+import uuid
+from functools import lru_cache
+
+import rag_utils
+
+
+class GameState:
+    """The game session between two calls, as plain data. to_dict() is JSON serializable and from_dict()
+    restores it, so the state can be kept anywhere (Streamlit, a cache, a database). The chat history
+    (written to Neo4j in batches), the response cache and the action prefetcher are held by the process,
+    so a session is served by the same worker process for its whole game."""
+
+    fields = ["session_id", "story_id", "story_hash", "status", "no_of_steps", "turn", "characters", "character",
+              "fragments", "description", "actions", "transcript", "ingest_stats"]
+
+    def __init__(self, session_id:str = None, story_id:str = "story.txt", no_of_steps:int = 10):
+        self.session_id = session_id or str(uuid.uuid4())
+        self.story_id = story_id
+        self.story_hash = None
+        # new -> choosing_character -> playing -> ended
+        self.status = "new"
+        self.no_of_steps = no_of_steps
+        self.turn = 0
+        self.characters = []
+        self.character = None
+        self.fragments = []
+        self.description = ""
+        self.actions = []
+        self.transcript = []
+        self.ingest_stats = None
+
+    def to_dict(self) -> dict:
+        """The state as a JSON serializable dict
+
+        Returns:
+            dict: the state
+        """
+        return copy.deepcopy({field: getattr(self, field) for field in self.fields})
+
+    @classmethod
+    def from_dict(cls, data:dict):
+        """Restore a state saved with to_dict
+
+        Args:
+            data (dict): the saved state
+
+        Returns:
+            GameState: the state
+        """
+        state = cls()
+        for field in cls.fields:
+            if field in data:
+                setattr(state, field, copy.deepcopy(data[field]))
+        return state
+
+
+class TurnError(RuntimeError):
+    """The llm returned a turn that can not be played (empty, or without actions); the state is unchanged,
+    the turn can be played again"""
+
+
+def load_characters(the_story:str) -> list:
+    with rag_utils.pooled_connection() as connection:
+        return rag_utils.get_story_characters(connection.cursor(), connection, the_story)
+
+
+_story_locks = {}
+_story_locks_lock = threading.Lock()
+
+def _story_lock(story_id:str):
+    with _story_locks_lock:
+        return _story_locks.setdefault(story_id, threading.Lock())
+
+
+class GameEngine:
+    """The game without a UI. start, choose_character and advance are coroutines working on a GameState:
+    the llm calls are streamed asynchronously and the blocking rag_utils calls run in worker threads,
+    so one event loop can serve many sessions at once. The *_stream variants yield the TurnStreamParser
+    while the turn is generated; iterate them from a single task."""
+
+    def __init__(self, story_id:str = "story.txt",
+                 backend = None,
+                 no_of_steps:int = 10,
+                 prefetcher = None,
+                 load_story = rag_utils.get_story_from_blob,
+                 load_characters = load_characters):
+        self.story_id = story_id
+        self.backend = backend or rag_utils.get_retrieval_backend()
+        self.no_of_steps = no_of_steps
+        self.prefetcher = prefetcher or rag_utils.action_prefetcher
+        self.load_story = load_story
+        self.load_characters = load_characters
+
+    @staticmethod
+    def _expect(state:GameState, status:str):
+        if state.status != status:
+            raise ValueError(f"The game is {state.status}, expected {status}")
+
+    def _ensure_story(self, the_story:str, characters) -> dict:
+        # embed the story once, even when many sessions start on it at the same time
+        with _story_lock(self.story_id):
+            if self.backend.has_story(self.story_id, rag_utils.content_hash(the_story)):
+                return None
+            character_names = [character["character_name"] for character in characters]
+            return self.backend.ingest(the_story, self.story_id, character_names=character_names)
+
+    @staticmethod
+    def _turn_result(parser, last_step:bool = False) -> dict:
+        # an empty or truncated turn must not leave the state half updated, nor a game without actions to play
+        if parser is None or not parser.buffer.strip():
+            raise TurnError("The llm returned an empty turn, try again")
+        result = rag_utils.advancing(parser.buffer)
+        if not last_step and not result["actions"]:
+            raise TurnError("The llm returned a turn without actions, try again")
+        return result
+
+    def _finish_turn(self, state:GameState, result:dict):
+        state.description = result.get("description") or ""
+        state.actions = result.get("actions") or []
+        state.transcript.append({"role": "assistant", "content": state.description, "actions": list(state.actions)})
+        state.turn += 1
+        if state.status == "playing" and state.actions:
+            # retrieval for the offered actions starts while the player is still choosing
+            self.prefetcher.prefetch(state.session_id, state.actions, self.backend, self.story_id,
+                                     choosen_character=state.character, exact_fragments=state.fragments,
+                                     no_of_steps=state.no_of_steps)
+
+    async def start(self, session_id:str = None, no_of_steps:int = None) -> GameState:
+        """Start a game: load the story and its characters
+
+        Args:
+            session_id (str, optional): id of the session. Defaults to a new uuid.
+            no_of_steps (int, optional): number of steps until the game ends. Defaults to the engine's.
+
+        Returns:
+            GameState: the state, choosing_character
+        """
+        state = GameState(session_id, self.story_id, no_of_steps or self.no_of_steps)
+        with rag_utils.metrics.turn(state.session_id, state.turn):
+            the_story = await asyncio.to_thread(self.load_story, self.story_id)
+            state.characters = await asyncio.to_thread(self.load_characters, the_story)
+        state.status = "choosing_character"
+        return state
+
+    async def choose_character_stream(self, state:GameState, name:str):
+        """Choose the character and stream the opening turn
+
+        Args:
+            state (GameState): the state, choosing_character
+            name (str): name of the character, any case
+
+        Raises:
+            ValueError: if the character is not in the story or the game is not choosing a character
+            TurnError: if the opening turn can not be played, the state is unchanged
+
+        Yields:
+            TurnStreamParser: the opening turn so far
+        """
+        self._expect(state, "choosing_character")
+        character = rag_utils.choosen_character_user(state.characters, name)
+        if character is None:
+            raise ValueError(f"{name} is not a character of the story")
+        with rag_utils.metrics.turn(state.session_id, state.turn):
+            the_story = await asyncio.to_thread(self.load_story, self.story_id)
+            state.story_hash = rag_utils.content_hash(the_story)
+            state.ingest_stats = await asyncio.to_thread(self._ensure_story, the_story, state.characters)
+            # the character does not change during the session, keep its fragments
+            fragments = await asyncio.to_thread(self.backend.get_exact_match, character, self.story_id)
+            parser = None
+            async for parser in rag_utils.character_start_chain_memory_astream(character, fragments, state.session_id,
+                                                                               story_hash=state.story_hash):
+                yield parser
+            result = self._turn_result(parser)
+            # the state only changes once the turn succeeded, a failed one can be played again
+            state.fragments = fragments
+            state.character = character
+            state.transcript.append({"role": "user", "content": character})
+            state.status = "playing"
+            self._finish_turn(state, result)
+
+    async def advance_stream(self, state:GameState, action):
+        """Play an action and stream the advancement
+
+        Args:
+            state (GameState): the state, playing
+            action (_type_): number of the action (from 1) or its text
+
+        Raises:
+            ValueError: if the action is not one of the offered ones or the game is not playing
+            TurnError: if the advancement can not be played, the state is unchanged
+
+        Yields:
+            TurnStreamParser: the advancement so far
+        """
+        self._expect(state, "playing")
+        if isinstance(action, int):
+            if not 1 <= action <= len(state.actions):
+                raise ValueError(f"Choose an action between 1 and {len(state.actions)}")
+            action = state.actions[action - 1]
+        elif action not in state.actions:
+            raise ValueError(f"{action} is not one of the offered actions")
+        with rag_utils.metrics.turn(state.session_id, state.turn):
+            # a pre-generated advancement needs no retrieval, the context is only retrieved without one
+            speculative_content = await asyncio.to_thread(self.prefetcher.continuation, state.session_id, action)
+            if speculative_content is not None:
+                await asyncio.to_thread(rag_utils.commit_advancement, state.session_id, action, speculative_content)
+                parser = rag_utils.TurnStreamParser().feed(speculative_content)
+                yield parser
+            else:
+                turn_context = await asyncio.to_thread(rag_utils.retrieve_turn_context, self.backend, state.character, action,
+                                                       self.story_id, session_id=state.session_id,
+                                                       exact_fragments=state.fragments, prefetcher=self.prefetcher)
+                parser = None
+                async for parser in rag_utils.character_advancement_chain_memory_astream(state.character, turn_context["fragments"],
+                                                                                         state.session_id, state.no_of_steps, action,
+                                                                                         story_hash=state.story_hash):
+                    yield parser
+            result = self._turn_result(parser, last_step=state.no_of_steps <= 0)
+            state.transcript.append({"role": "user", "content": action})
+            if state.no_of_steps > 0:
+                state.no_of_steps -= 1
+            else:
+                state.status = "ended"
+            self._finish_turn(state, result)
+
+    async def choose_character(self, state:GameState, name:str) -> GameState:
+        """Choose the character and generate the opening turn, see choose_character_stream
+
+        Returns:
+            GameState: the state, playing
+        """
+        async for _ in self.choose_character_stream(state, name):
+            pass
+        return state
+
+    async def advance(self, state:GameState, action) -> GameState:
+        """Play an action and generate the advancement, see advance_stream
+
+        Returns:
+            GameState: the state, playing or ended
+        """
+        async for _ in self.advance_stream(state, action):
+            pass
+        return state
+
+
+# for synchronous clients (Streamlit): one event loop in a background thread, shared by all their sessions
+@lru_cache(maxsize=None)
+def get_event_loop():
+    """Get the background event loop, started on first use
+
+    Returns:
+        _type_: the event loop
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="game-engine-loop", daemon=True).start()
+    return loop
+
+def run_sync(coroutine):
+    """Run a coroutine on the background event loop and wait for its result
+
+    Args:
+        coroutine (_type_): the coroutine
+
+    Returns:
+        _type_: its result
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+def iterate_sync(async_iterable):
+    """Iterate an async iterable (e.g. advance_stream) from synchronous code, on the background event loop
+
+    Args:
+        async_iterable (_type_): the async iterable
+
+    Yields:
+        _type_: its items
+    """
+    items = queue.Queue()
+    done = object()
+
+    async def consume():
+        try:
+            async for item in async_iterable:
+                items.put(item)
+        finally:
+            items.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(consume(), get_event_loop())
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        yield item
+    future.result()
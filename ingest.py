@@ -0,0 +1,138 @@
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import rag_utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed stories from the blob storage and load them into PostgreSQL. "
+                                                 "Progress is checkpointed per batch: run it again to resume after a failure")
+    parser.add_argument("--blob", nargs="+", default=["story.txt"], help="names of the story blobs")
+    parser.add_argument("--all", action="store_true", help="ingest every blob of the container (see --prefix)")
+    parser.add_argument("--prefix", default=None, help="with --all, only the blobs whose name starts with it")
+    parser.add_argument("--story-id", default=None, help="id of the story in the table, with a single blob (default: the blob name)")
+    parser.add_argument("--rebuild", action="store_true", help="delete the stored stories and embed them from scratch")
+    parser.add_argument("--table", default="story_embeddings", help="name of the embeddings table")
+    parser.add_argument("--workers", type=int, default=3, help="stories ingested in parallel")
+    parser.add_argument("--embed-workers", type=int, default=2, help="embedding requests in flight per story")
+    parser.add_argument("--retries", type=int, default=3, help="attempts per story, resuming from the last checkpoint")
+    parser.add_argument("--batch-size", type=int, default=256, help="maximum number of paragraphs per embedding request")
+    parser.add_argument("--batch-tokens", type=int, default=100000, help="maximum estimated tokens per embedding request")
+    parser.add_argument("--chunk-tokens", type=int, default=rag_utils.CHUNK_TARGET_TOKENS, help="estimated tokens per story chunk")
+    parser.add_argument("--chunk-overlap", type=int, default=rag_utils.CHUNK_OVERLAP_TOKENS, help="estimated tokens of overlap between chunks")
+    parser.add_argument("--index-type", default=rag_utils.VECTOR_INDEX_TYPE, choices=["hnsw", "ivfflat"], help="ANN index built after the load")
+    parser.add_argument("--hnsw-m", type=int, default=16, help="hnsw max connections per layer")
+    parser.add_argument("--hnsw-ef-construction", type=int, default=64, help="hnsw candidate list size at build time")
+    parser.add_argument("--ivfflat-lists", type=int, default=None, help="ivfflat number of lists (default rows / 1000)")
+    parser.add_argument("--binary-index", action="store_true", default=rag_utils.BINARY_RERANK_FACTOR > 0,
+                        help="also build the binary quantization index (default on when BINARY_RERANK_FACTOR > 0)")
+    parser.add_argument("--evaluate", action="store_true", help="print recall vs latency of the index against the exact scan")
+    parser.add_argument("--compaction-report", action="store_true",
+                        help="print the size, recall and latency of shorter, half precision and binary embeddings against the stored ones")
+    args = parser.parse_args()
+
+    blobs = rag_utils.list_blobs(args.prefix) if args.all else args.blob
+    if args.story_id and len(blobs) != 1:
+        parser.error("--story-id needs a single blob")
+    if args.retries < 1:
+        parser.error("--retries needs at least one attempt")
+    # every story holds a connection while each of its embedding workers may check one out for the embedding cache
+    connections = args.workers * (1 + args.embed_workers)
+    if connections > rag_utils.POSTGRES_POOL_MAX_SIZE:
+        parser.error(f"--workers {args.workers} with --embed-workers {args.embed_workers} can use {connections} "
+                     f"connections, more than POSTGRES_POOL_MAX_SIZE={rag_utils.POSTGRES_POOL_MAX_SIZE}")
+
+    rag_utils.embedding_cache.store = rag_utils.PostgresEmbeddingStore()
+    with rag_utils.pooled_connection() as connection:
+        rag_utils.create_table(connection.cursor(), connection, args.table)
+
+    failed = ingest_all(blobs, args)
+
+    with rag_utils.pooled_connection() as connection:
+        finish(connection, args)
+    sys.exit(1 if failed else 0)
+
+
+def ingest_all(blobs, args) -> list:
+    # the work is network bound (blob downloads, embedding requests, inserts), threads are enough
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="ingest") as executor:
+        futures = {executor.submit(ingest_with_retries, blob_name, args): blob_name for blob_name in blobs}
+        for future in as_completed(futures):
+            blob_name = futures[future]
+            try:
+                ingest_stats = future.result()
+            except Exception as e:
+                failed.append(blob_name)
+                print(f"{blob_name}: failed ({e}), run again to resume")
+                continue
+            print(f"{blob_name}: ingested {ingest_stats['rows']} paragraphs ({ingest_stats['reused']} reused, "
+                  f"{ingest_stats['deleted']} deleted) in {ingest_stats['seconds']:.2f}s "
+                  f"({ingest_stats['rows_per_sec']:.1f} rows/sec)")
+    print(f"{len(blobs) - len(failed)} of {len(blobs)} stories ready")
+    return failed
+
+
+def ingest_with_retries(blob_name:str, args) -> dict:
+    attempts = max(1, args.retries)
+    for attempt in range(1, attempts + 1):
+        try:
+            return ingest(blob_name, args, rebuild=args.rebuild and attempt == 1)
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            print(f"{blob_name}: attempt {attempt} failed ({e}), resuming")
+            time.sleep(2 ** attempt)
+
+
+def ingest(blob_name:str, args, rebuild:bool = False) -> dict:
+    story_id = args.story_id or blob_name
+    story_path = rag_utils.get_story_path_from_blob(blob_name)
+    with rag_utils.pooled_connection() as connection:
+        cursor = connection.cursor()
+        # the lock is held from the delete to the end, another process ingesting the story waits for it
+        with rag_utils.story_lock(cursor, connection, args.table, story_id), \
+             open(story_path, encoding="utf-8") as the_story:
+            if rebuild:
+                rag_utils.delete_story(cursor, connection, args.table, story_id)
+            # the story is chunked line by line from the cached file, never read whole;
+            # every embedded batch is committed, the story is marked ready only when it is complete
+            return rag_utils.ingest_story(cursor, connection, args.table, the_story, story_id,
+                                          max_batch_size=args.batch_size,
+                                          max_batch_tokens=args.batch_tokens,
+                                          target_tokens=args.chunk_tokens,
+                                          overlap_tokens=args.chunk_overlap,
+                                          checkpoint=True,
+                                          embed_workers=args.embed_workers)
+
+
+def finish(connection, args):
+    cursor = connection.cursor()
+    cache_stats = rag_utils.embedding_cache.stats()
+    print(f"Embedding cache: {cache_stats['hit_rate']:.1%} hit rate "
+          f"({cache_stats['memory_hits']} memory, {cache_stats['store_hits']} store, {cache_stats['misses']} misses)")
+    rag_utils.create_vector_index(cursor, connection, args.table, args.index_type,
+                                  m=args.hnsw_m, ef_construction=args.hnsw_ef_construction,
+                                  lists=args.ivfflat_lists, rebuild=args.rebuild, binary=args.binary_index)
+    if args.evaluate:
+        rerank_factors = (2, 4, 10) if args.binary_index else ()
+        for row in rag_utils.evaluate_vector_index(cursor, args.table, rerank_factors=rerank_factors):
+            print(f"{row['setting']:>16}  recall@5={row['recall']:.3f}  latency={row['latency_ms']:.2f}ms")
+    if args.compaction_report:
+        compaction_report(cursor, args)
+
+
+def compaction_report(cursor, args):
+    for name, size in rag_utils.embedding_storage_sizes(cursor, args.table).items():
+        print(f"{name}: {size / 1e6:.1f} MB")
+    embeddings = rag_utils.load_embeddings(cursor, args.table)
+    print(f"{len(embeddings)} stored embeddings ({rag_utils.embedding_column_type(cursor, args.table)}), "
+          f"references: their exact top 5")
+    for row in rag_utils.compaction_report(embeddings):
+        print(f"{row['representation']:>18} {row['dimensions']:>5}d  {row['bytes_per_vector']:>6} B/vector  "
+              f"{row['total_mb']:>8.1f} MB  recall@5={row['recall']:.3f}  latency={row['latency_ms']:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,42 @@
-from openai import OpenAI
+from openai import OpenAI, RateLimitError, APIConnectionError, InternalServerError
 import psycopg2
+import psycopg2.pool
+from psycopg2.extras import execute_values
 from pgvector.psycopg2 import register_vector
 import os
 import json
+import ast
+import re
+import random
+import io
+import time
+import hashlib
+import sqlite3
+import threading
+import asyncio
+import atexit
+import heapq
+import itertools
+import contextvars
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import lru_cache
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
 import textwrap
 import numpy as np
 import uuid
+import shutil
+import tempfile
+from types import SimpleNamespace
+from urllib.parse import urlparse
 
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 from azure.storage.blob import BlobServiceClient
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
 
 from langchain_openai import ChatOpenAI
 from langchain_community.graphs import Neo4jGraph
@@ -17,6 +44,9 @@ from langchain.prompts import PromptTemplate
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_community.chat_message_histories import Neo4jChatMessageHistory
 from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.callbacks import BaseCallbackHandler
 
 # constants
 KEY_VAULT_URL = os.environ.get("KEY_VAULT_URL")
@@ -27,63 +57,621 @@ POSTGRESQL_HOST = os.environ.get("POSTGRESQL_HOST")
 POSTGRESQL_DATABASE = os.environ.get("POSTGRESQL_DATABASE")
 NEO4J_URL = os.environ.get("NEO4J_URL")
 NEO4J_USERNAME = os.environ.get("NEO4J_USERNAME")
+# below the model's native size, the model shortens the embeddings itself (changing it needs a re-ingestion)
+EMBEDDING_DIMENSIONS = int(os.environ.get("EMBEDDING_DIMENSIONS", 1536))
+NATIVE_EMBEDDING_DIMENSIONS = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072, "text-embedding-ada-002": 1536}
+# pgvector column type of the stored embeddings: "vector" (float32) or "halfvec" (float16, half the size)
+EMBEDDING_STORAGE = os.environ.get("EMBEDDING_STORAGE", "vector")
+# > 0: similarity search ranks k * factor candidates on the binary-quantized embeddings first (bit index),
+# then re-ranks them with the stored embeddings
+BINARY_RERANK_FACTOR = int(os.environ.get("BINARY_RERANK_FACTOR", 0))
+VECTOR_INDEX_TYPE = os.environ.get("VECTOR_INDEX_TYPE", "hnsw")
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 40))
+IVFFLAT_PROBES = int(os.environ.get("IVFFLAT_PROBES", 10))
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+CHARACTER_EXTRACTION_CHUNK_TOKENS = int(os.environ.get("CHARACTER_EXTRACTION_CHUNK_TOKENS", 6000))
+CHARACTER_EXTRACTION_CONCURRENCY = int(os.environ.get("CHARACTER_EXTRACTION_CONCURRENCY", 8))
+POSTGRES_POOL_MIN_SIZE = int(os.environ.get("POSTGRES_POOL_MIN_SIZE", 1))
+POSTGRES_POOL_MAX_SIZE = int(os.environ.get("POSTGRES_POOL_MAX_SIZE", 10))
+POSTGRES_POOL_TIMEOUT = float(os.environ.get("POSTGRES_POOL_TIMEOUT", 10))
+POSTGRES_HEALTH_CHECK_SECONDS = float(os.environ.get("POSTGRES_HEALTH_CHECK_SECONDS", 30))
+STORY_CACHE_DIR = os.environ.get("STORY_CACHE_DIR", ".story_cache")
+RETRIEVAL_WORKERS = int(os.environ.get("RETRIEVAL_WORKERS", 16))
+# speculative retrieval and pre-generation have their own workers, the turns being played never wait behind them
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", 4))
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", 1000))
+# sessions unused for longer are written to Neo4j and dropped from memory
+HISTORY_IDLE_SECONDS = float(os.environ.get("HISTORY_IDLE_SECONDS", 1800))
+# get_memory looks for idle sessions at most this often
+HISTORY_SWEEP_SECONDS = float(os.environ.get("HISTORY_SWEEP_SECONDS", 60))
+HISTORY_RECENT_TURNS = int(os.environ.get("HISTORY_RECENT_TURNS", 4))
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 1500))
+HISTORY_WRITE_BATCH = int(os.environ.get("HISTORY_WRITE_BATCH", 4))
+CHUNK_TARGET_TOKENS = int(os.environ.get("CHUNK_TARGET_TOKENS", 256))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", 32))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 2000))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 86400))
+# number of cached variants served per opening or branch, 1 = always the same response
+RESPONSE_CACHE_VARIETY = int(os.environ.get("RESPONSE_CACHE_VARIETY", 3))
+HYBRID_TOKEN_BUDGET = int(os.environ.get("HYBRID_TOKEN_BUDGET", 2000))
+RRF_K = int(os.environ.get("RRF_K", 60))
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "pgvector")
+NUMPY_BACKEND_DIR = os.environ.get("NUMPY_BACKEND_DIR", ".vector_store")
+PREFETCH_SPECULATIVE_ACTIONS = int(os.environ.get("PREFETCH_SPECULATIVE_ACTIONS", 0))
+PREFETCH_LLM_BUDGET_PER_MINUTE = int(os.environ.get("PREFETCH_LLM_BUDGET_PER_MINUTE", 20))
+# a turn waits at most this long for a running prefetch, then retrieves (or generates) on its own
+PREFETCH_TIMEOUT_SECONDS = float(os.environ.get("PREFETCH_TIMEOUT_SECONDS", 10))
+SECRET_TTL_SECONDS = int(os.environ.get("SECRET_TTL_SECONDS", 3600))
+LLM_MAX_TOKENS = int(os.environ.get("LLM_MAX_TOKENS", 500))
+CHAIN_CACHE_SIZE = int(os.environ.get("CHAIN_CACHE_SIZE", 32))
+# OpenAI rate limits of the account (tier 1 gpt-4o-mini and text-embedding-3-small), 0 = unlimited
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", 500))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", 200000))
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.environ.get("EMBEDDING_REQUESTS_PER_MINUTE", 3000))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.environ.get("EMBEDDING_TOKENS_PER_MINUTE", 1000000))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 5))
+# embedding requests of fewer texts are coalesced across sessions, flushed when full or after the wait
+EMBEDDING_MICROBATCH_SIZE = int(os.environ.get("EMBEDDING_MICROBATCH_SIZE", 64))
+EMBEDDING_MICROBATCH_WAIT_MS = float(os.environ.get("EMBEDDING_MICROBATCH_WAIT_MS", 10))
+STRUCTURED_OUTPUT = os.environ.get("STRUCTURED_OUTPUT", "true").lower() in ("1", "true", "yes")
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+METRICS_JSONL_PATH = os.environ.get("METRICS_JSONL_PATH")
+# USD per 1000 tokens, gpt-4o-mini and text-embedding-3-small list prices
+LLM_PROMPT_PRICE_PER_1K = float(os.environ.get("LLM_PROMPT_PRICE_PER_1K", 0.00015))
+LLM_COMPLETION_PRICE_PER_1K = float(os.environ.get("LLM_COMPLETION_PRICE_PER_1K", 0.0006))
+EMBEDDING_PRICE_PER_1K = float(os.environ.get("EMBEDDING_PRICE_PER_1K", 0.00002))
+# fetched together, in parallel, the first time any of them is needed
+APP_SECRET_NAMES = ["NEO4J-PASSWORD", "POSTGRESQL-PASSWORD", "OPENAI-API-KEY"]
+
+# instrumentation
+# the (session_id, turn) the current stages belong to, copied into the worker threads by submit_in_context
+_metrics_context = contextvars.ContextVar("metrics_context", default=(None, None))
+
+def submit_in_context(executor, fun, *args, **kwargs):
+    """Submit to an executor with the caller's context variables, so the stages keep their session and turn"""
+    return executor.submit(contextvars.copy_context().run, fun, *args, **kwargs)
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_tokens(self, prompt_tokens:int = 0, completion_tokens:int = 0, cost:float = 0.0):
+        pass
+
+_null_span = _NullSpan()
+
+class _Span:
+    def __init__(self, metrics, stage:str):
+        self.metrics = metrics
+        self.stage = stage
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.stage, time.perf_counter() - self.start, 
+                            self.prompt_tokens, self.completion_tokens, self.cost)
+        return False
+
+    def add_tokens(self, prompt_tokens:int = 0, completion_tokens:int = 0, cost:float = 0.0):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cost += cost
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Records the duration, time to first token, token usage and cost of every llm call it is attached to.
+    The stage is taken from the "stage" metadata of the call."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.runs = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata = None, **kwargs):
+        prompt_tokens = sum(estimate_tokens(str(message.content)) for batch in messages for message in batch)
+        self.runs[run_id] = [time.perf_counter(), (metadata or {}).get("stage", "llm"), prompt_tokens, 
+                             _metrics_context.get(), False]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self.runs.get(run_id)
+        if run is not None and not run[4]:
+            run[4] = True
+            self.metrics.record(f"{run[1]}_first_token", time.perf_counter() - run[0], context=run[3])
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self.runs.pop(run_id, None)
+        if run is None:
+            return
+        start, stage, prompt_tokens, context, _ = run
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens") or prompt_tokens
+        completion_tokens = usage.get("completion_tokens")
+        for generations in response.generations:
+            for generation in generations:
+                usage_metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                if usage_metadata.get("input_tokens"):
+                    prompt_tokens = usage_metadata["input_tokens"]
+                if completion_tokens is None:
+                    completion_tokens = usage_metadata.get("output_tokens") or estimate_tokens(generation.text)
+        completion_tokens = completion_tokens or 0
+        cost = prompt_tokens / 1000 * LLM_PROMPT_PRICE_PER_1K + completion_tokens / 1000 * LLM_COMPLETION_PRICE_PER_1K
+        self.metrics.record(stage, time.perf_counter() - start, prompt_tokens, completion_tokens, cost, context=context)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.runs.pop(run_id, None)
+
+class Metrics:
+    """Per-stage durations, tokens and estimated cost, aggregated per stage and per session and turn, and event
+    counters (parse repairs, llm retries). Disabled, span() returns a shared no-op and no stage is recorded,
+    the counters are always kept."""
+
+    def __init__(self, enabled:bool = METRICS_ENABLED, 
+                 jsonl_path:str = METRICS_JSONL_PATH, 
+                 max_sessions:int = 1000, 
+                 max_events:int = 1000):
+        self.enabled = enabled
+        self.jsonl_path = jsonl_path
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        # the events to append to the JSONL file, written outside self.lock by one thread at a time
+        self.write_lock = threading.Lock()
+        self.pending_lines = []
+        self.stages = {}
+        self.counters = {}
+        self.sessions = OrderedDict()
+        self.events = deque(maxlen=max_events)
+        self.callback = MetricsCallbackHandler(self)
+
+    def span(self, stage:str):
+        """Time a block of code as a stage, use add_tokens on the span to attach tokens and cost
+
+        Args:
+            stage (str): name of the stage
+
+        Returns:
+            _type_: context manager
+        """
+        return _Span(self, stage) if self.enabled else _null_span
+
+    @contextmanager
+    def turn(self, session_id, turn:int):
+        """Attribute the stages recorded in the with block (and in the work it submits with submit_in_context)
+        to a session and turn
+
+        Args:
+            session_id (_type_): id of the session
+            turn (int): number of the turn
+        """
+        token = _metrics_context.set((session_id, turn))
+        try:
+            yield
+        finally:
+            _metrics_context.reset(token)
+
+    def llm_config(self, stage:str, **config) -> dict:
+        """Config for an llm call, with the stage as metadata and the metrics callback when enabled
+
+        Args:
+            stage (str): name of the stage
+
+        Returns:
+            dict: the runnable config
+        """
+        if self.enabled:
+            config["metadata"] = {**config.get("metadata", {}), "stage": stage}
+            config["callbacks"] = [self.callback]
+        return config
+
+    def record(self, stage:str, seconds:float, 
+               prompt_tokens:int = 0, 
+               completion_tokens:int = 0, 
+               cost:float = 0.0, 
+               context = None):
+        """Record one run of a stage
+
+        Args:
+            stage (str): name of the stage
+            seconds (float): duration
+            prompt_tokens (int, optional): prompt (or embedded) tokens. Defaults to 0.
+            completion_tokens (int, optional): completion tokens. Defaults to 0.
+            cost (float, optional): estimated cost in USD. Defaults to 0.0.
+            context (_type_, optional): (session_id, turn). Defaults to the current one.
+        """
+        if not self.enabled:
+            return
+        session_id, turn = context or _metrics_context.get()
+        event = {"ts": time.time(), "session_id": session_id, "turn": turn, "stage": stage, "seconds": seconds, 
+                 "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cost": cost}
+        line = json.dumps(event) if self.jsonl_path else None
+        with self.lock:
+            for aggregates in self._aggregates(stage, session_id, turn):
+                aggregates["count"] += 1
+                aggregates["seconds"] += seconds
+                aggregates["max_seconds"] = max(aggregates["max_seconds"], seconds)
+                aggregates["prompt_tokens"] += prompt_tokens
+                aggregates["completion_tokens"] += completion_tokens
+                aggregates["cost"] += cost
+            self.events.append(event)
+            if self.jsonl_path:
+                self.pending_lines.append(line)
+        if self.jsonl_path:
+            # a thread already writing takes this event along
+            self.flush(blocking=False)
+
+    def flush(self, blocking:bool = True):
+        """Append the buffered events to the JSONL file
+
+        Args:
+            blocking (bool, optional): wait for a running write, else leave the events to it. Defaults to True.
+        """
+        if not self.write_lock.acquire(blocking):
+            return
+        try:
+            while True:
+                with self.lock:
+                    lines, self.pending_lines = self.pending_lines, []
+                if not lines:
+                    return
+                with open(self.jsonl_path, "a") as f:
+                    f.write("".join(line + "\n" for line in lines))
+        finally:
+            self.write_lock.release()
+
+    def count(self, name:str, value:int = 1):
+        """Increment an event counter
+
+        Args:
+            name (str): name of the counter
+            value (int, optional): increment. Defaults to 1.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def counter_stats(self) -> dict:
+        """The event counters
+
+        Returns:
+            dict: name -> count
+        """
+        with self.lock:
+            return dict(self.counters)
+
+    def _aggregates(self, stage, session_id, turn):
+        new = lambda: {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+        yield self.stages.setdefault(stage, new())
+        if session_id is None:
+            return
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = {"totals": new(), "turns": {}}
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(session_id)
+        yield session["totals"]
+        yield session["turns"].setdefault(turn, {}).setdefault(stage, new())
+
+    def stage_stats(self) -> dict:
+        """Aggregates per stage, over all sessions
+
+        Returns:
+            dict: stage -> count, seconds, max_seconds, prompt_tokens, completion_tokens, cost
+        """
+        with self.lock:
+            return {stage: dict(aggregates) for stage, aggregates in self.stages.items()}
+
+    def session_stats(self, session_id) -> dict:
+        """Totals and per-turn, per-stage aggregates of a session
+
+        Args:
+            session_id (_type_): id of the session
+
+        Returns:
+            dict: "totals" and "turns" (turn -> stage -> aggregates), empty if nothing was recorded
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return {}
+            return {"totals": dict(session["totals"]), 
+                    "turns": {turn: {stage: dict(aggregates) for stage, aggregates in stages.items()} 
+                              for turn, stages in session["turns"].items()}}
+
+    def jsonl(self) -> str:
+        """The recent events as JSON lines
+
+        Returns:
+            str: one JSON object per line
+        """
+        with self.lock:
+            return "".join(json.dumps(event) + "\n" for event in self.events)
+
+    def prometheus(self, prefix:str = "storyweave") -> str:
+        """The per-stage aggregates in the Prometheus text exposition format
+
+        Args:
+            prefix (str, optional): prefix of the metric names. Defaults to "storyweave".
+
+        Returns:
+            str: the metrics
+        """
+        stages = self.stage_stats()
+        lines = [f"# HELP {prefix}_stage_seconds Duration of the stages.", f"# TYPE {prefix}_stage_seconds summary"]
+        for stage, aggregates in stages.items():
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {aggregates["count"]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {aggregates["seconds"]}')
+        lines += [f"# HELP {prefix}_tokens_total Tokens used by the stages.", f"# TYPE {prefix}_tokens_total counter"]
+        for stage, aggregates in stages.items():
+            lines.append(f'{prefix}_tokens_total{{stage="{stage}",kind="prompt"}} {aggregates["prompt_tokens"]}')
+            lines.append(f'{prefix}_tokens_total{{stage="{stage}",kind="completion"}} {aggregates["completion_tokens"]}')
+        lines += [f"# HELP {prefix}_cost_usd_total Estimated cost of the stages.", f"# TYPE {prefix}_cost_usd_total counter"]
+        for stage, aggregates in stages.items():
+            lines.append(f'{prefix}_cost_usd_total{{stage="{stage}"}} {aggregates["cost"]}')
+        lines += [f"# HELP {prefix}_events_total Parse repairs, llm retries and other events.", f"# TYPE {prefix}_events_total counter"]
+        for name, value in self.counter_stats().items():
+            lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+atexit.register(metrics.flush)
 
 # secrets retrieval
-credential = DefaultAzureCredential()
+# nothing here runs at import time: credential, secrets and clients are created on first use
+_secrets_cache = {}
+_secrets_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def get_credential():
+    """Get the Azure credential, created once
+
+    Returns:
+        _type_: the credential to access the key vault and the blob storage
+    """
+    return DefaultAzureCredential()
+
+@lru_cache(maxsize=None)
+def get_secret_client(vault_url:str = KEY_VAULT_URL):
+    """Get the Key Vault client, created once per vault
+
+    Args:
+        vault_url (str, optional): the url of the key vault. Defaults to KEY_VAULT_URL.
+
+    Returns:
+        _type_: the secret client
+    """
+    return SecretClient(vault_url=vault_url, credential=get_credential())
+
+def get_secrets(secret_names, ttl:int = SECRET_TTL_SECONDS) -> dict:
+    """Get secrets from Azure Key Vault, fetching the missing or expired ones in one parallel batch.
+    get_client, get_llm, get_graph and get_pool look their secret up on every call and rebuild the client
+    when it changed, so a rotated secret is used within ttl seconds.
+
+    Args:
+        secret_names (_type_): the names of the secrets
+        ttl (int, optional): seconds a fetched secret stays cached. Defaults to SECRET_TTL_SECONDS.
+
+    Returns:
+        dict: secret name -> value
+    """
+    with _secrets_lock:
+        now = time.monotonic()
+        missing = [name for name in dict.fromkeys(secret_names) 
+                   if name not in _secrets_cache or now - _secrets_cache[name][1] > ttl]
+        if missing:
+            secret_client = get_secret_client()
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                values = list(executor.map(lambda name: secret_client.get_secret(name).value, missing))
+            fetched_at = time.monotonic()
+            for name, value in zip(missing, values):
+                _secrets_cache[name] = (value, fetched_at)
+        return {name: _secrets_cache[name][0] for name in secret_names}
 
-def get_secret(secret_name:str, credential)-> str:
-    """Get secret from Azure Key Vault
+def get_secret(secret_name:str, credential = None)-> str:
+    """Get secret from Azure Key Vault (cached, see get_secrets)
 
     Args:
         secret_name (str): the name of the secret
-        credential (_type_): the credential to access the key vault
+        credential (_type_, optional): kept for compatibility, the shared credential is used. Defaults to None.
 
     Returns:
         str: the value of the secret
     """
-    secret_client = SecretClient(vault_url=KEY_VAULT_URL, credential=credential)
-    retrieved_secret = secret_client.get_secret(secret_name)
-    return retrieved_secret.value
+    names = APP_SECRET_NAMES if secret_name in APP_SECRET_NAMES else APP_SECRET_NAMES + [secret_name]
+    return get_secrets(names)[secret_name]
 ##################
 
 # story utils
+class FileBlobClient:
+    """Filesystem stand-in for an Azure blob client (account_url "file:///some/dir"),
+    with the same etag / conditional download behaviour"""
+
+    def __init__(self, path:str):
+        self.path = path
+
+    def download_blob(self, etag:str = None, match_condition = None):
+        stat = os.stat(self.path)
+        current_etag = f'"{stat.st_mtime_ns}-{stat.st_size}"'
+        if match_condition == MatchConditions.IfModified and etag == current_etag:
+            raise ResourceNotModifiedError("The condition specified using HTTP conditional header(s) is not met.")
+        properties = SimpleNamespace(etag=current_etag, last_modified=time.ctime(stat.st_mtime))
+        path = self.path
+
+        class Downloader:
+            def __init__(self):
+                self.properties = properties
+
+            def readinto(self, stream):
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, stream)
+
+        return Downloader()
+
+@lru_cache(maxsize=None)
+def get_blob_service_client(account_url:str = AZURE_STORAGE_BLOB_URL, credential = None):
+    """Get the blob service client, created once per account
+
+    Args:
+        account_url (str, optional): the url of the account. Defaults to AZURE_STORAGE_BLOB_URL.
+        credential (_type_, optional): the credential to access the blob storage. Defaults to get_credential().
+
+    Returns:
+        _type_: the blob service client
+    """
+    return BlobServiceClient(account_url, credential=credential or get_credential())
+
+def get_blob_client(blob_name:str, 
+                    account_url:str = AZURE_STORAGE_BLOB_URL, 
+                    credential = None, 
+                    container_name:str = AZURE_STORAGE_CONTAINER_NAME):
+    """Get the client of a blob, or a FileBlobClient for "file://" account urls
+
+    Args:
+        blob_name (str): the name of the blob
+        account_url (str, optional): the url of the account. Defaults to AZURE_STORAGE_BLOB_URL.
+        credential (_type_, optional): the credential to access the blob storage. Defaults to get_credential().
+        container_name (str, optional): the name of the container. Defaults to AZURE_STORAGE_CONTAINER_NAME.
+
+    Returns:
+        _type_: the blob client
+    """
+    if account_url.startswith("file://"):
+        return FileBlobClient(os.path.join(urlparse(account_url).path, container_name, blob_name))
+    container_client = get_blob_service_client(account_url, credential).get_container_client(container_name)
+    return container_client.get_blob_client(blob_name)
+
+def list_blobs(prefix:str = None, 
+               account_url:str = AZURE_STORAGE_BLOB_URL, 
+               credential = None, 
+               container_name:str = AZURE_STORAGE_CONTAINER_NAME) -> list:
+    """List the blobs of the container, or the files of the directory for "file://" account urls
+
+    Args:
+        prefix (str, optional): only the blobs whose name starts with it. Defaults to None.
+        account_url (str, optional): the url of the account. Defaults to AZURE_STORAGE_BLOB_URL.
+        credential (_type_, optional): the credential to access the blob storage. Defaults to get_credential().
+        container_name (str, optional): the name of the container. Defaults to AZURE_STORAGE_CONTAINER_NAME.
+
+    Returns:
+        list: names of the blobs
+    """
+    if account_url.startswith("file://"):
+        directory = os.path.join(urlparse(account_url).path, container_name)
+        names = sorted(os.path.relpath(os.path.join(root, name), directory) 
+                       for root, _, files in os.walk(directory) for name in files)
+        return [name for name in names if not prefix or name.startswith(prefix)]
+    container_client = get_blob_service_client(account_url, credential).get_container_client(container_name)
+    return [blob.name for blob in container_client.list_blobs(name_starts_with=prefix)]
+
+def get_story_path_from_blob(blob_name:str, 
+                             account_url:str = AZURE_STORAGE_BLOB_URL, 
+                             credential = None, 
+                             container_name:str = AZURE_STORAGE_CONTAINER_NAME, 
+                             cache_dir:str = STORY_CACHE_DIR)-> str:
+    """Sync the story to the local cache and return its path. The blob is downloaded only when its
+    etag changed (conditional request), and it is streamed to disk instead of buffered in memory.
+
+    Args:
+        blob_name (str): the name of the blob
+        account_url (str, optional): the url of the account. Defaults to AZURE_STORAGE_BLOB_URL.
+        credential (_type_, optional): the credential to access the blob storage. Defaults to get_credential().
+        container_name (str, optional): the name of the container. Defaults to AZURE_STORAGE_CONTAINER_NAME.
+        cache_dir (str, optional): the local cache directory. Defaults to STORY_CACHE_DIR.
+
+    Returns:
+        str: path of the cached story
+    """
+    story_path = os.path.join(cache_dir, container_name, blob_name)
+    meta_path = story_path + ".meta.json"
+    metadata = {}
+    if os.path.exists(story_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            metadata = json.load(f)
+
+    blob_client = get_blob_client(blob_name, account_url, credential, container_name)
+    try:
+        if metadata.get("etag"):
+            downloader = blob_client.download_blob(etag=metadata["etag"], match_condition=MatchConditions.IfModified)
+        else:
+            downloader = blob_client.download_blob()
+    except ResourceNotModifiedError:
+        return story_path
+
+    os.makedirs(os.path.dirname(story_path), exist_ok=True)
+    # both files are replaced whole; a failed download leaves no temporary file behind
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(story_path), delete=False) as f:
+        temp_path = f.name
+    try:
+        with open(temp_path, "wb") as f:
+            downloader.readinto(f)
+        os.replace(temp_path, story_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(meta_path), delete=False) as f:
+        json.dump({"etag": downloader.properties.etag, "last_modified": str(downloader.properties.last_modified)}, f)
+    os.replace(f.name, meta_path)
+    return story_path
+
+_story_texts = {}
+
 def get_story_from_blob(blob_name:str, 
                         account_url:str = AZURE_STORAGE_BLOB_URL, 
-                        credential = credential, 
+                        credential = None, 
                         container_name:str = AZURE_STORAGE_CONTAINER_NAME, 
+                        cache_dir:str = STORY_CACHE_DIR, 
                         )-> str:
-    """Get the story from the Azure Blob Storage
+    """Get the story from the Azure Blob Storage, through the local story cache
 
     Args:
         account_url (str): the url of the account
-        credential (_type_): the credential to access the blob storage
+        credential (_type_, optional): the credential to access the blob storage. Defaults to get_credential().
         container_name (str): the name of the container
         blob_name (str): the name of the blob
+        cache_dir (str, optional): the local cache directory. Defaults to STORY_CACHE_DIR.
 
     Returns:
         str: the story
     """
-    blob_service_client = BlobServiceClient(account_url, credential=credential)
-    container_client = blob_service_client.get_container_client(container_name)
-    blob_client = container_client.get_blob_client(blob_name)
-    the_story = blob_client.download_blob().readall() # read blob content as string
-    return the_story.decode("utf-8")
+    with metrics.span("blob_fetch"):
+        story_path = get_story_path_from_blob(blob_name, account_url, credential, container_name, cache_dir)
+        stat = os.stat(story_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = _story_texts.get(story_path)
+        if cached is None or cached[0] != version:
+            with open(story_path, encoding="utf-8") as f:
+                cached = (version, f.read())
+            _story_texts[story_path] = cached
+    return cached[1]
 
 
 # neo4j utils
-graph = Neo4jGraph(NEO4J_URL, NEO4J_USERNAME,
-                    get_secret("NEO4J-PASSWORD", credential))
+def get_graph():
+    """Get the Neo4j graph, connected on first use and again when the password is rotated
+
+    Returns:
+        _type_: the Neo4j graph
+    """
+    return _get_graph(get_secret("NEO4J-PASSWORD"))
+
+@lru_cache(maxsize=1)
+def _get_graph(password:str):
+    return Neo4jGraph(NEO4J_URL, NEO4J_USERNAME, password)
 
 # postresql utils
 def connect_to_postgres(username:str = POSTGRESQL_USERNAME, 
-                        password:str = get_secret("POSTGRESQL-PASSWORD", credential),
+                        password:str = None,
                         host:str = POSTGRESQL_HOST, 
                         database:str = POSTGRESQL_DATABASE):
     """Connect to the PostgreSQL database
 
     Args:
         username (str): the username to access the database
-        password (str): the password to access the database
+        password (str, optional): the password to access the database. Defaults to the key vault secret.
         host (str): the host of the database
         database (str): the name of the database
 
@@ -94,7 +682,7 @@ def connect_to_postgres(username:str = POSTGRESQL_USERNAME,
     host = host,
     database = database,
     user = username,
-    password = password)
+    password = password or get_secret("POSTGRESQL-PASSWORD"))
     return conn
 
 def create_vector_extension_and_register(conn):
@@ -112,24 +700,515 @@ def create_vector_extension_and_register(conn):
     register_vector(conn)
     return cur
 
-def create_table(cur, conn, table_name:str):
-    """Create table & columns
+class ConnectionPool:
+    """Thread-safe PostgreSQL connection pool. Up to maxconn connections are kept open and reused,
+    minconn of them opened up front. Connections get the vector extension registered once,
+    are health-checked when they were idle for a while and are rolled back when returned."""
+
+    def __init__(self, minconn:int = POSTGRES_POOL_MIN_SIZE, 
+                 maxconn:int = POSTGRES_POOL_MAX_SIZE, 
+                 timeout:float = POSTGRES_POOL_TIMEOUT, 
+                 health_check_seconds:float = POSTGRES_HEALTH_CHECK_SECONDS, 
+                 **connect_kwargs):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_seconds = health_check_seconds
+        self._connect_kwargs = connect_kwargs
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        # idle connections, the most recently returned last; at most maxconn as checkouts hold a slot
+        self._idle = [psycopg2.connect(**connect_kwargs) for _ in range(minconn)]
+        self.closed = False
+        # registered connections -> when they were last returned; keyed by the connection itself, not its id
+        self._last_used = weakref.WeakKeyDictionary()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.health_check_failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _take(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return psycopg2.connect(**self._connect_kwargs)
+
+    def _prepare(self, conn):
+        last_used = self._last_used.get(conn)
+        if last_used is None:
+            create_vector_extension_and_register(conn)
+            self._last_used[conn] = time.monotonic()
+        elif time.monotonic() - last_used > self.health_check_seconds:
+            conn.cursor().execute("SELECT 1")
+            conn.rollback()
+        return conn
+
+    def _discard(self, conn):
+        self._last_used.pop(conn, None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """Borrow a connection, waiting up to timeout seconds when the pool is saturated
+
+        Returns:
+            _type_: the connection to the database
+        """
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise psycopg2.pool.PoolError(f"no connection available after {self.timeout}s ({self.maxconn} in use)")
+        try:
+            conn = self._take()
+            try:
+                conn = self._prepare(conn)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                with self._lock:
+                    self.health_check_failures += 1
+                self._discard(conn)
+                conn = self._prepare(self._take())
+        except:
+            self._slots.release()
+            raise
+        wait = time.perf_counter() - start
+        with self._lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return conn
+
+    def putconn(self, conn):
+        """Return a borrowed connection, ending its open transaction
+
+        Args:
+            conn (_type_): the connection to the database
+        """
+        try:
+            if conn.closed:
+                self._discard(conn)
+            else:
+                try:
+                    conn.rollback()
+                    self._last_used[conn] = time.monotonic()
+                    with self._lock:
+                        keep = not self.closed
+                        if keep:
+                            self._idle.append(conn)
+                    if not keep:
+                        self._discard(conn)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    self._discard(conn)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def close(self):
+        """Close the idle connections, and the borrowed ones when they are returned"""
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self) -> dict:
+        """Pool saturation metrics
+
+        Returns:
+            dict: connections in use, peak, max size, saturation, checkouts, timeouts, health check failures and wait times
+        """
+        with self._lock:
+            return {"in_use": self.in_use, "peak_in_use": self.peak_in_use, "max_size": self.maxconn, 
+                    "saturation": self.in_use / self.maxconn, "checkouts": self.checkouts, 
+                    "timeouts": self.timeouts, "health_check_failures": self.health_check_failures, 
+                    "avg_wait_ms": self.total_wait * 1000 / self.checkouts if self.checkouts else 0.0, 
+                    "max_wait_ms": self.max_wait * 1000}
+
+_pool_lock = threading.Lock()
+_pool = None
+_pool_password = None
+
+def get_pool() -> ConnectionPool:
+    """Get the process-wide connection pool, created on first use and again when the password is rotated
+    (the previous pool closes its connections as they are returned)
+
+    Returns:
+        ConnectionPool: the connection pool
+    """
+    global _pool, _pool_password
+    password = get_secret("POSTGRESQL-PASSWORD")
+    with _pool_lock:
+        if _pool is None or password != _pool_password:
+            previous = _pool
+            _pool = ConnectionPool(host = POSTGRESQL_HOST, 
+                                   database = POSTGRESQL_DATABASE, 
+                                   user = POSTGRESQL_USERNAME, 
+                                   password = password)
+            _pool_password = password
+            if previous is not None:
+                previous.close()
+        return _pool
+
+@contextmanager
+def pooled_connection():
+    """Borrow a connection from the process-wide pool for the duration of a with block
+
+    Yields:
+        _type_: the connection to the database, with the vector type registered
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+def embedding_column_type(cur, table_name:str)-> str:
+    """Get the type of the stored embeddings, e.g. "vector(1536)" or "halfvec(512)"
+
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the table
+
+    Returns:
+        str: the column type, None if the table does not exist
+    """
+    cur.execute("SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+                "WHERE attrelid = to_regclass(%s) AND attname = 'story_embeddings';", (table_name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def vector_indexes(cur, table_name:str)-> set:
+    """Get the ANN indexes the embeddings column has
+
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the table
+
+    Returns:
+        set: the existing index types, among "hnsw", "ivfflat" and "binary"
+    """
+    index_types = ("hnsw", "ivfflat", "binary")
+    cur.execute("SELECT " + ", ".join(["to_regclass(%s) IS NOT NULL"] * len(index_types)) + ";", 
+                [f"{table_name}_embeddings_{index_type}_idx" for index_type in index_types])
+    return {index_type for index_type, exists in zip(index_types, cur.fetchone()) if exists}
+
+_binary_indexes = {}
+_binary_indexes_lock = threading.Lock()
+
+def has_binary_index(cur, table_name:str, recheck_seconds:float = 60)-> bool:
+    """Check if the table has the binary quantization index get_similar re-ranks from. An existing index
+    is remembered, a missing one is checked again after recheck_seconds
+
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the table
+        recheck_seconds (float, optional): how long a missing index is remembered. Defaults to 60.
+
+    Returns:
+        bool: True if the index exists
+    """
+    with _binary_indexes_lock:
+        exists, checked_at = _binary_indexes.get(table_name, (False, None))
+    if exists or (checked_at is not None and time.monotonic() - checked_at < recheck_seconds):
+        return exists
+    exists = "binary" in vector_indexes(cur, table_name)
+    if not exists:
+        print(f"{table_name} has no binary index, similarity search runs without the binary first pass")
+    with _binary_indexes_lock:
+        _binary_indexes[table_name] = (exists, time.monotonic())
+    return exists
+
+def drop_vector_indexes(cur, table_name:str):
+    """Drop the ANN indexes of the embeddings column (hnsw, ivfflat and binary)
+
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the table
+    """
+    for index_type in ("hnsw", "ivfflat", "binary"):
+        cur.execute(f"DROP INDEX IF EXISTS {table_name}_embeddings_{index_type}_idx;")
+    with _binary_indexes_lock:
+        _binary_indexes.pop(table_name, None)
+
+def _migrate_story_table(cur, table_name:str, legacy_story_id:str):
+    # tables created before stories were keyed (story_text, story_embeddings only): number the chunks,
+    # assign them to the legacy story and hash them as content_hash does, so the next ingestion reuses them
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s;", (table_name,))
+    columns = {row[0] for row in cur.fetchall()}
+    if {"chunk_id", "story_id", "content_hash"} <= columns:
+        return
+    print(f"Migrating {table_name}: its chunks are assigned to {legacy_story_id}")
+    cur.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS chunk_id SERIAL, "
+                f"ADD COLUMN IF NOT EXISTS story_id TEXT, "
+                f"ADD COLUMN IF NOT EXISTS content_hash TEXT;")
+    cur.execute(f"UPDATE {table_name} SET story_id = %s WHERE story_id IS NULL;", (legacy_story_id,))
+    cur.execute(f"UPDATE {table_name} SET content_hash = encode(sha256(convert_to(coalesce(story_text, ''), 'UTF8')), 'hex') "
+                f"WHERE content_hash IS NULL;")
+    cur.execute(f"DELETE FROM {table_name} a USING {table_name} b "
+                f"WHERE a.story_id = b.story_id AND a.content_hash = b.content_hash AND a.chunk_id > b.chunk_id;")
+    cur.execute(f"ALTER TABLE {table_name} ALTER COLUMN story_id SET NOT NULL, ALTER COLUMN content_hash SET NOT NULL;")
+    cur.execute("SELECT contype FROM pg_constraint WHERE conrelid = to_regclass(%s);", (table_name,))
+    constraint_types = {row[0] for row in cur.fetchall()}
+    if "p" not in constraint_types:
+        cur.execute(f"ALTER TABLE {table_name} ADD PRIMARY KEY (chunk_id);")
+    if "u" not in constraint_types:
+        cur.execute(f"ALTER TABLE {table_name} ADD UNIQUE (story_id, content_hash);")
+
+def create_table(cur, conn, table_name:str, 
+                 dimensions:int = EMBEDDING_DIMENSIONS, 
+                 storage:str = EMBEDDING_STORAGE, 
+                 legacy_story_id:str = "story.txt"):
+    """Create table & columns if they do not exist. Several stories share the table, keyed by story_id.
+    An existing table is migrated in place: a table from before story ids gets its chunks assigned to
+    legacy_story_id, and the embeddings column is converted when only the storage changes (vector <-> halfvec).
 
     Args:
         cur (_type_): cursor
         conn (_type_): connection
         table_name (str): name of the table
+        dimensions (int, optional): dimensions of the embeddings. Defaults to EMBEDDING_DIMENSIONS.
+        storage (str, optional): "vector" or "halfvec". Defaults to EMBEDDING_STORAGE.
+        legacy_story_id (str, optional): story of the chunks of a table from before story ids. Defaults to "story.txt".
+
+    Raises:
+        ValueError: if the storage is unknown or the table holds embeddings of other dimensions
     """
+    if storage not in ("vector", "halfvec"):
+        raise ValueError(f"Unknown embedding storage: {storage}")
+    column_type = f"{storage}({int(dimensions)})"
+    stored_type = embedding_column_type(cur, table_name)
+    # an untyped column (older tables) is typed if all its embeddings have the dimensions
+    if stored_type not in (None, "vector", "halfvec") and not stored_type.endswith(f"({int(dimensions)})"):
+        raise ValueError(f"{table_name} holds {stored_type} embeddings, not {column_type}: "
+                         f"the stories must be embedded again, in a new table or after dropping this one")
     try:
-        cur.execute(f"DROP TABLE IF EXISTS {table_name};")
-        column_names = ["story_text TEXT", "story_embeddings VECTOR"]
+        column_names = ["chunk_id SERIAL PRIMARY KEY", "story_id TEXT NOT NULL", "content_hash TEXT NOT NULL",
+                        "story_text TEXT", f"story_embeddings {column_type}", 
+                        "UNIQUE (story_id, content_hash)"]
         column_names = ", ".join(column_names)
-        cur.execute(f'CREATE TABLE {table_name} ({column_names});')
+        cur.execute(f'CREATE TABLE IF NOT EXISTS {table_name} ({column_names});')
+        if stored_type is not None:
+            _migrate_story_table(cur, table_name, legacy_story_id)
+        if stored_type is not None and stored_type != column_type:
+            # the operator classes differ, the indexes are built again by create_vector_index
+            drop_vector_indexes(cur, table_name)
+            cur.execute(f"ALTER TABLE {table_name} ALTER COLUMN story_embeddings TYPE {column_type} "
+                        f"USING story_embeddings::{column_type};")
+        cur.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS start_offset INTEGER, "
+                    f"ADD COLUMN IF NOT EXISTS end_offset INTEGER;")
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table_name}_stories ("
+                    f"story_id TEXT PRIMARY KEY, "
+                    f"story_hash TEXT, "
+                    f"chunk_count INTEGER, "
+                    f"updated_at TIMESTAMPTZ DEFAULT now());")
+        # a story is "ingesting" while a checkpointed ingestion is running or was interrupted, "ready" when complete
+        cur.execute(f"ALTER TABLE {table_name}_stories ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'ready', "
+                    f"ADD COLUMN IF NOT EXISTS chunks_done INTEGER NOT NULL DEFAULT 0;")
+        create_mentions_table(cur, table_name)
         conn.commit()
         print(f"Table {table_name} created successfully")
-        return
+    except Exception:
+        conn.rollback()
+        raise
+
+@contextmanager
+def story_lock(cur, conn, table_name:str, story_id:str):
+    """Hold a session advisory lock on a story for the duration of a with block, so that two processes
+    do not ingest (or delete) the same story at once: the second one waits, then finds the chunks stored.
+    A session lock rather than a transaction lock, as checkpointed ingestion commits every batch.
+    The lock is re-entrant on the same connection.
+
+    Args:
+        cur (_type_): cursor
+        conn (_type_): connection
+        table_name (str): name of the table
+        story_id (str): id of the story
+    """
+    key = f"{table_name}:{story_id}"
+    cur.execute("SELECT pg_advisory_lock(hashtext(%s));", (key,))
+    try:
+        yield
+    finally:
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(hashtext(%s));", (key,))
+
+def delete_story(cur, conn, table_name:str, story_id:str):
+    """Delete one story (chunks, mentions and registry entry), leaving the other stories untouched
+
+    Args:
+        cur (_type_): cursor
+        conn (_type_): connection
+        table_name (str): name of the table
+        story_id (str): id of the story
+    """
+    try:
+        cur.execute(f"DELETE FROM {table_name} WHERE story_id = %s;", (story_id,))
+        cur.execute(f"DELETE FROM {table_name}_stories WHERE story_id = %s;", (story_id,))
+        cur.execute(f"DELETE FROM {table_name}_mentions_indexed WHERE story_id = %s;", (story_id,))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+def create_mentions_table(cur, table_name:str):
+    """Create the chunk_id -> character -> count table used by get_exact_match, and the table of the
+    characters indexed per story (with or without mentions)
+
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the story table
+    """
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {table_name}_mentions ("
+                f"chunk_id INTEGER REFERENCES {table_name} (chunk_id) ON DELETE CASCADE, "
+                f"character_name TEXT, "
+                f"mention_count INTEGER, "
+                f"PRIMARY KEY (character_name, chunk_id));")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_mentions_rank_idx "
+                f"ON {table_name}_mentions (character_name, mention_count DESC);")
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {table_name}_mentions_indexed ("
+                f"story_id TEXT, "
+                f"character_name TEXT, "
+                f"PRIMARY KEY (story_id, character_name));")
+
+def _like_pattern(text:str)-> str:
+    # ILIKE pattern matching text anywhere, its wildcards taken literally
+    return "%" + re.sub(r"([\\%_])", r"\\\1", text) + "%"
+
+def build_mention_index(cur, conn, table_name:str, character_names, story_id:str) -> int:
+    """Count the mentions of each character in every paragraph of a story, inside the database.
+    Chunks that are already counted are skipped. Each character is recorded as indexed, even without mentions.
+
+    Args:
+        cur (_type_): cursor
+        conn (_type_): connection
+        table_name (str): name of the story table
+        character_names (_type_): list of character names
+        story_id (str): id of the story
+
+    Returns:
+        int: number of (chunk, character) rows inserted
+    """
+    sql_command = (f"INSERT INTO {table_name}_mentions (chunk_id, character_name, mention_count) "
+                   f"SELECT chunk_id, lower(%(name)s), "
+                   f"(length(lower(story_text)) - length(replace(lower(story_text), lower(%(name)s), ''))) / length(%(name)s) "
+                   f"FROM {table_name} WHERE story_id = %(story_id)s AND story_text ILIKE %(pattern)s "
+                   f"ON CONFLICT (character_name, chunk_id) DO NOTHING;")
+    inserted = 0
+    try:
+        for character_name in character_names:
+            if not character_name:
+                continue
+            cur.execute(sql_command, {"name": character_name, "pattern": _like_pattern(character_name), "story_id": story_id})
+            inserted += cur.rowcount
+            cur.execute(f"INSERT INTO {table_name}_mentions_indexed (story_id, character_name) VALUES (%s, lower(%s)) "
+                        f"ON CONFLICT DO NOTHING;", (story_id, character_name))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return inserted
+
+def create_vector_index(cur, conn, table_name:str, 
+                        index_type:str = VECTOR_INDEX_TYPE, 
+                        m:int = 16, 
+                        ef_construction:int = 64, 
+                        lists:int = None, 
+                        rebuild:bool = False, 
+                        binary:bool = BINARY_RERANK_FACTOR > 0, 
+                        dimensions:int = EMBEDDING_DIMENSIONS, 
+                        storage:str = EMBEDDING_STORAGE):
+    """Create a cosine ANN index on the embeddings column. Build it after the bulk load, it is much faster.
+    An existing index is kept unless rebuild is True (hnsw is maintained on insert, ivfflat lists are not).
+    With binary, an hnsw hamming index on the binary-quantized embeddings (1 bit per dimension) is built too,
+    for the first pass of get_similar with a rerank factor.
+
+    Args:
+        cur (_type_): cursor
+        conn (_type_): connection
+        table_name (str): name of the table
+        index_type (str, optional): "hnsw" or "ivfflat". Defaults to VECTOR_INDEX_TYPE.
+        m (int, optional): hnsw max connections per layer. Defaults to 16.
+        ef_construction (int, optional): hnsw candidate list size at build time. Defaults to 64.
+        lists (int, optional): ivfflat number of lists. Defaults to rows / 1000 (at least 1).
+        rebuild (bool, optional): drop and recreate an existing index. Defaults to False.
+        binary (bool, optional): also build the binary quantization index. Defaults to BINARY_RERANK_FACTOR > 0.
+        dimensions (int, optional): dimensions of the embeddings. Defaults to EMBEDDING_DIMENSIONS.
+        storage (str, optional): "vector" or "halfvec". Defaults to EMBEDDING_STORAGE.
+    """
+    index_name = f"{table_name}_embeddings_{index_type}_idx"
+    binary_index_name = f"{table_name}_embeddings_binary_idx"
+    operator_class = f"{storage}_cosine_ops"
+    try:
+        if rebuild:
+            cur.execute(f"DROP INDEX IF EXISTS {index_name};")
+            cur.execute(f"DROP INDEX IF EXISTS {binary_index_name};")
+        if index_type == "hnsw":
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} USING hnsw (story_embeddings {operator_class}) "
+                        f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)});")
+        elif index_type == "ivfflat":
+            if lists is None:
+                cur.execute(f"SELECT count(*) FROM {table_name};")
+                lists = max(1, cur.fetchone()[0] // 1000)
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} USING ivfflat (story_embeddings {operator_class}) "
+                        f"WITH (lists = {int(lists)});")
+        else:
+            raise ValueError(f"Unknown index type: {index_type}")
+        if binary:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {binary_index_name} ON {table_name} "
+                        f"USING hnsw ((binary_quantize(story_embeddings)::bit({int(dimensions)})) bit_hamming_ops) "
+                        f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)});")
+        conn.commit()
+        with _binary_indexes_lock:
+            _binary_indexes.pop(table_name, None)
+        print(f"Index {index_name} created successfully")
     except:
         conn.rollback()
+        raise
+
+_pgvector_versions = {}
+
+def pgvector_version(cur)-> tuple:
+    """Get the version of the vector extension of the database, checked once per database
+
+    Args:
+        cur (_type_): cursor
+
+    Returns:
+        tuple: e.g. (0, 8, 0), () if the extension is not installed
+    """
+    database = cur.connection.dsn
+    if database not in _pgvector_versions:
+        cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector';")
+        row = cur.fetchone()
+        _pgvector_versions[database] = tuple(int(part) for part in re.findall(r"\d+", row[0])) if row else ()
+    return _pgvector_versions[database]
+
+def set_search_params(cur, ef_search:int = None, probes:int = None, iterative_scan:bool = False):
+    """Set the query-time ANN parameters for the current transaction
+
+    Args:
+        cur (_type_): cursor
+        ef_search (int, optional): hnsw candidate list size at query time. Defaults to None (unchanged).
+        probes (int, optional): ivfflat number of probed lists. Defaults to None (unchanged).
+        iterative_scan (bool, optional): keep scanning the index until enough rows pass the WHERE clause
+            (relaxed order, pgvector >= 0.8), for filtered queries. Defaults to False.
+    """
+    if ef_search is not None:
+        cur.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(int(ef_search)),))
+    if probes is not None:
+        cur.execute("SELECT set_config('ivfflat.probes', %s, true)", (str(int(probes)),))
+    if iterative_scan and pgvector_version(cur) >= (0, 8):
+        cur.execute("SELECT set_config('hnsw.iterative_scan', 'relaxed_order', true), "
+                    "set_config('ivfflat.iterative_scan', 'relaxed_order', true)")
 
 def check_if_table_exists(cur, table_name:str):
     """Check if the table exists
@@ -144,8 +1223,41 @@ def check_if_table_exists(cur, table_name:str):
     cur.execute(f"SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = '{table_name}');")
     return cur.fetchone()[0]
 
+def content_hash(text:str)-> str:
+    """Hash of a text, used to detect changed stories and chunks
+
+    Args:
+        text (str): the text
+
+    Returns:
+        str: sha256 hex digest
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def check_if_story_is_current(cur, table_name:str, story_id:str, story_hash:str):
+    """Check if the story is completely ingested and matches the given content hash
+
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the table
+        story_id (str): id of the story
+        story_hash (str): content hash of the current story
+
+    Returns:
+        bool: True if the stored story is up to date and ready, False otherwise
+    """
+    if not check_if_table_exists(cur, f"{table_name}_stories"):
+        return False
+    cur.execute(f"SELECT * FROM {table_name}_stories WHERE story_id = %s;", (story_id,))
+    row = cur.fetchone()
+    if row is None:
+        return False
+    # tables created before the status column have only complete stories
+    row = dict(zip([column[0] for column in cur.description], row))
+    return row["story_hash"] == story_hash and row.get("status", "ready") == "ready"
+
 def insert_story_embeddings(cur, conn, table_name:str, 
-                            story_embedding, story_text:str):
+                            story_embedding, story_text:str, story_id:str):
     """Insert story embeddings into the table
 
     Args:
@@ -154,12 +1266,47 @@ def insert_story_embeddings(cur, conn, table_name:str,
         table_name (str): name of the table
         story_embedding (_type_): story embeddings
         story_text (str): story text
+        story_id (str): id of the story
     """
-    sql_comand = f'INSERT INTO {table_name} (story_text, story_embeddings) VALUES (%s, %s);'
-    args1 = (story_text, story_embedding)    
+    sql_comand = (f'INSERT INTO {table_name} (story_id, content_hash, story_text, story_embeddings) VALUES (%s, %s, %s, %s) '
+                  f'ON CONFLICT (story_id, content_hash) DO NOTHING;')
+    args1 = (story_id, content_hash(story_text), story_text, story_embedding)    
     cur.execute(sql_comand, args1)
     conn.commit()
 
+def insert_story_embeddings_bulk(cur, conn, table_name:str, rows, story_id:str, 
+                                 page_size:int = 500, 
+                                 commit:bool = True):
+    """Insert many story embeddings into the table in a single transaction
+
+    Args:
+        cur (_type_): cursor
+        conn (_type_): connection
+        table_name (str): name of the table
+        rows (_type_): list of (story_text, story_embedding) or (story_text, story_embedding, start_offset, end_offset) tuples
+        story_id (str): id of the story
+        page_size (int, optional): number of rows per INSERT statement. Defaults to 500.
+        commit (bool, optional): commit the transaction. Defaults to True.
+
+    Returns:
+        int: number of inserted rows
+    """
+    rows = [tuple(row) + (None,) * (4 - len(row)) for row in rows]
+    rows = [(story_id, content_hash(story_text), story_text, np.asarray(story_embedding, dtype=np.float32), start_offset, end_offset) 
+            for story_text, story_embedding, start_offset, end_offset in rows]
+    if not rows:
+        return 0
+    sql_comand = (f'INSERT INTO {table_name} (story_id, content_hash, story_text, story_embeddings, start_offset, end_offset) VALUES %s '
+                  f'ON CONFLICT (story_id, content_hash) DO NOTHING;')
+    try:
+        execute_values(cur, sql_comand, rows, page_size=page_size)
+        if commit:
+            conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return len(rows)
+
 def count_a_in_b(text_to_search:str, text_to_search_in:str)-> int:
     """Count the number of occurences of a text in another text
 
@@ -176,62 +1323,819 @@ def count_a_in_b(text_to_search:str, text_to_search_in:str)-> int:
 
 def get_exact_match(cur, table_name:str, 
                     character_name:str, 
+                    story_id:str, 
                     top_k:int = 3) -> list:
-    """Get the exact match of a character name in the story
+    """Get the paragraphs with the most mentions of a character name, from the mention index.
+    Characters that are not indexed yet are counted once and added to the index.
 
     Args:
         cur (_type_): cursor
         table_name (str): name of the table
         character_name (str): character name
+        story_id (str): id of the story
         top_k (int, optional): number of results. Defaults to 3.
 
     Returns:
         list: list of paragraphs
     """
-    sql_command = f'SELECT story_text FROM {table_name} WHERE story_text ILIKE %s'
-    cur.execute(sql_command, (f'%{character_name}%',))
+    sql_command = (f"SELECT s.story_text FROM {table_name}_mentions m JOIN {table_name} s USING (chunk_id) "
+                   f"WHERE m.character_name = lower(%s) AND s.story_id = %s "
+                   f"ORDER BY m.mention_count DESC LIMIT {int(top_k)}")
+    cur.execute(sql_command, (character_name, story_id))
     result = cur.fetchall()
-    final_result = [(paragraph[0], count_a_in_b(character_name, paragraph[0])) for paragraph in result]
-    final_result.sort(key=lambda x: x[1], reverse = True)
-    first_results = final_result[:top_k]
-    first_string_results = [paragraph[0] for paragraph in first_results]
+    if not result:
+        # a character without mentions is indexed once, not on every call
+        cur.execute(f"SELECT EXISTS (SELECT FROM {table_name}_mentions_indexed WHERE story_id = %s AND character_name = lower(%s));", 
+                    (story_id, character_name))
+        if cur.fetchone()[0]:
+            return []
+        build_mention_index(cur, cur.connection, table_name, [character_name], story_id)
+        cur.execute(sql_command, (character_name, story_id))
+        result = cur.fetchall()
+    first_string_results = [paragraph[0] for paragraph in result]
     return first_string_results
 
-def get_similar(cur, table_name:str, vector, k:int=5) -> list:
-    """Get the similar paragraphs to a given vector
+def get_similar(cur, table_name:str, vector, k:int=5, 
+                ef_search:int = HNSW_EF_SEARCH, 
+                probes:int = IVFFLAT_PROBES, 
+                story_id:str = None, 
+                rerank_factor:int = BINARY_RERANK_FACTOR, 
+                dimensions:int = EMBEDDING_DIMENSIONS, 
+                storage:str = EMBEDDING_STORAGE) -> list:
+    """Get the similar paragraphs to a given vector. With a rerank factor, k * rerank_factor candidates
+    are taken by hamming distance on the binary index first and re-ranked with the stored embeddings;
+    while the table has no binary index (see has_binary_index), the index of the embeddings is searched.
+    With a story id, the index is scanned iteratively (pgvector >= 0.8) until enough rows of the story are found,
+    and the story is scanned exactly if fewer than k come back.
 
     Args:
         cur (_type_): cursor
         table_name (str): name of the table
         vector (_type_): vector
         k (int, optional): number of results. Defaults to 5.
+        ef_search (int, optional): hnsw candidate list size. Defaults to HNSW_EF_SEARCH.
+        probes (int, optional): ivfflat number of probed lists. Defaults to IVFFLAT_PROBES.
+        story_id (str, optional): only search this story. Defaults to None (all stories).
+        rerank_factor (int, optional): candidates per result of the binary first pass, 0 for none. Defaults to BINARY_RERANK_FACTOR.
+        dimensions (int, optional): dimensions of the embeddings. Defaults to EMBEDDING_DIMENSIONS.
+        storage (str, optional): "vector" or "halfvec". Defaults to EMBEDDING_STORAGE.
 
     Returns:
         list: list of paragraphs
     """
-    cur.execute(f'SELECT story_text, (story_embeddings <=> %s) as similarity_score FROM {table_name} ORDER BY story_embeddings <=> %s LIMIT {k}', (vector, vector))
+    story_filter = "WHERE story_id = %(story_id)s " if story_id is not None else ""
+    params = {"vector": vector, "story_id": story_id, "k": int(k)}
+    if rerank_factor and has_binary_index(cur, table_name):
+        params["candidates"] = int(k * rerank_factor)
+        # hnsw returns at most ef_search rows
+        set_search_params(cur, max(ef_search or 0, params["candidates"]), probes, iterative_scan=story_id is not None)
+        cur.execute(f"SELECT story_text, (story_embeddings <=> CAST(%(vector)s AS {storage})) AS similarity_score FROM ("
+                    f"SELECT story_text, story_embeddings FROM {table_name} {story_filter}"
+                    f"ORDER BY binary_quantize(story_embeddings)::bit({int(dimensions)}) <~> binary_quantize(CAST(%(vector)s AS {storage})) "
+                    f"LIMIT %(candidates)s) candidates "
+                    f"ORDER BY similarity_score LIMIT %(k)s", params)
+    else:
+        set_search_params(cur, ef_search, probes, iterative_scan=story_id is not None)
+        # an iterative scan returns the rows in relaxed order, they are sorted again
+        cur.execute(f"SELECT story_text, similarity_score FROM ("
+                    f"SELECT story_text, (story_embeddings <=> CAST(%(vector)s AS {storage})) AS similarity_score FROM {table_name} "
+                    f"{story_filter}ORDER BY story_embeddings <=> CAST(%(vector)s AS {storage}) LIMIT %(k)s) hits "
+                    f"ORDER BY similarity_score", params)
     result = cur.fetchall()
     final_result = [x[0] for x in result]
+    if story_id is not None and len(final_result) < k:
+        # the index scan ran out of candidates before enough rows of the story (other stories dominate
+        # the table, or pgvector < 0.8 has no iterative scan): the story is scanned exactly
+        final_result = get_similar_exact(cur, table_name, vector, k, storage, story_id=story_id)
     return final_result
 
-# openai utils
-
-client = OpenAI(api_key=get_secret("OPENAI-API-KEY", credential))
-
-llm = ChatOpenAI(
-    openai_api_key=get_secret("OPENAI-API-KEY", credential),
-    model="gpt-4o-mini-2024-07-18",
-    temperature=0.1,
-    max_tokens=500,
-)
+def get_similar_exact(cur, table_name:str, vector, k:int=5, storage:str = EMBEDDING_STORAGE, story_id:str = None) -> list:
+    """Get the similar paragraphs to a given vector with an exact (sequential) scan
 
-# templates
-# TEMPLATE 1 --------------------------------------------------------------
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the table
+        vector (_type_): vector
+        k (int, optional): number of results. Defaults to 5.
+        storage (str, optional): "vector" or "halfvec". Defaults to EMBEDDING_STORAGE.
+        story_id (str, optional): only search this story. Defaults to None (all stories).
+
+    Returns:
+        list: list of paragraphs
+    """
+    story_filter = "WHERE story_id = %(story_id)s " if story_id is not None else ""
+    cur.execute("SELECT set_config('enable_indexscan', 'off', true)")
+    try:
+        cur.execute(f'SELECT story_text FROM {table_name} {story_filter}ORDER BY story_embeddings <=> CAST(%(vector)s AS {storage}) LIMIT {int(k)}', 
+                    {"vector": vector, "story_id": story_id})
+        result = cur.fetchall()
+    finally:
+        cur.execute("SELECT set_config('enable_indexscan', 'on', true)")
+    return [x[0] for x in result]
+
+def reciprocal_rank_fusion(rankings, rrf_k:int = RRF_K) -> list:
+    """Fuse several rankings with reciprocal rank fusion, deduplicating the items
+
+    Args:
+        rankings (_type_): lists of items, best first
+        rrf_k (int, optional): the rank constant. Defaults to RRF_K.
+
+    Returns:
+        list: the items, by decreasing fused score
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=lambda item: scores[item], reverse=True)
+
+def cap_by_token_budget(fragments, token_budget:int = HYBRID_TOKEN_BUDGET) -> list:
+    """Keep the first fragments that fit in the token budget (at least one)
+
+    Args:
+        fragments (_type_): list of paragraphs, best first
+        token_budget (int, optional): maximum estimated tokens. Defaults to HYBRID_TOKEN_BUDGET.
+
+    Returns:
+        list: list of paragraphs
+    """
+    kept = []
+    for fragment in fragments:
+        token_budget -= estimate_tokens(fragment)
+        if token_budget < 0 and kept:
+            break
+        kept.append(fragment)
+    return kept
+
+def fuse_fragments(rankings, rrf_k:int = RRF_K, token_budget:int = HYBRID_TOKEN_BUDGET) -> list:
+    """Reciprocal rank fusion of lists of paragraphs, capped by a token budget
+
+    Args:
+        rankings (_type_): lists of paragraphs, best first
+        rrf_k (int, optional): the rank constant. Defaults to RRF_K.
+        token_budget (int, optional): maximum estimated tokens. Defaults to HYBRID_TOKEN_BUDGET.
+
+    Returns:
+        list: list of paragraphs
+    """
+    return cap_by_token_budget(reciprocal_rank_fusion(rankings, rrf_k), token_budget)
+
+def get_hybrid(cur, table_name:str, character_name:str, vector, story_id:str, 
+               lexical_k:int = 3, 
+               vector_k:int = 5, 
+               rrf_k:int = RRF_K, 
+               token_budget:int = HYBRID_TOKEN_BUDGET, 
+               ef_search:int = HNSW_EF_SEARCH, 
+               probes:int = IVFFLAT_PROBES, 
+               storage:str = EMBEDDING_STORAGE) -> list:
+    """Get the character mention hits and the vector hits in one statement, deduplicated by chunk
+    and fused with reciprocal rank fusion, capped by a token budget. The character must already be
+    in the mention index (get_exact_match adds it). The vector hits are searched as in get_similar: iterative
+    index scan, and an exact scan of the story when fewer than vector_k come back.
+
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the table
+        character_name (str): character name
+        vector (_type_): vector
+        story_id (str): id of the story
+        lexical_k (int, optional): number of mention hits. Defaults to 3.
+        vector_k (int, optional): number of vector hits. Defaults to 5.
+        rrf_k (int, optional): the rank constant. Defaults to RRF_K.
+        token_budget (int, optional): maximum estimated tokens. Defaults to HYBRID_TOKEN_BUDGET.
+        ef_search (int, optional): hnsw candidate list size. Defaults to HNSW_EF_SEARCH.
+        probes (int, optional): ivfflat number of probed lists. Defaults to IVFFLAT_PROBES.
+        storage (str, optional): "vector" or "halfvec". Defaults to EMBEDDING_STORAGE.
+
+    Returns:
+        list: list of paragraphs
+    """
+    set_search_params(cur, ef_search, probes, iterative_scan=True)
+    sql_command = (f"WITH lexical AS ("
+                   f"SELECT chunk_id, story_text, row_number() OVER (ORDER BY mention_count DESC) AS rank FROM ("
+                   f"SELECT s.chunk_id, s.story_text, m.mention_count FROM {table_name}_mentions m JOIN {table_name} s USING (chunk_id) "
+                   f"WHERE m.character_name = lower(%(name)s) AND s.story_id = %(story_id)s "
+                   f"ORDER BY m.mention_count DESC LIMIT %(lexical_k)s) l), "
+                   f"semantic AS ("
+                   f"SELECT chunk_id, story_text, row_number() OVER (ORDER BY distance) AS rank FROM ("
+                   f"SELECT chunk_id, story_text, story_embeddings <=> CAST(%(vector)s AS {storage}) AS distance FROM {table_name} "
+                   f"WHERE story_id = %(story_id)s ORDER BY story_embeddings <=> CAST(%(vector)s AS {storage}) LIMIT %(vector_k)s) v) "
+                   f"SELECT story_text, sum(1.0 / (%(rrf_k)s + rank)) AS score, (SELECT count(*) FROM semantic) AS semantic_hits "
+                   f"FROM (SELECT * FROM lexical UNION ALL SELECT * FROM semantic) hits "
+                   f"GROUP BY chunk_id, story_text ORDER BY score DESC;")
+    params = {"name": character_name, "story_id": story_id, "vector": vector, 
+              "lexical_k": int(lexical_k), "vector_k": int(vector_k), "rrf_k": int(rrf_k)}
+    cur.execute(sql_command, params)
+    rows = cur.fetchall()
+    if (rows[0][2] if rows else 0) < vector_k:
+        # as in get_similar: too few semantic hits of the story came out of the index, the story is scanned exactly
+        cur.execute("SELECT set_config('enable_indexscan', 'off', true)")
+        try:
+            cur.execute(sql_command, params)
+            rows = cur.fetchall()
+        finally:
+            cur.execute("SELECT set_config('enable_indexscan', 'on', true)")
+    return cap_by_token_budget([row[0] for row in rows], token_budget)
+
+def evaluate_vector_index(cur, table_name:str, 
+                          k:int = 5, 
+                          no_of_queries:int = 50, 
+                          ef_search_values = (10, 20, 40, 80, 160), 
+                          probes_values = (1, 5, 10, 20, 50), 
+                          rerank_factors = ()) -> list:
+    """Compare the ANN index against the exact scan, using stored embeddings as queries.
+    Only the settings of the indexes the table has are tried.
+
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the table
+        k (int, optional): number of results per query. Defaults to 5.
+        no_of_queries (int, optional): number of sampled query vectors. Defaults to 50.
+        ef_search_values (tuple, optional): hnsw ef_search values to try.
+        probes_values (tuple, optional): ivfflat probes values to try.
+        rerank_factors (tuple, optional): rerank factors of the binary index to try. Defaults to none.
+
+    Returns:
+        list: one dict per setting with the recall@k and the mean latency in ms, plus the exact scan baseline
+    """
+    cur.execute(f'SELECT story_embeddings::vector FROM {table_name} ORDER BY random() LIMIT {int(no_of_queries)}')
+    query_vectors = [x[0] for x in cur.fetchall()]
+    if not query_vectors:
+        return []
+
+    exact_results = []
+    start = time.perf_counter()
+    for vector in query_vectors:
+        exact_results.append(set(get_similar_exact(cur, table_name, vector, k)))
+    exact_latency = (time.perf_counter() - start) * 1000 / len(query_vectors)
+    report = [{"setting": "exact", "recall": 1.0, "latency_ms": exact_latency}]
+
+    index_types = vector_indexes(cur, table_name)
+    settings = ([{"ef_search": value} for value in ef_search_values if "hnsw" in index_types] + 
+                [{"probes": value} for value in probes_values if "ivfflat" in index_types] + 
+                [{"rerank_factor": value} for value in rerank_factors if "binary" in index_types])
+    for setting in settings:
+        # the search parameters are set for the transaction, each setting starts from the defaults
+        cur.connection.rollback()
+        hits = 0
+        start = time.perf_counter()
+        for vector, exact in zip(query_vectors, exact_results):
+            approximate = get_similar(cur, table_name, vector, k, 
+                                      ef_search=setting.get("ef_search"), probes=setting.get("probes"), 
+                                      rerank_factor=setting.get("rerank_factor", 0))
+            hits += len(exact.intersection(approximate))
+        latency = (time.perf_counter() - start) * 1000 / len(query_vectors)
+        recall = hits / sum(len(exact) for exact in exact_results)
+        cur.connection.rollback()
+        name, value = next(iter(setting.items()))
+        report.append({"setting": f"{name}={value}", "recall": recall, "latency_ms": latency})
+    return report
+
+def embedding_storage_sizes(cur, table_name:str) -> dict:
+    """Get the on-disk size of the embeddings table and of each of its indexes
+
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the table
+
+    Returns:
+        dict: relation name -> bytes, the table size includes its TOAST data
+    """
+    cur.execute("SELECT %s, pg_table_size(to_regclass(%s)) "
+                "UNION ALL SELECT indexrelid::regclass::text, pg_relation_size(indexrelid) FROM pg_index "
+                "WHERE indrelid = to_regclass(%s);", (table_name, table_name, table_name))
+    return {name: size for name, size in cur.fetchall()}
+
+def load_embeddings(cur, table_name:str, story_id:str = None)-> np.ndarray:
+    """Get the stored embeddings as a float32 matrix, one row per chunk
+
+    Args:
+        cur (_type_): cursor
+        table_name (str): name of the table
+        story_id (str, optional): only the chunks of this story. Defaults to None (all stories).
+
+    Returns:
+        np.ndarray: the embeddings
+    """
+    if story_id is None:
+        cur.execute(f"SELECT story_embeddings::vector FROM {table_name} ORDER BY chunk_id;")
+    else:
+        cur.execute(f"SELECT story_embeddings::vector FROM {table_name} WHERE story_id = %s ORDER BY chunk_id;", (story_id,))
+    return np.array([row[0] for row in cur.fetchall()], dtype=np.float32)
+
+def _normalized(matrix:np.ndarray)-> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+def _top_k(scores:np.ndarray, k:int)-> np.ndarray:
+    # indices of the k highest scores of each row, best first
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+_popcount = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+def _hamming(query_bits:np.ndarray, bits:np.ndarray, block_size:int = 16)-> np.ndarray:
+    # hamming distances between packed bit rows, a few queries at a time to bound the memory
+    distances = np.empty((len(query_bits), len(bits)), dtype=np.int32)
+    for i in range(0, len(query_bits), block_size):
+        block = query_bits[i:i + block_size]
+        distances[i:i + block_size] = _popcount[block[:, None, :] ^ bits[None, :, :]].sum(axis=2, dtype=np.int32)
+    return distances
+
+def compaction_report(embeddings, 
+                      k:int = 5, 
+                      no_of_queries:int = 200, 
+                      dimensions_values = (1536, 1024, 512, 256), 
+                      rerank_factors = (4, 10), 
+                      seed:int = 0) -> list:
+    """Compare compact representations of the stored embeddings against them: shortened dimensions
+    (what the model's dimensions parameter returns: the first dimensions, normalized again), halfvec (float16)
+    and a binary-quantized first pass re-ranked with the halfvec embeddings. Sampled stored embeddings are the
+    queries and the exact cosine top-k of the stored embeddings (the query itself excluded) is the reference.
+    The search is brute force in numpy: the latencies compare the representations with each other, not with pgvector.
+
+    Args:
+        embeddings (_type_): the stored embeddings, one row per chunk (see load_embeddings)
+        k (int, optional): number of results per query. Defaults to 5.
+        no_of_queries (int, optional): number of sampled query vectors. Defaults to 200.
+        dimensions_values (tuple, optional): dimensions to try, larger than the stored ones are skipped.
+        rerank_factors (tuple, optional): candidates per result of the binary first pass to try.
+        seed (int, optional): seed of the query sample. Defaults to 0.
+
+    Returns:
+        list: one dict per representation with the dimensions, bytes per vector, total MB, recall@k and mean latency in ms
+    """
+    embeddings = _normalized(np.asarray(embeddings, dtype=np.float32))
+    rows, stored_dimensions = embeddings.shape
+    k = min(k, rows - 1)
+    if k < 1:
+        return []
+    query_ids = np.random.default_rng(seed).choice(rows, min(no_of_queries, rows), replace=False)
+    exclude_self = (np.arange(len(query_ids)), query_ids)
+
+    def search(matrix, queries):
+        start = time.perf_counter()
+        scores = queries @ matrix.T
+        scores[exclude_self] = -np.inf
+        top = _top_k(scores, k)
+        return top, (time.perf_counter() - start) * 1000 / len(query_ids)
+
+    reference, _ = search(embeddings, embeddings[query_ids])
+
+    def recall(top):
+        return float(np.mean([len(set(found) & set(expected)) / k for found, expected in zip(top, reference)]))
+
+    def row(representation, dimensions, bytes_per_vector, top, latency):
+        return {"representation": representation, "dimensions": dimensions, "bytes_per_vector": bytes_per_vector, 
+                "total_mb": bytes_per_vector * rows / 1e6, "recall": recall(top), "latency_ms": latency}
+
+    # pgvector stores 8 bytes of header per value, plus 4 (vector) or 2 (halfvec) bytes per dimension
+    report = []
+    for dimensions in [value for value in dimensions_values if value <= stored_dimensions]:
+        shortened = _normalized(embeddings[:, :dimensions])
+        top, latency = search(shortened, shortened[query_ids])
+        report.append(row("vector", dimensions, 8 + 4 * dimensions, top, latency))
+        # rounded to float16 but computed in float32, as pgvector does for halfvec distances
+        half = shortened.astype(np.float16).astype(np.float32)
+        top, latency = search(half, half[query_ids])
+        report.append(row("halfvec", dimensions, 8 + 2 * dimensions, top, latency))
+
+        bits = np.packbits(shortened > 0, axis=1)
+        for rerank_factor in rerank_factors:
+            candidates = min(k * rerank_factor, rows - 1)
+            start = time.perf_counter()
+            hamming = _hamming(bits[query_ids], bits)
+            # the query is not a candidate of itself
+            hamming[exclude_self] = dimensions + 1
+            candidate_ids = np.argpartition(hamming, candidates - 1, axis=1)[:, :candidates]
+            scores = np.einsum("qd,qcd->qc", half[query_ids], half[candidate_ids])
+            top = np.take_along_axis(candidate_ids, _top_k(scores, k), axis=1)
+            latency = (time.perf_counter() - start) * 1000 / len(query_ids)
+            # the binary index is on top of the halfvec column used for the re-ranking
+            report.append(row(f"binary+rerank x{rerank_factor}", dimensions, 8 + 2 * dimensions + dimensions // 8, top, latency))
+    return report
+
+# openai utils
+def get_client():
+    """Get the OpenAI client, created on first use and again when the api key is rotated
+
+    Returns:
+        _type_: the OpenAI client
+    """
+    return _get_client(get_secret("OPENAI-API-KEY"))
+
+@lru_cache(maxsize=1)
+def _get_client(api_key:str):
+    # the retries are coordinated by the schedulers
+    return OpenAI(api_key=api_key, max_retries=0)
+
+def get_llm():
+    """Get the chat model, created on first use and again when the api key is rotated
+
+    Returns:
+        _type_: the llm model
+    """
+    return _get_llm(get_secret("OPENAI-API-KEY"))
+
+@lru_cache(maxsize=1)
+def _get_llm(api_key:str):
+    return ChatOpenAI(
+        openai_api_key=api_key,
+        model="gpt-4o-mini-2024-07-18",
+        temperature=0.1,
+        max_tokens=LLM_MAX_TOKENS,
+        stream_usage=True,
+        max_retries=0,
+    )
+
+# openai scheduler
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+# the priority of the openai requests made in the current context, see openai_priority
+_openai_priority = contextvars.ContextVar("openai_priority", default=PRIORITY_INTERACTIVE)
+
+@contextmanager
+def openai_priority(priority:int):
+    """Run the openai requests of the block (and of the tasks submitted with submit_in_context) at a priority"""
+    token = _openai_priority.set(priority)
+    try:
+        yield
+    finally:
+        _openai_priority.reset(token)
+
+def _response_tokens(response)-> int:
+    # total tokens reported by an llm message (chunk) or an embeddings response, 0 if unknown
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        return usage.get("total_tokens", 0)
+    return getattr(getattr(response, "usage", None), "total_tokens", None) or 0
+
+class OpenAIScheduler:
+    """Process-wide admission of the requests to one OpenAI model: token buckets for the requests and the
+    tokens per minute, refilled continuously. Waiting requests are admitted by priority (interactive first),
+    then in arrival order. A request takes its estimated tokens and is settled with the reported usage.
+    A 429 pauses every request of the model until its retry-after, instead of each one retrying on its own."""
+
+    def __init__(self, name:str, 
+                 requests_per_minute:int, 
+                 tokens_per_minute:int, 
+                 max_retries:int = OPENAI_MAX_RETRIES):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.requests_available = float(requests_per_minute)
+        self.tokens_available = float(tokens_per_minute)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.peak_waiting = 0
+        self.admitted = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.waits = deque(maxlen=1000)
+
+    def _refill(self, now:float):
+        elapsed = now - self.refilled_at
+        self.refilled_at = now
+        if self.requests_per_minute > 0:
+            self.requests_available = min(self.requests_per_minute, self.requests_available + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute > 0:
+            self.tokens_available = min(self.tokens_per_minute, self.tokens_available + elapsed * self.tokens_per_minute / 60)
+
+    def _admit(self, waiter, tokens:int)-> float:
+        # under the condition lock: take the request if it can go now, else the seconds to wait before trying again
+        if self.waiting[0] is not waiter:
+            return 0.05
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        delay = 0.0
+        if self.requests_per_minute > 0 and self.requests_available < 1:
+            delay = (1 - self.requests_available) * 60 / self.requests_per_minute
+        if self.tokens_per_minute > 0 and self.tokens_available < tokens:
+            delay = max(delay, (tokens - self.tokens_available) * 60 / self.tokens_per_minute)
+        if delay > 0:
+            return delay
+        self.requests_available -= 1
+        self.tokens_available -= tokens
+        heapq.heappop(self.waiting)
+        self.condition.notify_all()
+        return 0.0
+
+    def _enqueue(self, tokens:int, priority:int):
+        priority = _openai_priority.get() if priority is None else priority
+        if self.tokens_per_minute > 0:
+            tokens = min(tokens, self.tokens_per_minute)
+        waiter = [priority, next(self.sequence)]
+        with self.condition:
+            heapq.heappush(self.waiting, waiter)
+            self.peak_waiting = max(self.peak_waiting, len(self.waiting))
+        return waiter, tokens, time.monotonic()
+
+    def _dequeue(self, waiter):
+        # the waiter gave up (error or cancellation) before it was admitted
+        with self.condition:
+            if waiter in self.waiting:
+                self.waiting.remove(waiter)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def _admitted(self, started:float, throttled:bool):
+        waited = time.monotonic() - started
+        with self.condition:
+            self.admitted += 1
+            self.throttled += throttled
+            self.waits.append(waited)
+        metrics.record(f"openai_wait_{self.name}", waited)
+        return waited
+
+    def acquire(self, tokens:int = 1, priority:int = None)-> float:
+        """Wait until a request of tokens can be sent
+
+        Args:
+            tokens (int, optional): estimated tokens of the request. Defaults to 1.
+            priority (int, optional): PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND. Defaults to the one of the context.
+
+        Returns:
+            float: the seconds waited
+        """
+        waiter, tokens, started = self._enqueue(tokens, priority)
+        throttled = False
+        try:
+            with self.condition:
+                while True:
+                    delay = self._admit(waiter, tokens)
+                    if delay == 0:
+                        break
+                    throttled = True
+                    self.condition.wait(delay)
+        except BaseException:
+            self._dequeue(waiter)
+            raise
+        return self._admitted(started, throttled)
+
+    async def aacquire(self, tokens:int = 1, priority:int = None)-> float:
+        """Async variant of acquire, the event loop is not blocked while waiting"""
+        waiter, tokens, started = self._enqueue(tokens, priority)
+        throttled = False
+        try:
+            while True:
+                with self.condition:
+                    delay = self._admit(waiter, tokens)
+                if delay == 0:
+                    break
+                throttled = True
+                await asyncio.sleep(min(delay, 0.05))
+        except BaseException:
+            self._dequeue(waiter)
+            raise
+        return self._admitted(started, throttled)
+
+    def settle(self, estimated_tokens:int, used_tokens:int):
+        """Correct the tokens taken for a request with the tokens it used (ignored when unknown)"""
+        if used_tokens and self.tokens_per_minute > 0:
+            with self.condition:
+                self.tokens_available = min(self.tokens_per_minute, self.tokens_available + estimated_tokens - used_tokens)
+
+    def _retry_delay(self, error, attempt:int)-> float:
+        with self.condition:
+            self.retries += 1
+        backoff = min(2 ** attempt, 30) * random.uniform(0.5, 1.0)
+        if not isinstance(error, RateLimitError):
+            return backoff
+        metrics.count(f"openai_rate_limited_{self.name}")
+        try:
+            retry_after = float(error.response.headers.get("retry-after"))
+        except (AttributeError, TypeError, ValueError):
+            retry_after = backoff
+        with self.condition:
+            self.rate_limited += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        # acquire waits for the pause
+        return 0.0
+
+    def call(self, fun, *args, tokens:int = 1, priority:int = None, **kwargs):
+        """Call fun(*args, **kwargs) once admitted, retrying on rate limits and transient errors
+
+        Args:
+            fun (_type_): the request, e.g. chain.invoke or client.embeddings.create
+            tokens (int, optional): estimated tokens of the request. Defaults to 1.
+            priority (int, optional): PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND. Defaults to the one of the context.
+
+        Returns:
+            _type_: the response
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens, priority)
+            try:
+                response = fun(*args, **kwargs)
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._retry_delay(e, attempt))
+                continue
+            self.settle(tokens, _response_tokens(response))
+            return response
+
+    def batch(self, fun, inputs, tokens, max_concurrency:int = 8, priority:int = None, **kwargs) -> list:
+        """Call fun(input, **kwargs) for every input, max_concurrency at a time, each one admitted as call does
+
+        Args:
+            fun (_type_): the request, e.g. chain.invoke
+            inputs (_type_): list of inputs
+            tokens (_type_): estimated tokens of each request
+            max_concurrency (int, optional): requests in flight. Defaults to 8.
+            priority (int, optional): PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND. Defaults to the one of the context.
+
+        Returns:
+            list: the responses, or the exceptions raised, in the order of the inputs
+        """
+        def one(item, item_tokens):
+            try:
+                return self.call(fun, item, tokens=item_tokens, priority=priority, **kwargs)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix=f"{self.name}-batch") as executor:
+            futures = [submit_in_context(executor, one, item, item_tokens) for item, item_tokens in zip(inputs, tokens)]
+            return [future.result() for future in futures]
+
+    def stream(self, fun, *args, tokens:int = 1, priority:int = None, **kwargs):
+        """Iterate fun(*args, **kwargs) (e.g. chain.stream) once admitted, retrying as call does until the first chunk"""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens, priority)
+            used_tokens = 0
+            started = False
+            try:
+                for chunk in fun(*args, **kwargs):
+                    started = True
+                    used_tokens += _response_tokens(chunk)
+                    yield chunk
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                if started or attempt == self.max_retries:
+                    raise
+                time.sleep(self._retry_delay(e, attempt))
+                continue
+            self.settle(tokens, used_tokens)
+            return
+
+    async def astream(self, fun, *args, tokens:int = 1, priority:int = None, **kwargs):
+        """Async variant of stream (e.g. chain.astream)"""
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(tokens, priority)
+            used_tokens = 0
+            started = False
+            try:
+                async for chunk in fun(*args, **kwargs):
+                    started = True
+                    used_tokens += _response_tokens(chunk)
+                    yield chunk
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                if started or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(e, attempt))
+                continue
+            self.settle(tokens, used_tokens)
+            return
+
+    def stats(self) -> dict:
+        """Queue and wait statistics
+
+        Returns:
+            dict: requests waiting now and at most, admitted, throttled (had to wait), rate limited (429) and retried
+            requests, and the mean / p95 wait in ms of the last 1000 admitted requests
+        """
+        with self.condition:
+            waits = np.array(self.waits) * 1000 if self.waits else np.zeros(1)
+            return {"waiting": len(self.waiting), "peak_waiting": self.peak_waiting, "admitted": self.admitted, 
+                    "throttled": self.throttled, "rate_limited": self.rate_limited, "retries": self.retries, 
+                    "wait_mean_ms": float(waits.mean()), "wait_p95_ms": float(np.percentile(waits, 95))}
+
+llm_scheduler = OpenAIScheduler("llm", LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+embedding_scheduler = OpenAIScheduler("embedding", EMBEDDING_REQUESTS_PER_MINUTE, EMBEDDING_TOKENS_PER_MINUTE)
+
+def estimate_llm_tokens(inputs:dict, history:bool = True)-> int:
+    """Estimated tokens of a turn request: the inputs, the (budgeted) history and the completion
+
+    Args:
+        inputs (dict): the inputs of the prompt
+        history (bool, optional): the prompt also gets the session history. Defaults to True.
+
+    Returns:
+        int: the estimated tokens
+    """
+    return estimate_tokens(json.dumps(inputs, default=str)) + (HISTORY_TOKEN_BUDGET if history else 0) + LLM_MAX_TOKENS
+
+class EmbeddingMicroBatcher:
+    """Coalesces the small embedding requests of concurrent sessions. A caller with no request of the batcher
+    in flight sends its own at once; otherwise the first caller of a batch waits up to max_wait seconds
+    (less if the batch fills up to max_batch_size texts) and sends one request for everyone."""
+
+    def __init__(self, max_batch_size:int = EMBEDDING_MICROBATCH_SIZE, 
+                 max_wait:float = EMBEDDING_MICROBATCH_WAIT_MS / 1000):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.in_flight = 0
+        self.batches = 0
+        self.requests = 0
+
+    def embed(self, texts, client, model:str, options:dict, priority:int = None) -> list:
+        """Get the embeddings of a few texts, in a shared request
+
+        Args:
+            texts (_type_): list of texts
+            client (_type_): openai client
+            model (str): name of the model
+            options (dict): extra arguments of the request (dimensions)
+            priority (int, optional): PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND. Defaults to the one of the context.
+
+        Returns:
+            list: embeddings, in the same order as the texts
+        """
+        priority = _openai_priority.get() if priority is None else priority
+        future = Future()
+        key = (id(client), model, tuple(sorted(options.items())))
+        with self.lock:
+            self.requests += 1
+            batch = self.pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.pending[key] = {"items": [], "texts": 0, "priority": priority}
+            batch["items"].append((list(texts), future))
+            batch["texts"] += len(texts)
+            batch["priority"] = min(batch["priority"], priority)
+            # alone (nothing in flight to wait for) or full, the batch is sent right away
+            send_now = batch["texts"] >= self.max_batch_size or (leader and self.in_flight == 0)
+            if send_now:
+                del self.pending[key]
+                self.in_flight += 1
+        if send_now:
+            self._flush(batch, client, model, options)
+        elif leader:
+            time.sleep(self.max_wait)
+            with self.lock:
+                # unless it filled up and was sent meanwhile
+                flush = self.pending.get(key) is batch
+                if flush:
+                    del self.pending[key]
+                    self.in_flight += 1
+            if flush:
+                self._flush(batch, client, model, options)
+        return future.result()
+
+    def _flush(self, batch, client, model:str, options:dict):
+        with self.lock:
+            self.batches += 1
+        texts = list(dict.fromkeys(text for texts, _ in batch["items"] for text in texts))
+        try:
+            embeddings = dict(zip(texts, embedding_request(client, texts, model, options, batch["priority"])))
+        except Exception as e:
+            with self.lock:
+                self.in_flight -= 1
+            for _, future in batch["items"]:
+                future.set_exception(e)
+            return
+        with self.lock:
+            self.in_flight -= 1
+        for texts, future in batch["items"]:
+            future.set_result([embeddings[text] for text in texts])
+
+    def stats(self) -> dict:
+        """Coalescing statistics
+
+        Returns:
+            dict: number of coalesced calls, of requests sent for them and calls per request
+        """
+        with self.lock:
+            return {"calls": self.requests, "requests": self.batches, 
+                    "calls_per_request": self.requests / self.batches if self.batches else 0.0}
+
+embedding_batcher = EmbeddingMicroBatcher()
+
+def scheduler_stats() -> dict:
+    """Queue and wait statistics of the llm and embedding schedulers and of the embedding micro-batcher
+
+    Returns:
+        dict: the statistics by name
+    """
+    return {"llm": llm_scheduler.stats(), "embedding": embedding_scheduler.stats(), 
+            "embedding_batches": embedding_batcher.stats()}
+
+# templates
+# TEMPLATE 1 --------------------------------------------------------------
 character_extraction_template = PromptTemplate.from_template("""
 You are a talented expert in text understanding. 
 
-Please extract a list with characters from the story, with their names, abilities and weaknesses as a list of dictionaries with the structure 
-                                              {{"character_name": "", "character_abilites":"", "character_weaknesses":""}}. 
+Please extract a list with characters from the story, with their names, abilities and weaknesses with the structure 
+                                              {{"characters": [{{"character_name": "", "character_abilities":"", "character_weaknesses":""}}]}}. 
                                                              Do not return the response type. ONLY the response with the structure stated above, in plain text.
 
 Story: {story}
@@ -314,32 +2218,394 @@ character_advancement_memory_prompt = ChatPromptTemplate([
     MessagesPlaceholder(variable_name = "history"),
     ("human", character_advancement_question)
 ])
+# ---------------------------------------------------
+
+# -----------------------------TEMPLATE 4
+# running summary of the older turns of a session, see CachedChatMessageHistory
+history_summary_template = PromptTemplate.from_template("""
+You are keeping the log of a text adventure game. Update the summary of the game so far with the new messages.
+Keep the character, the places, the items and the decisions that matter for the rest of the story. Maximum 10 sentences.
+
+Summary so far: {summary}
+
+New messages:
+{messages}
+
+Updated summary:
+""")
+# ---------------------------------------------------
+
+# structured output, the json schemas the responses are generated with (OpenAI strict response_format)
+characters_schema = {
+    "name": "characters",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "characters": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "character_name": {"type": "string"},
+                        "character_abilities": {"type": "string"},
+                        "character_weaknesses": {"type": "string"},
+                    },
+                    "required": ["character_name", "character_abilities", "character_weaknesses"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["characters"],
+        "additionalProperties": False,
+    },
+}
+
+turn_schema = {
+    "name": "turn",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "description": {"type": "string"},
+            "actions": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["description", "actions"],
+        "additionalProperties": False,
+    },
+}
+
+def structured_llm(llm, json_schema:dict, enabled:bool = STRUCTURED_OUTPUT):
+    """Bind a json schema to the llm, so the response is generated to match it
+
+    Args:
+        llm (_type_): llm model
+        json_schema (dict): characters_schema or turn_schema
+        enabled (bool, optional): if False the llm is returned as is. Defaults to STRUCTURED_OUTPUT.
+
+    Returns:
+        _type_: the llm with the response format bound
+    """
+    if not enabled:
+        return llm
+    return llm.bind(response_format={"type": "json_schema", "json_schema": json_schema})
+
+_chains = OrderedDict()
+_chains_lock = threading.Lock()
+
+def _cached_chain(key, build):
+    # the prompt and the llm are kept in the key, so their chains can not outlive them
+    with _chains_lock:
+        chain = _chains.get(key)
+        if chain is not None:
+            _chains.move_to_end(key)
+            return chain
+    chain = build()
+    with _chains_lock:
+        chain = _chains.setdefault(key, chain)
+        while len(_chains) > CHAIN_CACHE_SIZE:
+            _chains.popitem(last=False)
+    return chain
+
+class _Identity:
+    # hashes and compares by identity, for the prompts and llms in the chain cache keys
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __hash__(self):
+        return id(self.value)
+
+    def __eq__(self, other):
+        return isinstance(other, _Identity) and other.value is self.value
+
+def get_chain(prompt, llm = None, json_schema:dict = None):
+    """Get the prompt | llm chain, built once per prompt, llm and schema and reused by every call
+
+    Args:
+        prompt (_type_): the prompt template
+        llm (_type_, optional): llm model. Defaults to get_llm().
+        json_schema (dict, optional): response schema bound with structured_llm. Defaults to None (plain text).
+
+    Returns:
+        _type_: the chain
+    """
+    llm = llm or get_llm()
+    return _cached_chain(("chain", _Identity(prompt), _Identity(llm), _Identity(json_schema)), 
+                         lambda: prompt | (structured_llm(llm, json_schema) if json_schema is not None else llm))
+
+def get_chain_with_history(prompt, input_messages_key:str, llm = None):
+    """Get the turn chain of a prompt wrapped with the session history, built once and reused by every session.
+    The session is given at call time, in configurable={"session_id": ...}.
+
+    Args:
+        prompt (_type_): the prompt template, with a "history" placeholder
+        input_messages_key (str): the input written to the history as the player's message
+        llm (_type_, optional): llm model. Defaults to get_llm().
+
+    Returns:
+        _type_: the RunnableWithMessageHistory
+    """
+    llm = llm or get_llm()
+    # get_memory is looked up at call time
+    return _cached_chain(("history", _Identity(prompt), _Identity(llm), input_messages_key), 
+                         lambda: RunnableWithMessageHistory(get_chain(prompt, llm, turn_schema), 
+                                                            lambda session_id: get_memory(session_id), 
+                                                            input_messages_key=input_messages_key, history_messages_key="history"))
+
+_code_fence = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+def _close_json(text:str)-> str:
+    # drop trailing commas and close the strings, lists and objects a truncated response left open
+    out = []
+    stack = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if stack:
+                stack.pop()
+        out.append(char)
+    if in_string:
+        if escaped:
+            out.pop()
+        out.append('"')
+    repaired = "".join(out).rstrip()
+    while repaired and repaired[-1] in ",:":
+        repaired = repaired[:-1].rstrip()
+    if repaired.endswith('"') and stack and stack[-1] == "}":
+        # a key without its value
+        key_start = repaired.rfind('"', 0, len(repaired) - 1)
+        if repaired[:key_start].rstrip().endswith(("{", ",")):
+            repaired = repaired[:key_start].rstrip().rstrip(",")
+    return repaired + "".join(reversed(stack))
+
+def repair_json(text:str):
+    """Parse a JSON response, repairing what a model commonly gets wrong instead of asking it again:
+    code fences, text around the JSON, trailing commas, python literals and truncated output
+
+    Args:
+        text (str): the raw llm output
+
+    Raises:
+        ValueError: if nothing can be recovered
+
+    Returns:
+        tuple: the parsed value and whether it had to be repaired
+    """
+    decoder = json.JSONDecoder()
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+    text = _code_fence.sub("", text.strip())
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        raise ValueError("No JSON found in the response")
+    text = text[min(starts):]
+    try:
+        return decoder.raw_decode(text)[0], True
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(text), True
+    except (ValueError, SyntaxError):
+        pass
+    try:
+        return json.loads(_close_json(text)), True
+    except ValueError:
+        raise ValueError("The response can not be repaired")
+
+def _parse_with_stats(text:str, kind:str):
+    try:
+        data, repaired = repair_json(text)
+    except ValueError:
+        metrics.count(f"{kind}_parse_failed")
+        return None
+    metrics.count(f"{kind}_parse_repaired" if repaired else f"{kind}_parse_ok")
+    return data
 
 def character_extraction_chain_fun(the_story,
                                    character_extraction_template = character_extraction_template, 
-                                   llm = llm):
+                                   llm = None):
     """Extract characters from the story
 
     Args:
         character_extraction_template (_type_): extraction of the characters from the story
-        llm (_type_): llm model
+        llm (_type_, optional): llm model. Defaults to get_llm().
         the_story (_type_): the story to extract the characters from
 
     Returns:
         _type_: name of the characters, their abilities and weaknesses
     """
-    characters_chain = character_extraction_template | llm
-    characters_response = characters_chain.invoke({"story": the_story})
+    characters_chain = get_chain(character_extraction_template, llm, characters_schema)
+    characters_response = llm_scheduler.call(characters_chain.invoke, {"story": the_story}, config=metrics.llm_config("llm_characters"), 
+                                             tokens=estimate_llm_tokens({"story": the_story}, history=False))
     characters_content = characters_response.content
     return characters_content
 
+def parse_characters(characters_content:str) -> list:
+    """Parse the output of the character extraction chain
+
+    Args:
+        characters_content (str): the raw llm output
+
+    Returns:
+        list: list of {"character_name", "character_abilities", "character_weaknesses"} dicts, empty if it can not be parsed
+    """
+    data = _parse_with_stats(characters_content, "characters")
+    if isinstance(data, dict):
+        data = data["characters"] if isinstance(data.get("characters"), list) else [data]
+    if not isinstance(data, list):
+        return []
+    characters = []
+    for item in data:
+        if not isinstance(item, dict) or not item.get("character_name"):
+            continue
+        characters.append({"character_name": str(item["character_name"]).strip(), 
+                           "character_abilities": item.get("character_abilities", item.get("character_abilites", "")), 
+                           "character_weaknesses": item.get("character_weaknesses", "")})
+    return characters
+
+def merge_characters(characters_lists) -> list:
+    """Merge the characters extracted from several chunks, deduplicating them by name
+
+    Args:
+        characters_lists (_type_): lists of characters
+
+    Returns:
+        list: merged list of characters, in order of first appearance
+    """
+    merged = {}
+    for characters in characters_lists:
+        for character in characters:
+            entry = merged.setdefault(character["character_name"].lower(), 
+                                      {"character_name": character["character_name"], 
+                                       "character_abilities": [], "character_weaknesses": []})
+            for key in ("character_abilities", "character_weaknesses"):
+                value = str(character.get(key) or "").strip()
+                if value and value not in entry[key]:
+                    entry[key].append(value)
+    return [{"character_name": entry["character_name"], 
+             "character_abilities": "; ".join(entry["character_abilities"]), 
+             "character_weaknesses": "; ".join(entry["character_weaknesses"])} for entry in merged.values()]
+
+def extract_characters(the_story:str, 
+                       llm = None, 
+                       chunk_tokens:int = CHARACTER_EXTRACTION_CHUNK_TOKENS, 
+                       max_concurrency:int = CHARACTER_EXTRACTION_CONCURRENCY, 
+                       tries:int = 5) -> list:
+    """Extract the characters of a story. Long stories are split in chunks that are extracted concurrently
+    (map) and then merged and deduplicated (reduce), so the latency stays roughly flat with the story size.
+
+    Args:
+        the_story (str): the story
+        llm (_type_, optional): llm model. Defaults to get_llm().
+        chunk_tokens (int, optional): estimated tokens per chunk. Defaults to CHARACTER_EXTRACTION_CHUNK_TOKENS.
+        max_concurrency (int, optional): concurrent llm calls. Defaults to CHARACTER_EXTRACTION_CONCURRENCY.
+        tries (int, optional): attempts for a story or chunk that can not be parsed. Defaults to 5.
+
+    Returns:
+        list: list of characters
+    """
+    if estimate_tokens(the_story) <= chunk_tokens:
+        chunks = [the_story]
+    else:
+        chunks = [chunk.text for chunk in iter_chunks(the_story, target_tokens=chunk_tokens, overlap_tokens=0)]
+    characters_chain = get_chain(character_extraction_template, llm, characters_schema)
+    results = [[] for _ in chunks]
+    pending = list(range(len(chunks)))
+    for attempt in range(tries):
+        if attempt:
+            metrics.count("characters_llm_retries", len(pending))
+        inputs = [{"story": chunks[i]} for i in pending]
+        responses = llm_scheduler.batch(characters_chain.invoke, inputs, 
+                                        [estimate_llm_tokens(item, history=False) for item in inputs], 
+                                        max_concurrency=max_concurrency, config=metrics.llm_config("llm_characters"))
+        still_pending = []
+        for i, response in zip(pending, responses):
+            characters = [] if isinstance(response, Exception) else parse_characters(response.content)
+            if characters:
+                results[i] = characters
+            else:
+                still_pending.append(i)
+        pending = still_pending
+        if not pending:
+            break
+    return merge_characters(results)
+
+_story_characters = {}
+
+def get_story_characters(cur, conn, the_story:str, 
+                         table_name:str = "story_characters", 
+                         **extract_kwargs) -> list:
+    """Get the characters of a story, extracted once per story content hash and persisted in PostgreSQL
+
+    Args:
+        cur (_type_): cursor
+        conn (_type_): connection
+        the_story (str): the story
+        table_name (str, optional): name of the characters table. Defaults to "story_characters".
+        extract_kwargs: passed to extract_characters
+
+    Returns:
+        list: list of characters
+    """
+    story_hash = content_hash(the_story)
+    if story_hash in _story_characters:
+        return _story_characters[story_hash]
+    try:
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ("
+                    f"story_hash TEXT PRIMARY KEY, characters JSONB, created_at TIMESTAMPTZ DEFAULT now());")
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    cur.execute(f"SELECT characters FROM {table_name} WHERE story_hash = %s;", (story_hash,))
+    row = cur.fetchone()
+    if row is None:
+        characters = extract_characters(the_story, **extract_kwargs)
+        if not characters:
+            return []
+        try:
+            # another session may have extracted the same story meanwhile, keep the first list for everyone
+            cur.execute(f"INSERT INTO {table_name} (story_hash, characters) VALUES (%s, %s) "
+                        f"ON CONFLICT (story_hash) DO NOTHING;", (story_hash, json.dumps(characters)))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        cur.execute(f"SELECT characters FROM {table_name} WHERE story_hash = %s;", (story_hash,))
+        row = cur.fetchone()
+    characters = row[0]
+    _story_characters[story_hash] = characters
+    return characters
+
 def character_start_chain_memory_fun(choosen_character, fragment_list, session_id, 
                                      character_starting_point_memory_prompt = character_starting_point_memory_prompt, 
-                                     llm = llm):
+                                     llm = None):
     """Start the character chain
     Args:
         character_starting_point_memory_prompt (_type_): supply choosen_character and story
-        llm (_type_): llm model
+        llm (_type_, optional): llm model. Defaults to get_llm().
         choosen_character (_type_): the character that is choosen by the user
         the_story (_type_): the story from above
         session_id (_type_): id of the session
@@ -347,9 +2613,11 @@ def character_start_chain_memory_fun(choosen_character, fragment_list, session_i
     Returns:
         _type_: description of the surroundings and actions that user can perform
     """
-    character_start_chain = character_starting_point_memory_prompt | llm
-    chat_with_message_history = RunnableWithMessageHistory(character_start_chain, get_memory, input_messages_key="choosen_character", history_messages_key="history")
-    character_start_response = chat_with_message_history.invoke({"choosen_character": choosen_character, "fragment_list": fragment_list}, config = {"configurable": {"session_id": session_id}})
+    chat_with_message_history = get_chain_with_history(character_starting_point_memory_prompt, "choosen_character", llm)
+    inputs = {"choosen_character": choosen_character, "fragment_list": fragment_list}
+    character_start_response = llm_scheduler.call(chat_with_message_history.invoke, inputs, 
+                                                  config = metrics.llm_config("llm_start", configurable={"session_id": session_id}), 
+                                                  tokens=estimate_llm_tokens(inputs))
     character_start_content = character_start_response.content
     return character_start_content
 
@@ -357,11 +2625,11 @@ def character_start_chain_memory_fun(choosen_character, fragment_list, session_i
 def character_advancement_chain_memory_fun(choosen_character, fragment_list, session_id, 
                                            no_of_steps, choosen_action, 
                                            character_advancement_memory_prompt = character_advancement_memory_prompt, 
-                                           llm = llm):
+                                           llm = None):
     """Character advancement chain
     Args:
         character_advancement_memory_prompt (_type_): chain with the next action options & nr of steps
-        llm (_type_): llm model
+        llm (_type_, optional): llm model. Defaults to get_llm().
         choosen_character (_type_): the character that is choosen by the user
         the_story (_type_): the story from above
         session_id (_type_): id of the session
@@ -371,16 +2639,555 @@ def character_advancement_chain_memory_fun(choosen_character, fragment_list, ses
     Returns:
         _type_: description of the action and the next action options
     """
-    character_advancement_chain = character_advancement_memory_prompt | llm
-    chat_with_message_history = RunnableWithMessageHistory(character_advancement_chain, get_memory, input_messages_key="choosen_action", history_messages_key="history")
-    character_advancement_response = chat_with_message_history.invoke({"choosen_character": choosen_character, "fragment_list": fragment_list,
-                                                                       "no_of_steps": no_of_steps, "choosen_action": choosen_action}, 
-                                                                       config = {"configurable": {"session_id": session_id}})
+    chat_with_message_history = get_chain_with_history(character_advancement_memory_prompt, "choosen_action", llm)
+    inputs = {"choosen_character": choosen_character, "fragment_list": fragment_list,
+              "no_of_steps": no_of_steps, "choosen_action": choosen_action}
+    character_advancement_response = llm_scheduler.call(chat_with_message_history.invoke, inputs, 
+                                                        config = metrics.llm_config("llm_advancement", configurable={"session_id": session_id}), 
+                                                        tokens=estimate_llm_tokens(inputs))
     character_advancement_content = character_advancement_response.content
     return character_advancement_content
 
+class TurnStreamParser:
+    """Incremental parser for a streamed {"description": "", "actions": []} turn. The description is
+    decoded as far as it has arrived, the actions are set once the whole list has arrived."""
+
+    description_key = re.compile(r'"description"\s*:\s*"')
+    actions_key = re.compile(r'"actions"\s*:\s*(?=\[)')
+
+    def __init__(self):
+        self.buffer = ""
+        self.description = ""
+        self.actions = None
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, text:str):
+        """Add a streamed piece of the response
+
+        Args:
+            text (str): the new tokens
+
+        Returns:
+            TurnStreamParser: the parser
+        """
+        self.buffer += text
+        match = self.description_key.search(self.buffer)
+        if match:
+            self.description = self._partial_string(match.end())
+        if self.actions is None:
+            match = self.actions_key.search(self.buffer)
+            if match:
+                try:
+                    self.actions, _ = self._decoder.raw_decode(self.buffer, match.end())
+                except ValueError:
+                    pass
+        return self
+
+    def _partial_string(self, start:int)-> str:
+        # decode the JSON string starting at start up to its closing quote or the last complete character
+        i = start
+        end = len(self.buffer)
+        while i < end:
+            char = self.buffer[i]
+            if char == '"':
+                break
+            if char == "\\":
+                step = 6 if self.buffer[i + 1:i + 2] == "u" else 2
+                if i + step > end:
+                    break
+                i += step
+            else:
+                i += 1
+        try:
+            return json.loads('"' + self.buffer[start:i] + '"')
+        except ValueError:
+            return self.buffer[start:i]
+
+class ResponseCache:
+    """In-process LRU cache of llm turn responses with a TTL. A key holds up to variety responses: until it is
+    full a lookup is a miss (and the new response is added), then one of the variants is served at random,
+    so with variety > 1 players still get different openings and branches but they cost nothing after warm-up."""
+
+    def __init__(self, max_size:int = RESPONSE_CACHE_SIZE, 
+                 ttl:float = RESPONSE_CACHE_TTL_SECONDS, 
+                 variety:int = RESPONSE_CACHE_VARIETY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.variety = variety
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Cache key of the parts that determine a response
+
+        Returns:
+            str: sha256 hex digest
+        """
+        return content_hash(json.dumps(parts, default=str))
+
+    def get(self, key:str):
+        """A cached response, None if the key has fewer than variety responses or they expired
+
+        Args:
+            key (str): cache key
+
+        Returns:
+            _type_: one of the cached responses or None
+        """
+        if self.max_size <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None or entry[2] < self.variety:
+                self.misses += 1
+                metrics.count("response_cache_misses")
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        metrics.count("response_cache_hits")
+        return random.choice(entry[1])
+
+    def put(self, key:str, content:str):
+        """Add a response variant
+
+        Args:
+            key (str): cache key
+            content (str): the llm response
+        """
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                # created, distinct variants, responses added (a deterministic model may repeat itself)
+                entry = self.entries[key] = [time.monotonic(), [], 0]
+            if entry[2] < self.variety:
+                entry[2] += 1
+                if content not in entry[1]:
+                    entry[1].append(content)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Hit statistics of the cache
+
+        Returns:
+            dict: hits, misses, hit rate and number of keys
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "keys": len(self.entries), 
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+response_cache = ResponseCache()
+
+_prompt_hashes_lock = threading.Lock()
+_prompt_hashes = OrderedDict()
+
+def _prompt_hash(prompt)-> str:
+    # the prompt is kept in the key, so its id can not be reused by another prompt while the hash is cached
+    key = _Identity(prompt)
+    with _prompt_hashes_lock:
+        prompt_hash = _prompt_hashes.get(key)
+        if prompt_hash is not None:
+            _prompt_hashes.move_to_end(key)
+            return prompt_hash
+    prompt_hash = content_hash(prompt.pretty_repr())
+    with _prompt_hashes_lock:
+        _prompt_hashes[key] = prompt_hash
+        while len(_prompt_hashes) > CHAIN_CACHE_SIZE:
+            _prompt_hashes.popitem(last=False)
+    return prompt_hash
+
+def _turn_cache_key(cache, story_hash, prompt, choosen_character, fragment_list, session_id, 
+                    no_of_steps = None, choosen_action = None):
+    # the start turn only depends on the story, the character and its fragments; an advancement also on the
+    # action, the steps left and everything played so far
+    if cache is None or story_hash is None:
+        return None
+    fragments_hash = content_hash(json.dumps(list(fragment_list), default=str))
+    if choosen_action is None:
+        return cache.key(story_hash, _prompt_hash(prompt), choosen_character, fragments_hash)
+    return cache.key(story_hash, _prompt_hash(prompt), choosen_character, fragments_hash, 
+                     choosen_action, no_of_steps, get_memory(session_id).digest())
+
+def _cached_turn(cache, cache_key, session_id, input_message):
+    content = cache.get(cache_key) if cache_key is not None else None
+    if content is None:
+        return None
+    # write the history as RunnableWithMessageHistory would have
+    get_memory(session_id).add_messages([HumanMessage(content=input_message), AIMessage(content=content)])
+    return TurnStreamParser().feed(content)
+
+def _cache_turn(cache, cache_key, parser):
+    if cache_key is None or parser is None:
+        return
+    try:
+        data, _ = repair_json(parser.buffer)
+    except ValueError:
+        return
+    # a truncated turn without actions is not replayed from the cache
+    if isinstance(data, dict) and data.get("description") and data.get("actions"):
+        cache.put(cache_key, parser.buffer)
+
+def _stream_turn(chain_with_history, inputs:dict, session_id, stage:str, 
+                 cache = None, cache_key = None, input_message = None):
+    parser = _cached_turn(cache, cache_key, session_id, input_message)
+    if parser is not None:
+        yield parser
+        return
+    parser = TurnStreamParser()
+    for chunk in llm_scheduler.stream(chain_with_history.stream, inputs, 
+                                      config = metrics.llm_config(stage, configurable={"session_id": session_id}), 
+                                      tokens=estimate_llm_tokens(inputs)):
+        yield parser.feed(chunk.content)
+    _cache_turn(cache, cache_key, parser)
+
+def character_start_chain_memory_stream(choosen_character, fragment_list, session_id, 
+                                        character_starting_point_memory_prompt = character_starting_point_memory_prompt, 
+                                        llm = None, 
+                                        story_hash = None, 
+                                        cache = response_cache):
+    """Streaming variant of character_start_chain_memory_fun
+
+    Args:
+        choosen_character (_type_): the character that is choosen by the user
+        fragment_list (_type_): fragments from the story
+        session_id (_type_): id of the session
+        character_starting_point_memory_prompt (_type_): supply choosen_character and story
+        llm (_type_, optional): llm model. Defaults to get_llm().
+        story_hash (_type_, optional): content hash of the story, enables the response cache. Defaults to None.
+        cache (ResponseCache, optional): response cache, None to disable. Defaults to response_cache.
+
+    Yields:
+        TurnStreamParser: the parser, after each streamed chunk (buffer, description so far, actions when complete)
+    """
+    chat_with_message_history = get_chain_with_history(character_starting_point_memory_prompt, "choosen_character", llm)
+    cache_key = _turn_cache_key(cache, story_hash, character_starting_point_memory_prompt, choosen_character, fragment_list, session_id)
+    yield from _stream_turn(chat_with_message_history, 
+                            {"choosen_character": choosen_character, "fragment_list": fragment_list}, session_id, "llm_start", 
+                            cache, cache_key, choosen_character)
+
+def character_advancement_chain_memory_stream(choosen_character, fragment_list, session_id, 
+                                              no_of_steps, choosen_action, 
+                                              character_advancement_memory_prompt = character_advancement_memory_prompt, 
+                                              llm = None, 
+                                              story_hash = None, 
+                                              cache = response_cache):
+    """Streaming variant of character_advancement_chain_memory_fun
+
+    Args:
+        choosen_character (_type_): the character that is choosen by the user
+        fragment_list (_type_): fragments from the story
+        session_id (_type_): id of the session
+        no_of_steps (_type_): number of steps that the user has until the game ends
+        choosen_action (_type_): the action that the user has choosen
+        character_advancement_memory_prompt (_type_): chain with the next action options & nr of steps
+        llm (_type_, optional): llm model. Defaults to get_llm().
+        story_hash (_type_, optional): content hash of the story, enables the response cache. Defaults to None.
+        cache (ResponseCache, optional): response cache, None to disable. Defaults to response_cache.
+
+    Yields:
+        TurnStreamParser: the parser, after each streamed chunk (buffer, description so far, actions when complete)
+    """
+    chat_with_message_history = get_chain_with_history(character_advancement_memory_prompt, "choosen_action", llm)
+    cache_key = _turn_cache_key(cache, story_hash, character_advancement_memory_prompt, choosen_character, fragment_list, session_id, 
+                                no_of_steps, choosen_action)
+    yield from _stream_turn(chat_with_message_history, 
+                            {"choosen_character": choosen_character, "fragment_list": fragment_list, 
+                             "no_of_steps": no_of_steps, "choosen_action": choosen_action}, session_id, "llm_advancement", 
+                            cache, cache_key, choosen_action)
+
+async def _astream_turn(chain_with_history, inputs:dict, session_id, stage:str, 
+                        cache = None, cache_key = None, input_message = None):
+    # the history (Neo4j) and the response cache are read and written in worker threads, not on the event loop
+    parser = await asyncio.to_thread(_cached_turn, cache, cache_key, session_id, input_message)
+    if parser is not None:
+        yield parser
+        return
+    parser = TurnStreamParser()
+    async for chunk in llm_scheduler.astream(chain_with_history.astream, inputs, 
+                                             config = metrics.llm_config(stage, configurable={"session_id": session_id}), 
+                                             tokens=estimate_llm_tokens(inputs)):
+        yield parser.feed(chunk.content)
+    await asyncio.to_thread(_cache_turn, cache, cache_key, parser)
+
+async def character_start_chain_memory_astream(choosen_character, fragment_list, session_id, 
+                                               character_starting_point_memory_prompt = character_starting_point_memory_prompt, 
+                                               llm = None, 
+                                               story_hash = None, 
+                                               cache = response_cache):
+    """Async variant of character_start_chain_memory_stream, the llm call does not block the event loop
+
+    Args:
+        choosen_character (_type_): the character that is choosen by the user
+        fragment_list (_type_): fragments from the story
+        session_id (_type_): id of the session
+        character_starting_point_memory_prompt (_type_): supply choosen_character and story
+        llm (_type_, optional): llm model. Defaults to get_llm().
+        story_hash (_type_, optional): content hash of the story, enables the response cache. Defaults to None.
+        cache (ResponseCache, optional): response cache, None to disable. Defaults to response_cache.
+
+    Yields:
+        TurnStreamParser: the parser, after each streamed chunk (buffer, description so far, actions when complete)
+    """
+    chat_with_message_history = get_chain_with_history(character_starting_point_memory_prompt, "choosen_character", llm)
+    cache_key = await asyncio.to_thread(_turn_cache_key, cache, story_hash, character_starting_point_memory_prompt, 
+                                        choosen_character, fragment_list, session_id)
+    async for parser in _astream_turn(chat_with_message_history, 
+                                      {"choosen_character": choosen_character, "fragment_list": fragment_list}, session_id, "llm_start", 
+                                      cache, cache_key, choosen_character):
+        yield parser
+
+async def character_advancement_chain_memory_astream(choosen_character, fragment_list, session_id, 
+                                                     no_of_steps, choosen_action, 
+                                                     character_advancement_memory_prompt = character_advancement_memory_prompt, 
+                                                     llm = None, 
+                                                     story_hash = None, 
+                                                     cache = response_cache):
+    """Async variant of character_advancement_chain_memory_stream, the llm call does not block the event loop
+
+    Args:
+        choosen_character (_type_): the character that is choosen by the user
+        fragment_list (_type_): fragments from the story
+        session_id (_type_): id of the session
+        no_of_steps (_type_): number of steps that the user has until the game ends
+        choosen_action (_type_): the action that the user has choosen
+        character_advancement_memory_prompt (_type_): chain with the next action options & nr of steps
+        llm (_type_, optional): llm model. Defaults to get_llm().
+        story_hash (_type_, optional): content hash of the story, enables the response cache. Defaults to None.
+        cache (ResponseCache, optional): response cache, None to disable. Defaults to response_cache.
+
+    Yields:
+        TurnStreamParser: the parser, after each streamed chunk (buffer, description so far, actions when complete)
+    """
+    chat_with_message_history = get_chain_with_history(character_advancement_memory_prompt, "choosen_action", llm)
+    cache_key = await asyncio.to_thread(_turn_cache_key, cache, story_hash, character_advancement_memory_prompt, 
+                                        choosen_character, fragment_list, session_id, no_of_steps, choosen_action)
+    async for parser in _astream_turn(chat_with_message_history, 
+                                      {"choosen_character": choosen_character, "fragment_list": fragment_list, 
+                                       "no_of_steps": no_of_steps, "choosen_action": choosen_action}, session_id, "llm_advancement", 
+                                      cache, cache_key, choosen_action):
+        yield parser
+
+_history_cache = OrderedDict()
+# the CachedChatMessageHistory handle of each session, see get_memory
+_history_handles = {}
+# evicted sessions whose pending messages are still being written, taken back if the session returns
+_evicted_histories = {}
+_history_cache_lock = threading.Lock()
+_last_history_sweep = time.monotonic()
+_history_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="history")
+
+class SessionHistory:
+    """In-process state of a session history: all messages, the running summary of the older turns
+    and the messages not written to Neo4j yet"""
+
+    def __init__(self, backend, messages):
+        self.backend = backend
+        self.messages = list(messages)
+        self.summary = ""
+        self.summarized_upto = 0
+        self.summarizing = False
+        self.pending = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.evicted = False
+
+    def flush(self):
+        """Write the pending messages to Neo4j, in order"""
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if pending:
+                try:
+                    self.backend.add_messages(pending)
+                except:
+                    with self.lock:
+                        self.pending = pending + self.pending
+                    raise
+
+def _summarize_history(state:SessionHistory, upto:int, llm = None):
+    try:
+        with state.lock:
+            summary = state.summary
+            older = state.messages[state.summarized_upto:upto]
+        messages = "\n".join(f"{message.type}: {message.content}" for message in older)
+        summary_chain = get_chain(history_summary_template, llm)
+        inputs = {"summary": summary or "(empty)", "messages": messages}
+        new_summary = llm_scheduler.call(summary_chain.invoke, inputs, config=metrics.llm_config("llm_summary"), 
+                                         tokens=estimate_llm_tokens(inputs, history=False), priority=PRIORITY_BACKGROUND).content
+        with state.lock:
+            state.summary = new_summary
+            state.summarized_upto = upto
+    finally:
+        with state.lock:
+            state.summarizing = False
+
+def _flush_history(state:SessionHistory):
+    try:
+        state.flush()
+    except Exception as e:
+        print(f"Chat history write failed: {e}")
+
+def _flush_evicted(session_id, state:SessionHistory):
+    # the state is forgotten once Neo4j has all its messages, after that the session is loaded from there
+    _flush_history(state)
+    with _history_cache_lock, state.lock:
+        if state.evicted and not state.pending and _evicted_histories.get(session_id) is state:
+            del _evicted_histories[session_id]
+
+def _message_type(message)-> str:
+    # a streamed reply is stored as an AIMessageChunk, a cached one as an AIMessage: both are "ai"
+    if message.type.endswith("MessageChunk"):
+        return message.type[:-len("MessageChunk")].lower()
+    return message.type
+
+class CachedChatMessageHistory(BaseChatMessageHistory):
+    """Token-budgeted chat history of a session, kept in process. The last recent_turns turns are given to the
+    prompt verbatim and the older ones as a running summary, updated in the background. New messages are
+    written to Neo4j in batches of write_batch messages, in the background, so a turn does not wait on Neo4j."""
+
+    def __init__(self, session_id, backend = None, 
+                 recent_turns:int = HISTORY_RECENT_TURNS, 
+                 token_budget:int = HISTORY_TOKEN_BUDGET, 
+                 write_batch:int = HISTORY_WRITE_BATCH):
+        self.session_id = session_id
+        self._backend = backend
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.write_batch = write_batch
+
+    def _state(self) -> SessionHistory:
+        with _history_cache_lock:
+            state = _history_cache.get(self.session_id)
+            if state is not None:
+                _history_cache.move_to_end(self.session_id)
+                state.last_used = time.monotonic()
+                return state
+            # Neo4j may not have all the messages of an evicted session yet, its state is taken back instead
+            state = _evicted_histories.pop(self.session_id, None)
+            if state is not None:
+                state.evicted = False
+                state.last_used = time.monotonic()
+                _history_cache[self.session_id] = state
+                return state
+        backend = self._backend or Neo4jChatMessageHistory(session_id=self.session_id, graph=get_graph())
+        state = SessionHistory(backend, backend.messages)
+        with _history_cache_lock:
+            state = _history_cache.setdefault(self.session_id, state)
+        _evict_histories()
+        return state
+
+    @property
+    def messages(self):
+        state = self._state()
+        with state.lock:
+            recent_start = max(state.summarized_upto, len(state.messages) - 2 * self.recent_turns)
+            # the messages the summary does not cover yet (it is being updated) are given verbatim
+            recent = state.messages[state.summarized_upto:]
+            if recent_start > state.summarized_upto and not state.summarizing:
+                state.summarizing = True
+                submit_in_context(_history_executor, _summarize_history, state, recent_start)
+            summary = state.summary
+        budget = self.token_budget - (estimate_tokens(summary) if summary else 0)
+        kept = []
+        for message in reversed(recent):
+            budget -= estimate_tokens(message.content)
+            if budget < 0 and kept:
+                break
+            kept.append(message)
+        kept.reverse()
+        if summary:
+            kept.insert(0, SystemMessage(content=f"Summary of the game so far: {summary}"))
+        return kept
+
+    def add_messages(self, messages):
+        state = self._state()
+        with state.lock:
+            state.messages.extend(messages)
+            state.pending.extend(messages)
+            # an evicted state is not flushed again by anyone else
+            flush = len(state.pending) >= self.write_batch or state.evicted
+        if flush:
+            if state.evicted:
+                _history_executor.submit(_flush_evicted, self.session_id, state)
+            else:
+                _history_executor.submit(_flush_history, state)
+
+    def flush(self):
+        """Write the pending messages of the session to Neo4j now"""
+        self._state().flush()
+
+    def digest(self)-> str:
+        """Hash of all the messages of the session, to key responses that depend on the history
+
+        Returns:
+            str: sha256 hex digest
+        """
+        state = self._state()
+        with state.lock:
+            contents = [(_message_type(message), message.content) for message in state.messages]
+        return content_hash(json.dumps(contents))
+
+    def clear(self):
+        state = self._state()
+        state.backend.clear()
+        with _history_cache_lock:
+            _history_cache.pop(self.session_id, None)
+            _history_handles.pop(self.session_id, None)
+            _evicted_histories.pop(self.session_id, None)
+
+def _evict_histories(idle_seconds:float = HISTORY_IDLE_SECONDS, max_size:int = HISTORY_CACHE_SIZE):
+    # the least recently used sessions come first: drop those over the size or idle for too long,
+    # their pending messages are written in the background
+    evicted = []
+    with _history_cache_lock:
+        now = time.monotonic()
+        while _history_cache:
+            session_id, state = next(iter(_history_cache.items()))
+            if len(_history_cache) <= max_size and now - state.last_used <= idle_seconds:
+                break
+            del _history_cache[session_id]
+            _history_handles.pop(session_id, None)
+            state.evicted = True
+            _evicted_histories[session_id] = state
+            evicted.append((session_id, state))
+    for session_id, state in evicted:
+        _history_executor.submit(_flush_evicted, session_id, state)
+    return len(evicted)
+
+def evict_idle_histories(idle_seconds:float = HISTORY_IDLE_SECONDS)-> int:
+    """Write the idle sessions to Neo4j and drop them from memory. New sessions also do it, as they are created,
+    and get_memory every HISTORY_SWEEP_SECONDS.
+
+    Args:
+        idle_seconds (float, optional): sessions unused for longer are evicted. Defaults to HISTORY_IDLE_SECONDS.
+
+    Returns:
+        int: the number of evicted sessions
+    """
+    return _evict_histories(idle_seconds)
+
+def flush_histories():
+    """Write the pending messages of all the cached sessions to Neo4j"""
+    with _history_cache_lock:
+        states = list(_history_cache.values()) + list(_evicted_histories.values())
+    for state in states:
+        _flush_history(state)
+
+atexit.register(flush_histories)
+
 def get_memory(session_id):
-    """Get the memory for the session
+    """Get the memory for the session, the same handle for every call until the session is evicted
 
     Args:
         session_id (_type_): id of the session
@@ -388,7 +3195,17 @@ def get_memory(session_id):
     Returns:
         _type_: memory for the session
     """
-    return Neo4jChatMessageHistory(session_id=session_id, graph=graph)
+    global _last_history_sweep
+    # idle sessions are evicted even when no new session comes in, as long as any session plays
+    now = time.monotonic()
+    if now - _last_history_sweep > HISTORY_SWEEP_SECONDS:
+        _last_history_sweep = now
+        _evict_histories()
+    handle = _history_handles.get(session_id)
+    if handle is None:
+        with _history_cache_lock:
+            handle = _history_handles.setdefault(session_id, CachedChatMessageHistory(session_id))
+    return handle
 
 # for game
 def choosen_character_user(characters_list, user_choice):
@@ -406,7 +3223,8 @@ def choosen_character_user(characters_list, user_choice):
     return None
 
 def advancing(character_start_content, last_step = False):
-    """The user choice of the character 
+    """The user choice of the character. Malformed responses are repaired (see repair_json), if nothing
+    can be recovered the whole response is the description.
 
     Args:
         character_start_content (_type_): the content of the character start chain
@@ -414,10 +3232,14 @@ def advancing(character_start_content, last_step = False):
     Returns:
         _type_: the description of the surroundings and the actions that the user can perform
     """
-    data = json.loads(character_start_content)
+    data = _parse_with_stats(character_start_content, "turn")
+    if not isinstance(data, dict):
+        return {"description": character_start_content.strip(), "actions": []}
     description = data.get("description")
     actions = data.get("actions")
-    result = {"description": description, "actions": actions}
+    if not isinstance(actions, list):
+        actions = []
+    result = {"description": description, "actions": [str(action) for action in actions]}
     return result
 
 def next_actions(actions, a_no):
@@ -442,21 +3264,396 @@ def next_actions(actions, a_no):
 
     return chosen_action
 
-def get_embedding(text, client= client, 
-                  model="text-embedding-3-small"):
+# embedding cache
+def normalize_text(text:str)-> str:
+    """Normalize a text for cache keys (collapse whitespace)
+
+    Args:
+        text (str): the text
+
+    Returns:
+        str: the normalized text
+    """
+    return " ".join(text.split())
+
+class PostgresEmbeddingStore:
+    """Persistent embedding cache tier in a PostgreSQL table. Uses the connection pool unless a connection is given."""
+
+    def __init__(self, conn = None, table_name:str = "embedding_cache"):
+        self.conn = conn
+        self.table_name = table_name
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ("
+                        f"model TEXT, text_hash TEXT, embedding vector, "
+                        f"PRIMARY KEY (model, text_hash));")
+            conn.commit()
+
+    @contextmanager
+    def _connection(self):
+        if self.conn is not None:
+            yield self.conn
+        else:
+            with pooled_connection() as conn:
+                yield conn
+
+    def get_many(self, model:str, keys) -> dict:
+        # a failed checkout (pool exhausted) or query is a cache miss, not an error of the embedding request
+        try:
+            with self._connection() as conn:
+                cur = conn.cursor()
+                try:
+                    cur.execute(f"SELECT text_hash, embedding FROM {self.table_name} WHERE model = %s AND text_hash = ANY(%s);", 
+                                (model, list(keys)))
+                    return {row[0]: np.asarray(row[1], dtype=np.float32) for row in cur.fetchall()}
+                except Exception:
+                    conn.rollback()
+                    raise
+        except Exception as e:
+            print(f"Embedding cache read failed: {e}")
+            return {}
+
+    def put_many(self, model:str, items:dict):
+        rows = [(model, key, np.asarray(embedding, dtype=np.float32)) for key, embedding in items.items()]
+        try:
+            with self._connection() as conn:
+                cur = conn.cursor()
+                try:
+                    execute_values(cur, f"INSERT INTO {self.table_name} (model, text_hash, embedding) VALUES %s "
+                                        f"ON CONFLICT (model, text_hash) DO NOTHING;", rows)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+        except Exception as e:
+            print(f"Embedding cache write failed: {e}")
+
+class SqliteEmbeddingStore:
+    """Persistent embedding cache tier in a local SQLite file"""
+
+    def __init__(self, path:str = "embedding_cache.sqlite"):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS embedding_cache ("
+                              "model TEXT, text_hash TEXT, embedding BLOB, "
+                              "PRIMARY KEY (model, text_hash))")
+            self.conn.commit()
+
+    def get_many(self, model:str, keys) -> dict:
+        keys = list(keys)
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                placeholders = ", ".join("?" for _ in part)
+                rows = self.conn.execute(f"SELECT text_hash, embedding FROM embedding_cache "
+                                         f"WHERE model = ? AND text_hash IN ({placeholders})", [model] + part)
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, model:str, items:dict):
+        rows = [(model, key, np.asarray(embedding, dtype=np.float32).tobytes()) for key, embedding in items.items()]
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO embedding_cache (model, text_hash, embedding) VALUES (?, ?, ?)", rows)
+            self.conn.commit()
+
+class EmbeddingCache:
+    """Two-tier embedding cache keyed by (model, normalized text hash): an in-process LRU
+    in front of an optional persistent store (PostgresEmbeddingStore or SqliteEmbeddingStore)"""
+
+    def __init__(self, max_size:int = EMBEDDING_CACHE_SIZE, store = None):
+        self.max_size = max_size
+        self.store = store
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text:str)-> str:
+        return content_hash(normalize_text(text))
+
+    def _remember(self, model:str, key:str, embedding):
+        self.memory[(model, key)] = embedding
+        self.memory.move_to_end((model, key))
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def get_many(self, model:str, keys) -> dict:
+        """Look the keys up in memory, then in the store
+
+        Returns:
+            dict: key -> float32 embedding for the keys that were found
+        """
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                embedding = self.memory.get((model, key))
+                if embedding is None:
+                    missing.append(key)
+                else:
+                    self.memory.move_to_end((model, key))
+                    found[key] = embedding
+            self.memory_hits += len(found)
+        if missing and self.store is not None:
+            stored = self.store.get_many(model, missing)
+            with self.lock:
+                for key, embedding in stored.items():
+                    self._remember(model, key, embedding)
+                self.store_hits += len(stored)
+            found.update(stored)
+        with self.lock:
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, model:str, items:dict):
+        items = {key: np.asarray(embedding, dtype=np.float32) for key, embedding in items.items()}
+        with self.lock:
+            for key, embedding in items.items():
+                self._remember(model, key, embedding)
+        if items and self.store is not None:
+            self.store.put_many(model, items)
+
+    def stats(self) -> dict:
+        """Hit-rate statistics of the cache
+
+        Returns:
+            dict: memory hits, store hits, misses, hit rate and number of entries in memory
+        """
+        with self.lock:
+            lookups = self.memory_hits + self.store_hits + self.misses
+            hit_rate = (self.memory_hits + self.store_hits) / lookups if lookups else 0.0
+            return {"memory_hits": self.memory_hits, "store_hits": self.store_hits, "misses": self.misses, 
+                    "hit_rate": hit_rate, "size": len(self.memory)}
+
+embedding_cache = EmbeddingCache()
+
+def get_embedding(text, client = None, 
+                  model="text-embedding-3-small", 
+                  cache = embedding_cache, 
+                  dimensions:int = EMBEDDING_DIMENSIONS):
    """_summary_
 
    Args:
        text (str): the text that the user input
+       client (_type_, optional): openai client. Defaults to get_client().
        model (str, optional): Defaults to "text-embedding-3-small".
+       cache (EmbeddingCache, optional): embedding cache, None to disable. Defaults to embedding_cache.
+       dimensions (int, optional): dimensions of the embedding. Defaults to EMBEDDING_DIMENSIONS.
 
    Returns:
        _type_: embeddings
    """
-   return client.embeddings.create(input = [text], model=model).data[0].embedding
+   return get_embeddings([text], client, model, cache = cache, dimensions = dimensions)[0]
+
+def embedding_request_options(model:str, dimensions:int = EMBEDDING_DIMENSIONS)-> dict:
+    """Extra arguments of the embeddings request: the dimensions, when shorter than the model's native ones
+
+    Args:
+        model (str): name of the model
+        dimensions (int, optional): dimensions of the embeddings. Defaults to EMBEDDING_DIMENSIONS.
+
+    Returns:
+        dict: the arguments
+    """
+    if dimensions is None or dimensions == NATIVE_EMBEDDING_DIMENSIONS.get(model):
+        return {}
+    return {"dimensions": int(dimensions)}
+
+def estimate_tokens(text:str)-> int:
+    """Rough estimation of the number of tokens in a text (~4 characters per token)
+
+    Args:
+        text (str): the text to estimate
+
+    Returns:
+        int: the estimated number of tokens
+    """
+    return max(1, len(text) // 4)
+
+def batch_texts(texts, max_batch_size:int = 256, max_batch_tokens:int = 100000):
+    """Group texts into batches bounded by size and by estimated tokens
+
+    Args:
+        texts (_type_): list of texts
+        max_batch_size (int, optional): maximum number of texts per batch. Defaults to 256.
+        max_batch_tokens (int, optional): maximum estimated tokens per batch. Defaults to 100000.
+
+    Yields:
+        list: a batch of texts
+    """
+    batch = []
+    batch_tokens = 0
+    for text in texts:
+        text_tokens = estimate_tokens(text)
+        if batch and (len(batch) >= max_batch_size or batch_tokens + text_tokens > max_batch_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += text_tokens
+    if batch:
+        yield batch
+
+def embedding_request(client, texts, model:str, options:dict, priority:int = None) -> list:
+    """Send one embeddings request through the embedding scheduler
+
+    Args:
+        client (_type_): openai client
+        texts (_type_): list of texts
+        model (str): name of the model
+        options (dict): extra arguments of the request (see embedding_request_options)
+        priority (int, optional): PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND. Defaults to the one of the context.
+
+    Returns:
+        list: embeddings, in the same order as the texts
+    """
+    estimated_tokens = sum(estimate_tokens(text) for text in texts)
+    with metrics.span("embedding_request") as span:
+        response = embedding_scheduler.call(client.embeddings.create, input = texts, model=model, 
+                                            tokens=estimated_tokens, priority=priority, **options)
+        if metrics.enabled:
+            tokens = _response_tokens(response) or estimated_tokens
+            span.add_tokens(prompt_tokens=tokens, cost=tokens / 1000 * EMBEDDING_PRICE_PER_1K)
+    return [item.embedding for item in sorted(response.data, key=lambda x: x.index)]
+
+def get_embeddings(texts, client = None, 
+                   model="text-embedding-3-small", 
+                   max_batch_size:int = 256, 
+                   max_batch_tokens:int = 100000, 
+                   cache = embedding_cache, 
+                   dimensions:int = EMBEDDING_DIMENSIONS, 
+                   priority:int = None, 
+                   batcher = embedding_batcher) -> list:
+    """Get the embeddings of many texts using multi-input requests. Cached texts are not sent.
+    Requests go through the embedding scheduler; small ones are coalesced with those of other sessions.
+
+    Args:
+        texts (_type_): list of texts
+        client (_type_, optional): openai client. Defaults to get_client().
+        model (str, optional): Defaults to "text-embedding-3-small".
+        max_batch_size (int, optional): maximum number of texts per request. Defaults to 256.
+        max_batch_tokens (int, optional): maximum estimated tokens per request. Defaults to 100000.
+        cache (EmbeddingCache, optional): embedding cache, None to disable. Defaults to embedding_cache.
+        dimensions (int, optional): dimensions of the embeddings, shortened by the model. Defaults to EMBEDDING_DIMENSIONS.
+        priority (int, optional): PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND. Defaults to the one of the context.
+        batcher (EmbeddingMicroBatcher, optional): micro-batcher of the small requests, None to disable. Defaults to embedding_batcher.
+
+    Returns:
+        list: embeddings, in the same order as the texts
+    """
+    texts = list(texts)
+    options = embedding_request_options(model, dimensions)
+    # shortened embeddings are cached apart from the native ones
+    cache_model = f"{model}:{options['dimensions']}" if options else model
+    keys = [EmbeddingCache.key(text) for text in texts] if cache is not None else list(range(len(texts)))
+    found = cache.get_many(cache_model, list(dict.fromkeys(keys))) if cache is not None else {}
+
+    to_embed = {}
+    for key, text in zip(keys, texts):
+        if key not in found:
+            to_embed.setdefault(key, text)
+    missing_keys = list(to_embed.keys())
+    new_embeddings = {}
+    if missing_keys and client is None:
+        client = get_client()
+    for batch in batch_texts(list(to_embed.values()), max_batch_size, max_batch_tokens):
+        if batcher is not None and len(batch) < batcher.max_batch_size:
+            batch_embeddings = batcher.embed(batch, client, model, options, priority)
+        else:
+            batch_embeddings = embedding_request(client, batch, model, options, priority)
+        batch_keys = missing_keys[len(new_embeddings):len(new_embeddings) + len(batch)]
+        for key, embedding in zip(batch_keys, batch_embeddings):
+            new_embeddings[key] = embedding
+    if cache is not None and new_embeddings:
+        cache.put_many(cache_model, new_embeddings)
+    found.update(new_embeddings)
+
+    embeddings = []
+    for key in keys:
+        embedding = found[key]
+        embeddings.append(embedding.tolist() if isinstance(embedding, np.ndarray) else embedding)
+    return embeddings
+
+StoryChunk = namedtuple("StoryChunk", ["text", "start_offset", "end_offset"])
+
+def _chunk_cut(text:str, max_chars:int)-> int:
+    # cut at the last sentence end, else the last whitespace, in the second half of the window
+    window = text[:max_chars]
+    for separators in ((". ", "! ", "? ", ".\n", "!\n", "?\n"), (" ", "\n")):
+        cut = max(window.rfind(separator) for separator in separators)
+        if cut > max_chars // 2:
+            return cut + 1
+    return max_chars
+
+def _chunk_overlap(text:str, overlap_chars:int)-> str:
+    # the tail of a chunk that starts the next one, beginning at a word boundary
+    if overlap_chars <= 0:
+        return ""
+    tail = text[-overlap_chars:]
+    space = tail.find(" ")
+    return tail[space + 1:] if 0 <= space < len(tail) - 1 else ""
+
+def iter_chunks(story, 
+                target_tokens:int = CHUNK_TARGET_TOKENS, 
+                overlap_tokens:int = CHUNK_OVERLAP_TOKENS):
+    """Split a story into chunks of about target_tokens (~4 characters per token, as estimate_tokens),
+    merging short lines and splitting long ones at sentence or word boundaries, with overlap_tokens of
+    overlap between consecutive chunks. Works as a generator over the lines, so a file object is
+    read line by line and never held in memory as a whole.
+
+    Args:
+        story (_type_): the story, as a string or an iterable of lines (e.g. a text file object)
+        target_tokens (int, optional): estimated tokens per chunk. Defaults to CHUNK_TARGET_TOKENS.
+        overlap_tokens (int, optional): estimated tokens repeated from the previous chunk. Defaults to CHUNK_OVERLAP_TOKENS.
+
+    Yields:
+        StoryChunk: the chunk text and its start and end character offsets in the story
+    """
+    lines = io.StringIO(story) if isinstance(story, str) else story
+    max_chars = max(1, target_tokens * 4)
+    overlap_chars = min(overlap_tokens * 4, max_chars // 4)
+    buffer = ""
+    buffer_start = 0
+    carried = 0  # length of the overlap at the start of the buffer, already part of the previous chunk
+
+    def take(cut):
+        # split buffer[:cut] off as a chunk and keep its overlap tail at the start of the buffer
+        nonlocal buffer, buffer_start, carried
+        piece = buffer[:cut]
+        text = piece.strip()
+        chunk = None
+        if text:
+            start = buffer_start + len(piece) - len(piece.lstrip())
+            chunk = StoryChunk(text, start, start + len(text))
+        tail = _chunk_overlap(piece.rstrip(), overlap_chars)
+        keep_from = len(piece.rstrip()) - len(tail) if tail else cut
+        buffer_start += keep_from
+        buffer = buffer[keep_from:]
+        carried = len(tail)
+        return chunk
+
+    for line in lines:
+        if buffer[carried:].strip() and len(buffer) + len(line) > max_chars:
+            chunk = take(len(buffer))
+            if chunk is not None:
+                yield chunk
+        buffer += line
+        while len(buffer) > max_chars:
+            chunk = take(_chunk_cut(buffer, max_chars))
+            if chunk is not None:
+                yield chunk
+    if buffer[carried:].strip():
+        chunk = take(len(buffer))
+        if chunk is not None:
+            yield chunk
 
 def split_into_paragraphs(text):
-    """Split the story into paragraphs
+    """Split the story into token-sized chunks (see iter_chunks)
 
     Args:
         text (_type_): the text that the user input, in this case a story
@@ -464,12 +3661,634 @@ def split_into_paragraphs(text):
     Returns:
         _type_: splitted parapraphs 
     """
-    paragraphs = text.split("\n")
-    paragraphs = [paragraph for paragraph in paragraphs if paragraph]
-    return paragraphs
+    return [chunk.text for chunk in iter_chunks(text)]
+
+def _hashed_lines(story, hasher):
+    lines = io.StringIO(story) if isinstance(story, str) else story
+    for line in lines:
+        hasher.update(line.encode("utf-8"))
+        yield line
+
+def ingest_story(cur, conn, table_name:str, the_story, story_id:str, 
+                 client = None, 
+                 model="text-embedding-3-small", 
+                 max_batch_size:int = 256, 
+                 max_batch_tokens:int = 100000, 
+                 character_names = None, 
+                 target_tokens:int = CHUNK_TARGET_TOKENS, 
+                 overlap_tokens:int = CHUNK_OVERLAP_TOKENS, 
+                 checkpoint:bool = False, 
+                 embed_workers:int = 1, 
+                 priority:int = PRIORITY_BACKGROUND) -> dict:
+    """Chunk the story and bring its stored chunks up to date: only new or changed chunks are embedded,
+    chunks that are gone are deleted, the rest is kept (with updated offsets). Other stories are not touched.
+    The story is chunked as a stream and embedded batch by batch, all in one transaction, under story_lock.
+    With checkpoint, every batch is committed as soon as it is stored and the story is marked "ingesting" until
+    it is complete: after a failure, running it again only embeds the batches that were not committed.
+
+    Args:
+        cur (_type_): cursor
+        conn (_type_): connection
+        table_name (str): name of the table
+        the_story (_type_): the story, as a string or a text file object
+        story_id (str): id of the story
+        client (_type_, optional): openai client. Defaults to get_client().
+        model (str, optional): Defaults to "text-embedding-3-small".
+        max_batch_size (int, optional): maximum number of texts per request. Defaults to 256.
+        max_batch_tokens (int, optional): maximum estimated tokens per request. Defaults to 100000.
+        character_names (_type_, optional): characters to build the mention index for. Defaults to None.
+        target_tokens (int, optional): estimated tokens per chunk. Defaults to CHUNK_TARGET_TOKENS.
+        overlap_tokens (int, optional): estimated tokens of overlap between chunks. Defaults to CHUNK_OVERLAP_TOKENS.
+        checkpoint (bool, optional): commit every batch, mark the story ready only when complete. Defaults to False.
+        embed_workers (int, optional): batches embedded concurrently. Defaults to 1.
+        priority (int, optional): priority of the embedding requests, behind the game turns. Defaults to PRIORITY_BACKGROUND.
 
-def get_similar_to_action(cur, table_name, text, client = client):
+    Returns:
+        dict: number of inserted, reused and deleted rows, elapsed seconds and rows per second
+    """
+    with story_lock(cur, conn, table_name, story_id):
+        return _ingest_story(cur, conn, table_name, the_story, story_id, client, model, max_batch_size, 
+                             max_batch_tokens, character_names, target_tokens, overlap_tokens, 
+                             checkpoint, embed_workers, priority)
+
+def _ingest_story(cur, conn, table_name, the_story, story_id, client, model, max_batch_size, 
+                  max_batch_tokens, character_names, target_tokens, overlap_tokens, 
+                  checkpoint, embed_workers, priority) -> dict:
+    start = time.perf_counter()
+    cur.execute(f"SELECT content_hash FROM {table_name} WHERE story_id = %s;", (story_id,))
+    stored_hashes = {row[0] for row in cur.fetchall()}
+    story_hasher = hashlib.sha256()
+    seen_hashes = set()
+    new_chunks = []
+    offset_updates = []
+    in_flight = deque()
+    rows = 0
+
+    def store_batch():
+        # batches are stored in order, on this thread, the embedding requests run in the executor
+        chunks, future = in_flight.popleft()
+        inserted = insert_story_embeddings_bulk(cur, conn, table_name, 
+                                                [(chunk.text, embedding, chunk.start_offset, chunk.end_offset) 
+                                                 for chunk, embedding in zip(chunks, future.result())], 
+                                                story_id, commit=False)
+        if checkpoint:
+            cur.execute(f"UPDATE {table_name}_stories SET chunks_done = chunks_done + %s, updated_at = now() "
+                        f"WHERE story_id = %s;", (len(chunks), story_id))
+            conn.commit()
+        return inserted
+
+    def submit_batch(executor):
+        chunks = list(new_chunks)
+        new_chunks.clear()
+        in_flight.append((chunks, executor.submit(get_embeddings, [chunk.text for chunk in chunks], 
+                                                  client, model, max_batch_size, max_batch_tokens, 
+                                                  priority=priority, batcher=None)))
+        return store_batch() if len(in_flight) >= embed_workers else 0
+
+    try:
+        if checkpoint:
+            cur.execute(f"INSERT INTO {table_name}_stories (story_id, status, chunks_done, updated_at) "
+                        f"VALUES (%s, 'ingesting', 0, now()) "
+                        f"ON CONFLICT (story_id) DO UPDATE SET status = 'ingesting', chunks_done = 0, updated_at = now();", 
+                        (story_id,))
+            conn.commit()
+        with ThreadPoolExecutor(max_workers=max(1, embed_workers), thread_name_prefix="embedding") as executor:
+            for chunk in iter_chunks(_hashed_lines(the_story, story_hasher), target_tokens, overlap_tokens):
+                chunk_hash = content_hash(chunk.text)
+                if chunk_hash in seen_hashes:
+                    continue
+                seen_hashes.add(chunk_hash)
+                if chunk_hash in stored_hashes:
+                    offset_updates.append((chunk_hash, chunk.start_offset, chunk.end_offset))
+                else:
+                    new_chunks.append(chunk)
+                    if len(new_chunks) >= max_batch_size:
+                        rows += submit_batch(executor)
+            if new_chunks:
+                rows += submit_batch(executor)
+            while in_flight:
+                rows += store_batch()
+
+        stale_hashes = [chunk_hash for chunk_hash in stored_hashes if chunk_hash not in seen_hashes]
+        if stale_hashes:
+            cur.execute(f"DELETE FROM {table_name} WHERE story_id = %s AND content_hash = ANY(%s);", (story_id, stale_hashes))
+        if offset_updates:
+            execute_values(cur, f"UPDATE {table_name} AS s SET start_offset = v.start_offset, end_offset = v.end_offset "
+                                f"FROM (VALUES %s) AS v (story_id, content_hash, start_offset, end_offset) "
+                                f"WHERE s.story_id = v.story_id AND s.content_hash = v.content_hash;", 
+                           [(story_id,) + update for update in offset_updates], page_size=500)
+        cur.execute(f"INSERT INTO {table_name}_stories (story_id, story_hash, chunk_count, status, chunks_done, updated_at) "
+                    f"VALUES (%s, %s, %s, 'ready', %s, now()) "
+                    f"ON CONFLICT (story_id) DO UPDATE SET story_hash = EXCLUDED.story_hash, "
+                    f"chunk_count = EXCLUDED.chunk_count, status = 'ready', chunks_done = EXCLUDED.chunks_done, "
+                    f"updated_at = EXCLUDED.updated_at;", 
+                    (story_id, story_hasher.hexdigest(), len(seen_hashes), len(seen_hashes)))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+    cur.execute(f"SELECT DISTINCT m.character_name FROM {table_name}_mentions m JOIN {table_name} s USING (chunk_id) "
+                f"WHERE s.story_id = %s UNION SELECT character_name FROM {table_name}_mentions_indexed WHERE story_id = %s;", 
+                (story_id, story_id))
+    indexed_names = [row[0] for row in cur.fetchall()]
+    mention_names = list(dict.fromkeys([name.lower() for name in (character_names or []) if name] + indexed_names))
+    if mention_names:
+        build_mention_index(cur, conn, table_name, mention_names, story_id)
+
+    elapsed = time.perf_counter() - start
+    rows_per_sec = rows / elapsed if elapsed > 0 else 0.0
+    return {"rows": rows, "reused": len(seen_hashes) - rows, "deleted": len(stale_hashes), 
+            "seconds": elapsed, "rows_per_sec": rows_per_sec}
+
+def get_similar_to_action(cur, table_name, text, client = None, story_id = None):
     action_embedding = np.array(get_embedding(text, client))
-    action_similar = get_similar(cur, table_name, action_embedding)
+    action_similar = get_similar(cur, table_name, action_embedding, story_id=story_id)
     return action_similar
 
+# retrieval backends
+class RetrievalBackend(ABC):
+    """Interface of the retrieval backends: story ingestion, exact (character mention) match and vector search"""
+
+    @abstractmethod
+    def has_story(self, story_id:str, story_hash:str = None)-> bool:
+        ...
+
+    @abstractmethod
+    def ingest(self, the_story:str, story_id:str, character_names = None, **kwargs) -> dict:
+        ...
+
+    @abstractmethod
+    def get_exact_match(self, character_name:str, story_id:str, top_k:int = 3) -> list:
+        ...
+
+    @abstractmethod
+    def get_similar_batch(self, vectors, story_id:str = None, k:int = 5) -> list:
+        ...
+
+    def get_similar(self, vector, story_id:str = None, k:int = 5) -> list:
+        return self.get_similar_batch([vector], story_id, k)[0]
+
+    def get_hybrid(self, character_name:str, vector, story_id:str, 
+                   lexical_k:int = 3, 
+                   vector_k:int = 5, 
+                   token_budget:int = HYBRID_TOKEN_BUDGET) -> list:
+        return fuse_fragments([self.get_exact_match(character_name, story_id, lexical_k), 
+                               self.get_similar(vector, story_id, vector_k)], token_budget=token_budget)
+
+class PgVectorBackend(RetrievalBackend):
+    """PostgreSQL + pgvector backend, on pooled connections"""
+
+    def __init__(self, table_name:str = "story_embeddings", 
+                 ef_search:int = HNSW_EF_SEARCH, 
+                 probes:int = IVFFLAT_PROBES, 
+                 rerank_factor:int = BINARY_RERANK_FACTOR, 
+                 dimensions:int = EMBEDDING_DIMENSIONS, 
+                 storage:str = EMBEDDING_STORAGE):
+        self.table_name = table_name
+        self.ef_search = ef_search
+        self.probes = probes
+        self.rerank_factor = rerank_factor
+        self.dimensions = dimensions
+        self.storage = storage
+
+    def _get_similar(self, cur, vector, story_id:str, k:int) -> list:
+        return get_similar(cur, self.table_name, np.asarray(vector), k, self.ef_search, self.probes, story_id=story_id, 
+                           rerank_factor=self.rerank_factor, dimensions=self.dimensions, storage=self.storage)
+
+    def has_story(self, story_id:str, story_hash:str = None)-> bool:
+        with metrics.span("sql_has_story"), pooled_connection() as conn:
+            cur = conn.cursor()
+            if story_hash is not None:
+                return check_if_story_is_current(cur, self.table_name, story_id, story_hash)
+            if not check_if_table_exists(cur, f"{self.table_name}_stories"):
+                return False
+            cur.execute(f"SELECT EXISTS (SELECT FROM {self.table_name}_stories WHERE story_id = %s);", (story_id,))
+            return cur.fetchone()[0]
+
+    def ingest(self, the_story:str, story_id:str, character_names = None, **kwargs) -> dict:
+        with metrics.span("sql_ingest"), pooled_connection() as conn:
+            cur = conn.cursor()
+            create_table(cur, conn, self.table_name, self.dimensions, self.storage)
+            ingest_stats = ingest_story(cur, conn, self.table_name, the_story, story_id, 
+                                        character_names=character_names, **kwargs)
+            create_vector_index(cur, conn, self.table_name, binary=self.rerank_factor > 0, 
+                                dimensions=self.dimensions, storage=self.storage)
+        return ingest_stats
+
+    def get_exact_match(self, character_name:str, story_id:str, top_k:int = 3) -> list:
+        with metrics.span("sql_exact_match"), pooled_connection() as conn:
+            return get_exact_match(conn.cursor(), self.table_name, character_name, story_id, top_k)
+
+    def get_similar(self, vector, story_id:str = None, k:int = 5) -> list:
+        with metrics.span("sql_similar"), pooled_connection() as conn:
+            return self._get_similar(conn.cursor(), vector, story_id, k)
+
+    def get_similar_batch(self, vectors, story_id:str = None, k:int = 5) -> list:
+        with metrics.span("sql_similar_batch"), pooled_connection() as conn:
+            cur = conn.cursor()
+            return [self._get_similar(cur, vector, story_id, k) for vector in vectors]
+
+    def get_hybrid(self, character_name:str, vector, story_id:str, 
+                   lexical_k:int = 3, 
+                   vector_k:int = 5, 
+                   token_budget:int = HYBRID_TOKEN_BUDGET) -> list:
+        with metrics.span("sql_hybrid"), pooled_connection() as conn:
+            return get_hybrid(conn.cursor(), self.table_name, character_name, np.asarray(vector), story_id, 
+                              lexical_k, vector_k, token_budget=token_budget, 
+                              ef_search=self.ef_search, probes=self.probes, storage=self.storage)
+
+class NumpyBackend(RetrievalBackend):
+    """In-process backend: per story, the normalized float32 embeddings in a memory-mapped .npy matrix and
+    the paragraphs in a json file. Top-k is a matmul + argpartition, for one or many queries at once.
+    No network hop, and nothing but a directory is needed, so it also runs offline."""
+
+    def __init__(self, directory:str = NUMPY_BACKEND_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.stories = {}
+        self.mentions = {}
+
+    def _name(self, story_id:str)-> str:
+        return re.sub(r"[^\w.-]", "_", story_id)
+
+    def _meta_path(self, story_id:str)-> str:
+        return os.path.join(self.directory, self._name(story_id) + ".json")
+
+    def _story_ids(self)-> list:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[:-len(".json")] for name in os.listdir(self.directory) if name.endswith(".json"))
+
+    def _load(self, story_id:str):
+        with self.lock:
+            story = self.stories.get(story_id)
+        if story is None:
+            meta_path = self._meta_path(story_id)
+            if not os.path.exists(meta_path):
+                return None
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            # the meta names the matrix it was written with (older ones: <story>.npy)
+            matrix_path = os.path.join(self.directory, meta.get("matrix", self._name(story_id) + ".npy"))
+            matrix = np.load(matrix_path, mmap_mode="r")
+            if matrix.shape[0] != len(meta["texts"]):
+                raise ValueError(f"{matrix_path} holds {matrix.shape[0]} embeddings for {len(meta['texts'])} paragraphs, "
+                                 f"ingest {story_id} again")
+            story = {"matrix": matrix, "texts": meta["texts"], "story_hash": meta["story_hash"], "matrix_path": matrix_path}
+            with self.lock:
+                self.stories[story_id] = story
+        return story
+
+    def has_story(self, story_id:str, story_hash:str = None)-> bool:
+        story = self._load(story_id)
+        return story is not None and (story_hash is None or story["story_hash"] == story_hash)
+
+    def add_story(self, story_id:str, texts, embeddings, story_hash:str = None):
+        """Store the paragraphs and embeddings of a story, replacing the previous version. The matrix is written
+        to a new file and the meta, naming it, replaces the previous one last: readers see either version, whole.
+
+        Args:
+            story_id (str): id of the story
+            texts (_type_): paragraphs
+            embeddings (_type_): their embeddings
+            story_hash (str, optional): content hash of the story. Defaults to None.
+        """
+        matrix = np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1, norms)
+        os.makedirs(self.directory, exist_ok=True)
+        previous = self._load(story_id)
+        matrix_name = f"{self._name(story_id)}.{uuid.uuid4().hex[:12]}.npy"
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+            np.save(f, matrix)
+        os.replace(f.name, os.path.join(self.directory, matrix_name))
+        with tempfile.NamedTemporaryFile("w", dir=self.directory, delete=False, encoding="utf-8") as f:
+            json.dump({"story_hash": story_hash, "matrix": matrix_name, "texts": list(texts)}, f)
+        os.replace(f.name, self._meta_path(story_id))
+        with self.lock:
+            # a search over all the stories loads them by file name
+            for key in (story_id, self._name(story_id)):
+                self.stories.pop(key, None)
+            self.mentions = {key: value for key, value in self.mentions.items() if key[0] != story_id}
+        if previous is not None:
+            # memory maps of the previous matrix stay valid after the unlink
+            try:
+                os.remove(previous["matrix_path"])
+            except OSError:
+                pass
+
+    def ingest(self, the_story:str, story_id:str, character_names = None, **kwargs) -> dict:
+        # the paragraphs of the stored version keep their embeddings, only new ones are embedded
+        start = time.perf_counter()
+        texts = list(dict.fromkeys(split_into_paragraphs(the_story)))
+        previous = self._load(story_id)
+        stored = {text: i for i, text in enumerate(previous["texts"])} if previous is not None else {}
+        new_texts = [text for text in texts if text not in stored]
+        kwargs = {"priority": PRIORITY_BACKGROUND, "batcher": None, **kwargs}
+        new_embeddings = dict(zip(new_texts, get_embeddings(new_texts, **kwargs))) if new_texts else {}
+        embeddings = [previous["matrix"][stored[text]] if text in stored else new_embeddings[text] for text in texts]
+        self.add_story(story_id, texts, embeddings, content_hash(the_story))
+        elapsed = time.perf_counter() - start
+        kept = set(texts)
+        return {"rows": len(new_texts), "reused": len(texts) - len(new_texts), 
+                "deleted": sum(1 for text in stored if text not in kept), 
+                "seconds": elapsed, "rows_per_sec": len(new_texts) / elapsed if elapsed > 0 else 0.0}
+
+    def get_exact_match(self, character_name:str, story_id:str, top_k:int = 3) -> list:
+        story = self._load(story_id)
+        if story is None:
+            return []
+        key = (story_id, character_name.lower())
+        with self.lock:
+            ranked = self.mentions.get(key)
+        if ranked is None:
+            counts = [(count_a_in_b(character_name, text), i) for i, text in enumerate(story["texts"])]
+            ranked = [i for count, i in sorted(counts, key=lambda x: x[0], reverse=True) if count > 0]
+            with self.lock:
+                self.mentions[key] = ranked
+        return [story["texts"][i] for i in ranked[:top_k]]
+
+    @staticmethod
+    def _top_k(story:dict, queries, k:int) -> list:
+        # the k best (score, text) of each query, best first
+        scores = queries @ story["matrix"].T
+        k = min(k, scores.shape[1])
+        if k == 0:
+            return [[] for _ in queries]
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return [[(float(top_scores[row, j]), story["texts"][top[row, j]]) for j in order[row]] for row in range(len(queries))]
+
+    def get_similar_batch(self, vectors, story_id:str = None, k:int = 5) -> list:
+        # without a story id, all the stored stories are searched
+        story_ids = [story_id] if story_id is not None else self._story_ids()
+        stories = [story for story in map(self._load, story_ids) if story is not None]
+        if not stories:
+            return [[] for _ in vectors]
+        queries = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+        if len(stories) == 1:
+            return [[text for _, text in row] for row in self._top_k(stories[0], queries, k)]
+        per_story = [self._top_k(story, queries, k) for story in stories]
+        return [[text for _, text in heapq.nlargest(k, itertools.chain.from_iterable(rows), key=lambda x: x[0])] 
+                for rows in zip(*per_story)]
+
+@lru_cache(maxsize=None)
+def get_retrieval_backend(name:str = RETRIEVAL_BACKEND, table_name:str = "story_embeddings")-> RetrievalBackend:
+    """Get the retrieval backend, created once
+
+    Args:
+        name (str, optional): "pgvector" or "numpy". Defaults to RETRIEVAL_BACKEND.
+        table_name (str, optional): name of the table, for pgvector. Defaults to "story_embeddings".
+
+    Returns:
+        RetrievalBackend: the retrieval backend
+    """
+    if name == "pgvector":
+        return PgVectorBackend(table_name)
+    if name == "numpy":
+        return NumpyBackend()
+    raise ValueError(f"Unknown retrieval backend: {name}")
+
+_retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+def _timed(timings:dict, name:str, fun, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return fun(*args, **kwargs)
+    finally:
+        timings[name] = time.perf_counter() - start
+        metrics.record(f"retrieval_{name}", timings[name])
+
+def _exact_match_stage(timings, backend, character_name, story_id, top_k):
+    return _timed(timings, "exact_match", backend.get_exact_match, character_name, story_id, top_k)
+
+def _hybrid_stage(timings, backend, character_name, action_text, story_id, top_k, k, token_budget, client):
+    action_embedding = np.array(_timed(timings, "embedding", get_embedding, action_text, client))
+    return _timed(timings, "hybrid_search", backend.get_hybrid, character_name, action_embedding, story_id, 
+                  top_k, k, token_budget)
+
+def _history_stage(timings, session_id):
+    return _timed(timings, "history", lambda: get_memory(session_id).messages)
+
+def retrieve_turn_context(backend:RetrievalBackend, character_name:str, action_text:str, story_id:str, 
+                          session_id = None, 
+                          exact_fragments = None, 
+                          top_k:int = 3, 
+                          k:int = 5, 
+                          token_budget:int = HYBRID_TOKEN_BUDGET, 
+                          client = None, 
+                          prefetcher = None) -> dict:
+    """Retrieval stage of a game turn. The action embedding + hybrid search (character mentions and vector hits
+    in one backend call, fused with reciprocal rank fusion) and the chat history load run concurrently.
+    When the action was prefetched, its vector hits are fused with the character fragments instead.
+
+    Args:
+        backend (RetrievalBackend): the retrieval backend
+        character_name (str): the choosen character
+        action_text (str): the choosen action
+        story_id (str): id of the story
+        session_id (_type_, optional): id of the session, to prefetch its history. Defaults to None.
+        exact_fragments (_type_, optional): already known character fragments, used with prefetched hits. Defaults to None.
+        top_k (int, optional): number of character mention hits. Defaults to 3.
+        k (int, optional): number of vector hits. Defaults to 5.
+        token_budget (int, optional): maximum estimated tokens of the fragments. Defaults to HYBRID_TOKEN_BUDGET.
+        client (_type_, optional): openai client. Defaults to get_client().
+        prefetcher (ActionPrefetcher, optional): where prefetched similar fragments are looked up. Defaults to action_prefetcher.
+
+    Returns:
+        dict: "fragments" (fused, without duplicates), "history" (or None) and per-stage "timings" in seconds
+    """
+    start = time.perf_counter()
+    timings = {}
+    prefetcher = prefetcher or action_prefetcher
+    similar_fragments = prefetcher.similar(session_id, action_text) if session_id is not None else None
+    history_future = submit_in_context(_retrieval_executor, _history_stage, timings, session_id) if session_id is not None else None
+
+    if similar_fragments is not None:
+        timings["prefetched"] = True
+        if exact_fragments is None:
+            exact_fragments = _exact_match_stage(timings, backend, character_name, story_id, top_k)
+        fragments = fuse_fragments([list(exact_fragments), similar_fragments], token_budget=token_budget)
+    else:
+        fragments = _hybrid_stage(timings, backend, character_name, action_text, story_id, top_k, k, token_budget, client)
+    history = history_future.result() if history_future is not None else None
+    timings["total"] = time.perf_counter() - start
+    metrics.record("retrieval_total", timings["total"])
+    return {"fragments": fragments, "history": history, "timings": timings}
+
+def speculate_advancement(choosen_character, fragment_list, session_id, 
+                          no_of_steps, choosen_action, 
+                          character_advancement_memory_prompt = character_advancement_memory_prompt, 
+                          llm = None):
+    """Generate the advancement for an action without writing it to the session history.
+    Use commit_advancement if the player picks that action.
+
+    Args:
+        choosen_character (_type_): the character that is choosen by the user
+        fragment_list (_type_): fragments from the story
+        session_id (_type_): id of the session
+        no_of_steps (_type_): number of steps that the user has until the game ends
+        choosen_action (_type_): the candidate action
+        character_advancement_memory_prompt (_type_): chain with the next action options & nr of steps
+        llm (_type_, optional): llm model. Defaults to get_llm().
+
+    Returns:
+        _type_: description of the action and the next action options
+    """
+    character_advancement_chain = get_chain(character_advancement_memory_prompt, llm, turn_schema)
+    inputs = {"choosen_character": choosen_character, "fragment_list": fragment_list,
+              "no_of_steps": no_of_steps, "choosen_action": choosen_action, 
+              "history": get_memory(session_id).messages}
+    # a guess, it waits behind the turns the players are waiting for
+    character_advancement_response = llm_scheduler.call(character_advancement_chain.invoke, inputs, 
+                                                        config=metrics.llm_config("llm_speculative"), 
+                                                        tokens=estimate_llm_tokens(inputs, history=False), 
+                                                        priority=PRIORITY_BACKGROUND)
+    return character_advancement_response.content
+
+def commit_advancement(session_id, choosen_action, character_advancement_content):
+    """Write a speculative advancement to the session history, as the advancement chain would have
+
+    Args:
+        session_id (_type_): id of the session
+        choosen_action (_type_): the action that the user has choosen
+        character_advancement_content (_type_): the speculative advancement
+    """
+    get_memory(session_id).add_messages([HumanMessage(content=choosen_action), AIMessage(content=character_advancement_content)])
+
+class ActionPrefetcher:
+    """Speculative retrieval for the actions offered to a player. As soon as the actions are shown, all of them
+    are embedded in one batched request and searched, in the background; optionally the advancement of the
+    first actions is also pre-generated, capped by a process-wide budget of llm calls per minute."""
+
+    def __init__(self, executor = _prefetch_executor, 
+                 max_sessions:int = HISTORY_CACHE_SIZE, 
+                 speculative_actions:int = PREFETCH_SPECULATIVE_ACTIONS, 
+                 llm_budget_per_minute:int = PREFETCH_LLM_BUDGET_PER_MINUTE):
+        self.executor = executor
+        self.max_sessions = max_sessions
+        self.speculative_actions = speculative_actions
+        self.llm_budget_per_minute = llm_budget_per_minute
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+        self.llm_calls = deque()
+        self.similar_hits = 0
+        self.similar_misses = 0
+        self.continuation_hits = 0
+        self.continuation_misses = 0
+        self.budget_skips = 0
+
+    def prefetch(self, session_id, actions, backend:RetrievalBackend, story_id:str, 
+                 k:int = 5, 
+                 choosen_character = None, 
+                 exact_fragments = None, 
+                 no_of_steps = None):
+        """Start prefetching the offered actions of a session (replaces the previous turn)
+
+        Args:
+            session_id (_type_): id of the session
+            actions (_type_): the offered actions
+            backend (RetrievalBackend): the retrieval backend
+            story_id (str): id of the story
+            k (int, optional): number of similar results. Defaults to 5.
+            choosen_character (_type_, optional): needed to pre-generate advancements. Defaults to None.
+            exact_fragments (_type_, optional): character fragments, for pre-generated advancements. Defaults to None.
+            no_of_steps (_type_, optional): steps left at the next turn, for pre-generated advancements. Defaults to None.
+        """
+        actions = list(dict.fromkeys(actions or []))
+        # the entry is complete before it is published, similar() may look it up at once
+        entry = {"continuations": {}}
+        entry["similar"] = submit_in_context(self.executor, self._similar_task, entry, session_id, actions, backend, story_id, k, 
+                                             choosen_character, exact_fragments, no_of_steps)
+        with self.lock:
+            self.sessions[session_id] = entry
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def _similar_task(self, entry, session_id, actions, backend, story_id, k, 
+                      choosen_character, exact_fragments, no_of_steps):
+        embeddings = get_embeddings(actions)
+        similar = dict(zip(actions, backend.get_similar_batch(embeddings, story_id, k))) if actions else {}
+        if choosen_character is not None and no_of_steps is not None:
+            for action in actions[:self.speculative_actions]:
+                if not self._take_llm_budget():
+                    break
+                fragment_list = fuse_fragments([list(exact_fragments or []), similar[action]])
+                entry["continuations"][action] = submit_in_context(self.executor, speculate_advancement, choosen_character, 
+                                                                   fragment_list, session_id, no_of_steps, action)
+        return similar
+
+    def _take_llm_budget(self)-> bool:
+        with self.lock:
+            now = time.monotonic()
+            while self.llm_calls and now - self.llm_calls[0] > 60:
+                self.llm_calls.popleft()
+            if len(self.llm_calls) >= self.llm_budget_per_minute:
+                self.budget_skips += 1
+                return False
+            self.llm_calls.append(now)
+            return True
+
+    def similar(self, session_id, action, timeout:float = PREFETCH_TIMEOUT_SECONDS):
+        """Prefetched similar fragments of an action, waiting up to timeout seconds for a running prefetch
+
+        Returns:
+            list: the fragments, or None if the action was not prefetched or the prefetch failed
+        """
+        with self.lock:
+            entry = self.sessions.get(session_id)
+        fragments = None
+        if entry is not None:
+            try:
+                fragments = entry["similar"].result(timeout=timeout).get(action)
+            except Exception:
+                metrics.count("prefetch_similar_failed")
+        with self.lock:
+            if fragments is None:
+                self.similar_misses += 1
+            else:
+                self.similar_hits += 1
+        return fragments
+
+    def continuation(self, session_id, action, timeout:float = PREFETCH_TIMEOUT_SECONDS):
+        """Pre-generated advancement of an action, waiting up to timeout seconds for a running generation
+
+        Returns:
+            str: the advancement content, or None if it was not pre-generated or the generation failed
+        """
+        with self.lock:
+            entry = self.sessions.get(session_id)
+        content = None
+        if entry is not None:
+            try:
+                entry["similar"].result(timeout=timeout)
+                future = entry["continuations"].get(action)
+                content = future.result(timeout=timeout) if future is not None else None
+            except Exception:
+                metrics.count("prefetch_continuation_failed")
+        with self.lock:
+            if content is None:
+                self.continuation_misses += 1
+            else:
+                self.continuation_hits += 1
+        return content
+
+    def stats(self) -> dict:
+        """Prefetch hit statistics
+
+        Returns:
+            dict: hits and misses of prefetched fragments and pre-generated advancements, and budget skips
+        """
+        with self.lock:
+            return {"similar_hits": self.similar_hits, "similar_misses": self.similar_misses, 
+                    "continuation_hits": self.continuation_hits, "continuation_misses": self.continuation_misses, 
+                    "budget_skips": self.budget_skips, "sessions": len(self.sessions)}
+
+action_prefetcher = ActionPrefetcher()
+